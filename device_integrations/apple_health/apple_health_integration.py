@@ -0,0 +1,446 @@
+"""
+Apple Health Integration via HealthKit export files
+Apple exposes no server-side API; users export export.xml (or export.zip) from the
+Health app, which is stream-parsed here and bulk-loaded into the metric store
+"""
+
+import asyncio
+import os
+import zipfile
+from datetime import datetime, timedelta
+from typing import Dict, IO, Iterator, List, Optional, Any, Tuple
+from xml.etree.ElementTree import iterparse
+from loguru import logger
+import numpy as np
+
+from ..common.base_device import (
+    BaseDeviceIntegration, HealthMetric, DeviceConnection, SyncResult, IngestStats
+)
+from ..common.rollups import EPOCH
+from ..common.sleep_sessions import SleepSession
+
+# HealthKit unit -> (scale, offset) into the standardized unit, per standardized metric
+UNIT_CONVERSIONS: Dict[str, Dict[str, Tuple[float, float]]] = {
+    'steps': {'count': (1.0, 0.0)},
+    'heart_rate': {'count/min': (1.0, 0.0)},
+    'resting_heart_rate': {'count/min': (1.0, 0.0)},
+    'walking_heart_rate': {'count/min': (1.0, 0.0)},
+    'hrv_sdnn': {'ms': (1.0, 0.0)},
+    'blood_oxygen': {'%': (100.0, 0.0)},             # exported as a fraction
+    'respiratory_rate': {'count/min': (1.0, 0.0)},
+    'body_temperature': {'degC': (1.0, 0.0), 'degF': (5 / 9, -160 / 9)},
+    'weight_kg': {'kg': (1.0, 0.0), 'lb': (0.45359237, 0.0), 'g': (0.001, 0.0)},
+    'body_fat_percent': {'%': (100.0, 0.0)},         # exported as a fraction
+    'calories_burned': {'kcal': (1.0, 0.0), 'Cal': (1.0, 0.0), 'kJ': (1 / 4.184, 0.0)},
+    'distance_km': {'km': (1.0, 0.0), 'mi': (1.609344, 0.0), 'm': (0.001, 0.0)},
+    'vo2_max': {'mL/min·kg': (1.0, 0.0)},
+    'active_minutes': {'min': (1.0, 0.0)},
+}
+
+STANDARD_UNITS = {
+    'steps': 'count',
+    'heart_rate': 'bpm',
+    'resting_heart_rate': 'bpm',
+    'walking_heart_rate': 'bpm',
+    'hrv_sdnn': 'ms',
+    'blood_oxygen': 'percent',
+    'respiratory_rate': 'breaths/min',
+    'body_temperature': 'celsius',
+    'weight_kg': 'kg',
+    'body_fat_percent': 'percent',
+    'calories_burned': 'kcal',
+    'distance_km': 'km',
+    'vo2_max': 'ml/kg/min',
+    'active_minutes': 'minutes',
+}
+
+SLEEP_ANALYSIS = 'HKCategoryTypeIdentifierSleepAnalysis'
+
+# Stage values that count as time asleep (InBed and Awake do not)
+ASLEEP_VALUES = {
+    'HKCategoryValueSleepAnalysisAsleep',
+    'HKCategoryValueSleepAnalysisAsleepUnspecified',
+    'HKCategoryValueSleepAnalysisAsleepCore',
+    'HKCategoryValueSleepAnalysisAsleepDeep',
+    'HKCategoryValueSleepAnalysisAsleepREM',
+}
+
+# Asleep samples separated by less than this belong to the same session
+SLEEP_SESSION_GAP = timedelta(hours=1)
+
+# Samples typed in by hand rather than measured
+USER_ENTERED_QUALITY = 0.5
+
+# An import yields to the event loop after parsing this many elements and between
+# store writes of at most about this many records (cut on day boundaries), so a
+# large export doesn't stall other syncs
+PARSE_YIELD_ELEMENTS = 1_000
+WRITE_SLICE_RECORDS = 2_000
+
+MS_PER_DAY = 86_400_000
+
+def _day_slices(timestamps_ms: np.ndarray, size: int) -> List[Tuple[int, int]]:
+    """
+    [lo, hi) row ranges of sorted timestamps, each at least `size` rows (bar the last)
+    and ending on a day boundary, so consecutive writes don't re-encode a shared day
+    """
+    day_starts = (np.flatnonzero(np.diff(timestamps_ms // MS_PER_DAY)) + 1).tolist()
+    slices, lo = [], 0
+    for row in day_starts:
+        if row - lo >= size:
+            slices.append((lo, row))
+            lo = row
+    slices.append((lo, len(timestamps_ms)))
+    return slices
+
+class AppleHealthIntegration(BaseDeviceIntegration):
+    """
+    Apple Health integration that imports HealthKit export files
+    """
+    
+    def __init__(self, batch_size: int = 200_000):
+        super().__init__("apple")
+        
+        # HealthKit record types to standardized names
+        # Apple reports HRV as SDNN, which is not interchangeable with RMSSD
+        self.metric_mappings = {
+            'HKQuantityTypeIdentifierStepCount': 'steps',
+            'HKQuantityTypeIdentifierHeartRate': 'heart_rate',
+            'HKQuantityTypeIdentifierRestingHeartRate': 'resting_heart_rate',
+            'HKQuantityTypeIdentifierWalkingHeartRateAverage': 'walking_heart_rate',
+            'HKQuantityTypeIdentifierHeartRateVariabilitySDNN': 'hrv_sdnn',
+            'HKQuantityTypeIdentifierOxygenSaturation': 'blood_oxygen',
+            'HKQuantityTypeIdentifierRespiratoryRate': 'respiratory_rate',
+            'HKQuantityTypeIdentifierBodyTemperature': 'body_temperature',
+            'HKQuantityTypeIdentifierBodyMass': 'weight_kg',
+            'HKQuantityTypeIdentifierBodyFatPercentage': 'body_fat_percent',
+            'HKQuantityTypeIdentifierActiveEnergyBurned': 'calories_burned',
+            'HKQuantityTypeIdentifierDistanceWalkingRunning': 'distance_km',
+            'HKQuantityTypeIdentifierVO2Max': 'vo2_max',
+            'HKQuantityTypeIdentifierAppleExerciseTime': 'active_minutes',
+        }
+        
+        # Records buffered across all metric types before a bulk write
+        self.batch_size = batch_size
+        
+        # user_id -> export file registered at authentication
+        self.export_paths: Dict[str, str] = {}
+    
+    async def authenticate(self, credentials: Dict[str, str]) -> DeviceConnection:
+        """
+        Register a user's export file; there is no OAuth flow for HealthKit exports
+        """
+        user_id = credentials.get('user_id')
+        export_path = credentials.get('export_path')
+        
+        if not all([user_id, export_path]):
+            raise ValueError("Missing required Apple Health credentials")
+        if not os.path.exists(export_path):
+            raise ValueError(f"Apple Health export not found: {export_path}")
+        
+        self.export_paths[user_id] = export_path
+        
+        connection = DeviceConnection(
+            user_id=user_id,
+            device_type=self.device_type,
+            access_token='',
+            permissions=['export'],
+            status='active'
+        )
+        
+        logger.info(f"Apple Health export registered for user {user_id}")
+        return connection
+    
+    async def refresh_token(self, connection: DeviceConnection) -> DeviceConnection:
+        """Exports carry no tokens"""
+        return connection
+    
+    async def get_available_metrics(self, connection: DeviceConnection) -> List[str]:
+        """
+        Get available metrics from Apple Health exports
+        """
+        return sorted(set(self.metric_mappings.values())) + ['sleep_duration']
+    
+    async def sync_metrics(self, connection: DeviceConnection,
+                          start_date: datetime, end_date: datetime,
+                          metric_types: List[str] = None) -> SyncResult:
+        """
+        Import the user's registered export file for the date range
+        Yields to the event loop every few thousand parsed elements and between store
+        writes so other syncs keep running
+        """
+        export_path = self.export_paths.get(connection.user_id)
+        if export_path is None:
+            return SyncResult(
+                success=False,
+                metrics_synced=0,
+                errors=[f"No Apple Health export registered for user {connection.user_id}"],
+                last_sync_time=datetime.now()
+            )
+        
+        importer = self._import(connection, export_path, start_date, end_date, metric_types)
+        while True:
+            try:
+                next(importer)
+            except StopIteration as done:
+                return done.value
+            await asyncio.sleep(0)
+    
+    async def get_real_time_data(self, connection: DeviceConnection) -> List[HealthMetric]:
+        """Exports are point-in-time snapshots; there is no real-time feed"""
+        return []
+    
+    def import_export(self, connection: DeviceConnection, export_path: str,
+                      start_date: datetime = None, end_date: datetime = None,
+                      metric_types: List[str] = None) -> SyncResult:
+        """
+        Import an export.xml (or the export.zip containing it) into the metric store
+        Memory stays bounded by batch_size regardless of the file's size
+        """
+        importer = self._import(connection, export_path, start_date, end_date, metric_types)
+        while True:
+            try:
+                next(importer)
+            except StopIteration as done:
+                return done.value
+    
+    def _open_export(self, export_path: str) -> IO[bytes]:
+        if zipfile.is_zipfile(export_path):
+            archive = zipfile.ZipFile(export_path)
+            names = [n for n in archive.namelist() if n.endswith('/export.xml') or n == 'export.xml']
+            if not names:
+                raise ValueError(f"No export.xml in {export_path}")
+            # Streams the member; the archive closes when the member is closed
+            return archive.open(names[0])
+        return open(export_path, 'rb')
+    
+    def _iter_records(self, export_file: IO[bytes]) -> Iterator[Any]:
+        """
+        Top-level elements of the export, cleared once consumed so the parsed tree
+        never holds more than the current element
+        """
+        events = iterparse(export_file, events=('start', 'end'))
+        _, root = next(events)
+        depth = 0
+        for event, element in events:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                yield element
+                element.clear()
+                # Drop the cleared children the root still references
+                root.clear()
+    
+    def _import(self, connection: DeviceConnection, export_path: str,
+                start_date: Optional[datetime], end_date: Optional[datetime],
+                metric_types: Optional[List[str]]) -> Iterator[None]:
+        """Stream records into per-metric buffers and bulk-write them batch by batch"""
+        started = datetime.now()
+        logger.info(f"Starting Apple Health import for {connection.user_id} from {export_path}")
+        
+        wanted = set(metric_types) if metric_types else None
+        start_ms = self._epoch_ms(start_date) if start_date else None
+        end_ms = self._epoch_ms(end_date) if end_date else None
+        
+        # metric_type -> (timestamps ms, values, quality); flushed together at batch_size
+        buffers: Dict[str, Tuple[List[int], List[float], List[float]]] = {}
+        buffered = 0
+        stats = IngestStats()
+        errors = []
+        skipped = 0
+        quality_sum = 0.0
+        imported = 0
+        asleep: List[Tuple[int, int]] = []
+        day_cache: Dict[str, int] = {}
+        
+        def flush() -> Iterator[None]:
+            """Write the buffers in day-aligned slices, yielding after each"""
+            nonlocal buffered
+            pending = list(buffers.items())
+            buffers.clear()
+            buffered = 0
+            for metric_type, (timestamps, values, quality) in pending:
+                if not timestamps:
+                    continue
+                timestamps = np.array(timestamps, dtype=np.int64)
+                order = np.argsort(timestamps, kind='stable')
+                timestamps = timestamps[order]
+                values = np.array(values)[order]
+                quality = np.array(quality)[order]
+                for lo, hi in _day_slices(timestamps, WRITE_SLICE_RECORDS):
+                    stats.merge(self.store_metric_arrays(
+                        connection, metric_type, timestamps[lo:hi], values[lo:hi],
+                        quality[lo:hi], STANDARD_UNITS[metric_type]
+                    ))
+                    yield
+        
+        parsed = 0
+        try:
+            with self._open_export(export_path) as export_file:
+                for element in self._iter_records(export_file):
+                    parsed += 1
+                    if parsed % PARSE_YIELD_ELEMENTS == 0:
+                        yield
+                    if element.tag != 'Record':
+                        continue
+                    
+                    record_type = element.get('type')
+                    if record_type == SLEEP_ANALYSIS:
+                        if element.get('value') in ASLEEP_VALUES:
+                            asleep.append((
+                                self._parse_ms(element.get('startDate'), day_cache),
+                                self._parse_ms(element.get('endDate'), day_cache)
+                            ))
+                        continue
+                    
+                    metric_type = self.metric_mappings.get(record_type)
+                    if metric_type is None or (wanted is not None and metric_type not in wanted):
+                        continue
+                    
+                    conversion = UNIT_CONVERSIONS[metric_type].get(element.get('unit'))
+                    timestamp_ms = self._parse_ms(element.get('startDate'), day_cache)
+                    if conversion is None or (start_ms is not None and timestamp_ms < start_ms) \
+                            or (end_ms is not None and timestamp_ms >= end_ms):
+                        skipped += 1
+                        continue
+                    
+                    try:
+                        value = float(element.get('value')) * conversion[0] + conversion[1]
+                    except (TypeError, ValueError):
+                        skipped += 1
+                        continue
+                    if not self.validate_metric_value(metric_type, value):
+                        skipped += 1
+                        continue
+                    
+                    quality = 1.0
+                    if len(element):
+                        for entry in element.iterfind('MetadataEntry'):
+                            if entry.get('key') == 'HKWasUserEntered' and entry.get('value') == '1':
+                                quality = USER_ENTERED_QUALITY
+                    
+                    buffer = buffers.get(metric_type)
+                    if buffer is None:
+                        buffer = buffers[metric_type] = ([], [], [])
+                    buffer[0].append(timestamp_ms)
+                    buffer[1].append(value)
+                    buffer[2].append(quality)
+                    buffered += 1
+                    quality_sum += quality
+                    imported += 1
+                    
+                    if buffered >= self.batch_size:
+                        yield from flush()
+            
+            yield from flush()
+            if wanted is None or 'sleep_duration' in wanted:
+                sleep_metrics = self._record_sleep(connection, asleep, start_ms, end_ms)
+                stats.merge(self.store_metrics(connection, sleep_metrics))
+                imported += len(sleep_metrics)
+                quality_sum += len(sleep_metrics)
+        
+        except Exception as e:
+            logger.error(f"Error during Apple Health import: {e}")
+            errors.append(str(e))
+            # Keep what was parsed before the failure
+            yield from flush()
+        
+        connection.last_sync = datetime.now()
+        quality_score = quality_sum / imported if imported else 0.0
+        
+        elapsed = (connection.last_sync - started).total_seconds()
+        logger.info(
+            f"Apple Health import completed: {imported} metrics "
+            f"({stats.inserted} new, {stats.updated} revised, {stats.unchanged} unchanged, "
+            f"{skipped} skipped) in {elapsed:.1f}s, quality: {quality_score:.2f}"
+        )
+        
+        return SyncResult(
+            success=len(errors) == 0,
+            metrics_synced=imported,
+            errors=errors,
+            last_sync_time=connection.last_sync,
+            data_quality_score=quality_score,
+            ingest_stats=stats
+        )
+    
+    def _record_sleep(self, connection: DeviceConnection, asleep: List[Tuple[int, int]],
+                      start_ms: Optional[int], end_ms: Optional[int]) -> List[HealthMetric]:
+        """
+        Merge asleep stage samples into sessions for stitching, one sleep_duration each
+        Watch and phone samples overlap, so time asleep is the union of the intervals
+        """
+        metrics = []
+        if not asleep:
+            return metrics
+        
+        gap_ms = SLEEP_SESSION_GAP.total_seconds() * 1000
+        sessions: List[List[int]] = []  # [start, end, asleep ms]
+        covered_until = None
+        for begin, finish in sorted(asleep):
+            if sessions and begin - sessions[-1][1] < gap_ms:
+                session = sessions[-1]
+            else:
+                session = [begin, finish, 0]
+                sessions.append(session)
+                covered_until = begin
+            
+            # Only count the part not already covered by an overlapping sample
+            if finish > covered_until:
+                session[2] += finish - max(begin, covered_until)
+                covered_until = finish
+            session[1] = max(session[1], finish)
+        
+        for begin, finish, asleep_ms in sessions:
+            if (start_ms is not None and begin < start_ms) or (end_ms is not None and begin >= end_ms):
+                continue
+            
+            start = EPOCH + timedelta(milliseconds=begin)
+            sleep_hours = asleep_ms / 3_600_000
+            session_id = f"apple:{start.isoformat()}"
+            self.record_sleep_session(SleepSession(
+                user_id=connection.user_id,
+                source_device=self.device_type,
+                start=start,
+                end=EPOCH + timedelta(milliseconds=finish),
+                sleep_hours=sleep_hours,
+                efficiency=100 * asleep_ms / (finish - begin) if finish > begin else None,
+                session_id=session_id,
+                is_main_sleep=sleep_hours >= 3
+            ))
+            
+            if self.validate_metric_value('sleep_duration', sleep_hours):
+                metrics.append(HealthMetric(
+                    metric_type='sleep_duration',
+                    value=sleep_hours,
+                    unit='hours',
+                    timestamp=start,
+                    source_device=self.device_type,
+                    metadata={'natural_id': session_id}
+                ))
+        
+        return metrics
+    
+    def _parse_ms(self, timestamp_str: str, day_cache: Dict[str, int]) -> int:
+        """
+        Milliseconds since EPOCH on the sleeper's wall clock for HealthKit's
+        'YYYY-MM-DD HH:MM:SS +HHMM' format; the offset is dropped like other sources
+        """
+        try:
+            day_ms = day_cache.get(timestamp_str[:10])
+            if day_ms is None:
+                day_ms = day_cache[timestamp_str[:10]] = self._epoch_ms(
+                    datetime.strptime(timestamp_str[:10], '%Y-%m-%d')
+                )
+            return day_ms + 1000 * (
+                int(timestamp_str[11:13]) * 3600 + int(timestamp_str[14:16]) * 60
+                + int(timestamp_str[17:19])
+            )
+        except (TypeError, ValueError):
+            return self._epoch_ms(self.normalize_timestamp(timestamp_str or ''))
+    
+    @staticmethod
+    def _epoch_ms(timestamp: datetime) -> int:
+        return (timestamp.replace(tzinfo=None) - EPOCH) // timedelta(milliseconds=1)
@@ -0,0 +1,349 @@
+"""
+Micro-benchmarks for the per-sample hot paths of BaseDeviceIntegration
+Each path runs over synthetic 1k / 100k / 1M sample datasets with repeated timings
+(GC paused, best-of and median reported) and a separate tracemalloc pass for peak
+allocation and retained blocks. Candidate replacements, e.g. vectorized versions,
+can be registered against a path and are timed and checked against the current code
+
+    python -m device_integrations.benchmarks.hot_paths --sizes 1000,100000 --output hot.json
+    python -m device_integrations.benchmarks.hot_paths \\
+        --candidate detect_outliers=mypackage.vectorized:detect_outliers
+    python -m device_integrations.benchmarks.hot_paths --compare base.json hot.json
+"""
+
+import argparse
+import gc
+import importlib
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict, field, replace
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+from loguru import logger
+import numpy as np
+
+from ..common.base_device import HealthMetric
+from ..fitbit.fitbit_integration import FitbitIntegration
+from ..oura.oura_integration import OuraIntegration
+from .sync_benchmark import git_commit
+
+# Timestamps in the shapes vendors actually send; all but the first two miss the
+# fast strptime formats in normalize_timestamp
+TIMESTAMP_FORMATS = [
+    '%Y-%m-%dT%H:%M:%S.%fZ',        # Fitbit / generic UTC
+    '%Y-%m-%d',                     # daily summaries
+    '%Y-%m-%dT%H:%M:%S.000',        # Fitbit sleep startTime
+    '%Y-%m-%dT%H:%M:%S+02:00',      # Oura, with offset
+]
+
+# metric_type -> (share of samples, typical value, spread); intraday heart rate dominates
+SAMPLE_MIX = {
+    'heart_rate': (0.85, 72.0, 12.0),
+    'steps': (0.05, 90.0, 60.0),
+    'hrv_rmssd': (0.04, 45.0, 15.0),
+    'sleep_efficiency': (0.02, 88.0, 5.0),
+    'calories_burned': (0.02, 8.0, 4.0),
+    'custom_metric': (0.02, 1.0, 0.5),   # no validation range
+}
+
+DEFAULT_SIZES = [1_000, 100_000, 1_000_000]
+
+class SyntheticSamples:
+    """Deterministic inputs for every hot path at one dataset size"""
+    
+    def __init__(self, size: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.size = size
+        
+        types = list(SAMPLE_MIX)
+        shares = np.array([SAMPLE_MIX[t][0] for t in types])
+        type_index = rng.choice(len(types), size=size, p=shares / shares.sum())
+        means = np.array([SAMPLE_MIX[t][1] for t in types])[type_index]
+        spreads = np.array([SAMPLE_MIX[t][2] for t in types])[type_index]
+        values = means + spreads * rng.standard_normal(size)
+        # A few wild readings so outlier detection and validation have work to do
+        wild = rng.random(size) < 0.01
+        values[wild] *= rng.uniform(3, 10, int(wild.sum()))
+        
+        # Recent minute-resolution samples, so freshness scoring sees realistic ages
+        start = datetime.now().replace(second=0, microsecond=0) - timedelta(minutes=size)
+        timestamps = [start + timedelta(minutes=i) for i in range(size)]
+        
+        self.metric_types = [types[i] for i in type_index.tolist()]
+        self.values = values.tolist()
+        self.metrics = [
+            HealthMetric(
+                metric_type=metric_type,
+                value=value,
+                unit='unit',
+                timestamp=timestamp,
+                source_device='fitbit',
+                quality_score=1.0
+            )
+            for metric_type, value, timestamp in zip(self.metric_types, self.values, timestamps)
+        ]
+        self.timestamp_strings = [
+            timestamp.strftime(TIMESTAMP_FORMATS[i % len(TIMESTAMP_FORMATS)])
+            for i, timestamp in enumerate(timestamps)
+        ]
+        # Beat-to-beat intervals in ms around 60-90 bpm
+        self.rr_intervals = (800 + 120 * rng.standard_normal(size)).clip(300, 2000).tolist()
+
+@dataclass
+class HotPath:
+    """A hot path: how to build its input (untimed, once per run) and the current code"""
+    name: str
+    inputs: Callable[[SyntheticSamples], tuple]
+    current: Callable[..., Any]
+
+def _build_hot_paths() -> Dict[str, HotPath]:
+    fitbit = FitbitIntegration()
+    oura = OuraIntegration()
+    
+    return {
+        'normalize_timestamp': HotPath(
+            'normalize_timestamp',
+            lambda d: (d.timestamp_strings,),
+            lambda strings: [fitbit.normalize_timestamp(s) for s in strings]
+        ),
+        'validate_metric_value': HotPath(
+            'validate_metric_value',
+            lambda d: (d.metric_types, d.values),
+            lambda types, values: [fitbit.validate_metric_value(t, v) for t, v in zip(types, values)]
+        ),
+        'detect_outliers': HotPath(
+            'detect_outliers',
+            # Fresh copies per run: flagged outliers are modified in place
+            lambda d: ([replace(m) for m in d.metrics],),
+            fitbit.detect_outliers
+        ),
+        'calculate_quality_score': HotPath(
+            'calculate_quality_score',
+            lambda d: (d.metrics,),
+            fitbit.calculate_quality_score
+        ),
+        '_calculate_rmssd': HotPath(
+            '_calculate_rmssd',
+            lambda d: (d.rr_intervals,),
+            oura._calculate_rmssd
+        ),
+        'to_dict': HotPath(
+            'to_dict',
+            lambda d: (d.metrics,),
+            lambda metrics: [m.to_dict() for m in metrics]
+        ),
+    }
+
+@dataclass
+class Measurement:
+    """Timings and allocations of one implementation of a path at one size"""
+    path: str
+    implementation: str
+    size: int
+    repeats: int
+    best_ms: float
+    median_ms: float
+    mean_ms: float
+    stdev_ms: float
+    ns_per_sample: float
+    peak_alloc_mb: float
+    retained_blocks: int
+    matches_current: Optional[bool] = None
+    speedup_vs_current: Optional[float] = None
+    timings_ms: List[float] = field(default_factory=list)
+
+def _results_match(expected: Any, actual: Any) -> bool:
+    """Candidates may return arrays or lists; floats are compared with tolerance"""
+    if isinstance(expected, (int, float)) or isinstance(actual, (int, float)):
+        return bool(np.isclose(float(expected), float(actual), rtol=1e-9, atol=1e-12))
+    if isinstance(expected, list) and expected and isinstance(expected[0], HealthMetric):
+        return len(expected) == len(actual) and all(
+            a.value == b.value and a.quality_score == b.quality_score
+            for a, b in zip(expected, actual)
+        )
+    expected, actual = list(expected), list(actual)
+    if len(expected) != len(actual):
+        return False
+    if expected and isinstance(expected[0], float):
+        return bool(np.allclose(expected, actual, rtol=1e-9))
+    return expected == actual
+
+def measure(path: HotPath, implementation: Callable[..., Any], implementation_name: str,
+            data: SyntheticSamples, repeats: int = 5, warmup: int = 1) -> Measurement:
+    """Time `repeats` runs after `warmup`, then one traced run for allocations"""
+    timings = []
+    for run in range(warmup + repeats):
+        args = path.inputs(data)
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter_ns()
+            implementation(*args)
+            elapsed = time.perf_counter_ns() - started
+        finally:
+            gc.enable()
+        if run >= warmup:
+            timings.append(elapsed / 1e6)
+    
+    # tracemalloc slows every allocation, so it gets its own run
+    args = path.inputs(data)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    result = implementation(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    del result
+    
+    return Measurement(
+        path=path.name,
+        implementation=implementation_name,
+        size=data.size,
+        repeats=repeats,
+        best_ms=min(timings),
+        median_ms=statistics.median(timings),
+        mean_ms=statistics.fmean(timings),
+        stdev_ms=statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        ns_per_sample=min(timings) * 1e6 / data.size,
+        peak_alloc_mb=(peak - baseline) / 2**20,
+        retained_blocks=retained,
+        timings_ms=timings
+    )
+
+def load_candidate(spec: str) -> Callable[..., Any]:
+    """'package.module:function' -> the function"""
+    module_name, _, attribute = spec.partition(':')
+    if not attribute:
+        raise ValueError(f"Candidate must be module:function, got {spec}")
+    return getattr(importlib.import_module(module_name), attribute)
+
+def run_hot_paths(sizes: List[int], paths: List[str] = None, repeats: int = 5,
+                  candidates: Dict[str, Dict[str, Callable[..., Any]]] = None,
+                  seed: int = 0) -> Dict[str, Any]:
+    """
+    Measure each path at each size; candidates maps path -> {name: implementation}
+    and every candidate is checked against the current result
+    """
+    hot_paths = _build_hot_paths()
+    paths = paths or list(hot_paths)
+    candidates = candidates or {}
+    unknown = (set(paths) | set(candidates)) - set(hot_paths)
+    if unknown:
+        raise ValueError(f"Unknown hot paths: {sorted(unknown)}")
+    
+    measurements: List[Measurement] = []
+    for size in sizes:
+        data = SyntheticSamples(size, seed)
+        for name in paths:
+            path = hot_paths[name]
+            current = measure(path, path.current, 'current', data, repeats)
+            measurements.append(current)
+            _print_measurement(current)
+            
+            expected = path.current(*path.inputs(data))
+            for candidate_name, implementation in candidates.get(name, {}).items():
+                candidate = measure(path, implementation, candidate_name, data, repeats)
+                candidate.matches_current = _results_match(expected, implementation(*path.inputs(data)))
+                candidate.speedup_vs_current = current.best_ms / candidate.best_ms if candidate.best_ms else None
+                measurements.append(candidate)
+                _print_measurement(candidate)
+        del data
+    
+    return {
+        'benchmark': 'hot_paths',
+        'created': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'results': [asdict(m) for m in measurements],
+    }
+
+def _print_measurement(m: Measurement):
+    line = (
+        f"{m.path:<24} {m.implementation:<14} n={m.size:<9} best {m.best_ms:>10.2f}ms "
+        f"median {m.median_ms:>10.2f}ms  {m.ns_per_sample:>8.0f}ns/sample  "
+        f"peak {m.peak_alloc_mb:>8.1f}MB  retained {m.retained_blocks:>8}"
+    )
+    if m.speedup_vs_current is not None:
+        line += f"  x{m.speedup_vs_current:.2f}{'' if m.matches_current else '  MISMATCH'}"
+    print(line)
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = 0.10) -> List[str]:
+    """Best-of timing and peak allocation changes per (path, implementation, size)"""
+    key = lambda r: (r['path'], r['implementation'], r['size'])
+    base_results = {key(r): r for r in baseline['results']}
+    lines = [f"{baseline.get('commit') or 'baseline'} -> {current.get('commit') or 'current'}"]
+    
+    for result in current['results']:
+        base = base_results.get(key(result))
+        if base is None:
+            continue
+        for metric in ('best_ms', 'peak_alloc_mb'):
+            before, after = base[metric], result[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            flag = 'REGRESSION' if change > threshold else ('improved' if change < -threshold else '')
+            lines.append(
+                f"{result['path']:<24} {result['implementation']:<14} n={result['size']:<9} "
+                f"{metric:<14} {before:>10.2f} -> {after:>10.2f} ({change:+.1%}) {flag}".rstrip()
+            )
+    return lines
+
+def _int_list(text: str) -> List[int]:
+    return [int(part) for part in text.split(',') if part]
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for per-sample hot paths")
+    parser.add_argument('--sizes', type=_int_list, default=DEFAULT_SIZES)
+    parser.add_argument('--paths', help="comma-separated subset of hot paths")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--candidate', action='append', default=[], metavar='PATH=MODULE:FUNCTION',
+                        help="time a replacement implementation against the current one")
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help="compare two result files instead of running")
+    parser.add_argument('--threshold', type=float, default=0.10)
+    args = parser.parse_args()
+    
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        lines = compare(baseline, current, args.threshold)
+        print('\n'.join(lines))
+        sys.exit(1 if any(line.endswith('REGRESSION') for line in lines) else 0)
+    
+    # Unparseable-timestamp errors and the like would dominate the timings
+    logger.remove()
+    
+    candidates: Dict[str, Dict[str, Callable[..., Any]]] = {}
+    for spec in args.candidate:
+        path, _, target = spec.partition('=')
+        candidates.setdefault(path, {})[target.rpartition(':')[2]] = load_candidate(target)
+    
+    report = run_hot_paths(
+        args.sizes, args.paths.split(',') if args.paths else None, args.repeats,
+        candidates, args.seed
+    )
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Rebalance-then-resync check for the sharded deployment
+Syncs users on a ShardedDeviceManager backed by the mock vendor server, adds a worker,
+then re-syncs the same window. The re-sync must be idempotent: users that moved to
+the new worker insert nothing, exactly like the users that stayed put. Exits non-zero
+when a moved user's re-sync inserts records, i.e. their dedup state was lost
+
+    python -m device_integrations.benchmarks.rebalance_check --users 12 --workers 2
+"""
+
+import argparse
+import asyncio
+import functools
+import sys
+from datetime import timedelta
+from typing import Dict, List
+from loguru import logger
+
+from ..mock_vendor_server import MockVendorServer, MockVendorConfig, attach_manager, MOCK_VENDORS
+from ..sharded_manager import ShardedDeviceManager
+from .sync_benchmark import BENCHMARK_END
+
+async def inserted_per_user(sharded: ShardedDeviceManager, user_ids: List[str],
+                            start_date, end_date) -> Dict[str, int]:
+    """Records each user's sync inserted into the store, across vendors"""
+    synced = await asyncio.gather(*(
+        sharded.sync_user_data(user_id, start_date, end_date) for user_id in user_ids
+    ))
+    inserted = {}
+    for user_id, results in zip(user_ids, synced):
+        failed = [f"{device}: {result.errors}" for device, result in results.items() if not result.success]
+        if failed:
+            raise RuntimeError(f"Sync failed for {user_id}: {failed}")
+        inserted[user_id] = sum(
+            result.ingest_stats.inserted for result in results.values() if result.ingest_stats
+        )
+    return inserted
+
+async def run_check(users: int, workers: int, days: int, seed: int = 0) -> List[str]:
+    """Problems found; empty when every moved user re-synced without inserting"""
+    async with MockVendorServer(MockVendorConfig(seed=seed)) as server:
+        async with ShardedDeviceManager(
+            workers=workers, worker_setup=functools.partial(attach_manager, server.url)
+        ) as sharded:
+            user_ids = [f"rebalance-user-{i}" for i in range(users)]
+            for user_id in user_ids:
+                for vendor in MOCK_VENDORS:
+                    await sharded.authenticate_device(user_id, vendor, {
+                        'client_id': 'check', 'client_secret': 'check', 'redirect_uri': 'check',
+                        'authorization_code': user_id, 'user_id': user_id
+                    })
+            
+            end_date = BENCHMARK_END
+            start_date = end_date - timedelta(days=days - 1)
+            await inserted_per_user(sharded, user_ids, start_date, end_date)
+            
+            owners = {user_id: sharded.worker_for(user_id) for user_id in user_ids}
+            await sharded.add_worker()
+            moved = {user_id for user_id in user_ids if sharded.worker_for(user_id) != owners[user_id]}
+            
+            inserted = await inserted_per_user(sharded, user_ids, start_date, end_date)
+    
+    print(f"{len(moved)} of {users} users moved to the new worker")
+    problems = []
+    if not moved:
+        problems.append("No user moved; use more users to exercise a handover")
+    for user_id in user_ids:
+        if inserted[user_id]:
+            where = 'moved' if user_id in moved else 'unmoved'
+            problems.append(f"{user_id} ({where}) inserted {inserted[user_id]} records on re-sync")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that re-syncs after a rebalance insert nothing")
+    parser.add_argument('--users', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    
+    problems = asyncio.run(run_check(args.users, args.workers, args.days, args.seed))
+    print('\n'.join(problems) or "ok: re-sync after rebalance inserted nothing")
+    sys.exit(1 if problems else 0)
+
+if __name__ == '__main__':
+    main()
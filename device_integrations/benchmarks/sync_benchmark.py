@@ -0,0 +1,352 @@
+"""
+Sync throughput benchmarks against the local mock vendor server
+Drives DeviceManager.sync_user_data (or each vendor's sync_metrics) over a matrix of
+user counts, date windows and intraday settings, and writes JSON results that can be
+compared across commits
+The mock server shares the benchmark's event loop, so its request handling counts
+toward loop lag and CPU time
+
+    python -m device_integrations.benchmarks.sync_benchmark --users 1,100 --days 1,7,30 \\
+        --output results.json
+    python -m device_integrations.benchmarks.sync_benchmark --compare base.json results.json
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from loguru import logger
+
+from ..common.base_device import SyncResult
+from ..device_manager import DeviceManager, UserDeviceProfile
+from ..mock_vendor_server import MockVendorServer, MockVendorConfig, LatencyModel, MOCK_VENDORS
+
+# Synced windows end here so every run requests the same synthetic data
+BENCHMARK_END = datetime(2024, 6, 30)
+
+# Rough metrics per user-day from both mock vendors, used to skip oversized scenarios
+METRICS_PER_USER_DAY = 115
+INTRADAY_METRICS_PER_USER_DAY = 1440
+
+# A scenario metric moving this much in the bad direction is reported as a regression
+REGRESSION_THRESHOLD = 0.10
+
+# Higher is better for these; lower is better for every other compared metric
+HIGHER_IS_BETTER = {'calls_per_second', 'metrics_per_second'}
+COMPARED_METRICS = [
+    'calls_per_second', 'metrics_per_second', 'sync_p50_ms', 'sync_p99_ms',
+    'peak_rss_mb', 'loop_lag_p99_ms'
+]
+
+@dataclass
+class Scenario:
+    """One benchmark configuration"""
+    users: int
+    days: int
+    intraday: bool
+    mode: str = 'manager'       # 'manager' (sync_user_data) | 'vendor' (sync_metrics)
+    concurrency: int = 64       # syncs in flight at once
+    latency_ms: float = 0.0     # median mock latency per request
+    
+    @property
+    def name(self) -> str:
+        return (f"{self.mode}-u{self.users}-d{self.days}-"
+                f"{'intraday' if self.intraday else 'daily'}-l{self.latency_ms:g}")
+    
+    @property
+    def estimated_metrics(self) -> int:
+        per_day = METRICS_PER_USER_DAY + (INTRADAY_METRICS_PER_USER_DAY if self.intraday else 0)
+        return self.users * self.days * per_day
+
+@dataclass
+class ScenarioResult:
+    """Measurements for one scenario; skipped scenarios carry only a note"""
+    name: str
+    scenario: Dict[str, Any]
+    status: str = 'ok'          # 'ok' | 'skipped'
+    note: str = ''
+    wall_seconds: float = 0.0
+    calls: int = 0
+    calls_per_second: float = 0.0
+    metrics: int = 0
+    metrics_per_second: float = 0.0
+    syncs: int = 0
+    failed_syncs: int = 0
+    sync_p50_ms: float = 0.0
+    sync_p99_ms: float = 0.0
+    start_rss_mb: float = 0.0
+    peak_rss_mb: float = 0.0
+    loop_lag_p50_ms: float = 0.0
+    loop_lag_p99_ms: float = 0.0
+    loop_lag_max_ms: float = 0.0
+    status_counts: Dict[str, int] = field(default_factory=dict)
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile; 0.0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+def current_rss_mb() -> float:
+    """Resident set size now (Linux /proc), else the process peak"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class LoopMonitor:
+    """
+    Samples event-loop lag (how late a periodic wake-up fires) and resident memory
+    while a scenario runs
+    """
+    
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.lags_ms: List[float] = []
+        self.peak_rss_mb = 0.0
+        self._task: Optional[asyncio.Task] = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags_ms.append(max(loop.time() - expected, 0.0) * 1000)
+            self.peak_rss_mb = max(self.peak_rss_mb, current_rss_mb())
+    
+    def start(self):
+        self.peak_rss_mb = current_rss_mb()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+async def run_scenario(scenario: Scenario, seed: int = 0) -> ScenarioResult:
+    """Sync every user once over the scenario's window and measure it"""
+    # Don't charge this scenario for garbage left by the previous one
+    gc.collect()
+    start_rss_mb = current_rss_mb()
+    
+    config = MockVendorConfig(
+        seed=seed,
+        latency=LatencyModel('lognormal', scenario.latency_ms),
+        intraday_interval=60 if scenario.intraday else 0
+    )
+    server = MockVendorServer(config)
+    await server.start()
+    
+    manager = DeviceManager()
+    # The mock's own rate limiting stands in for vendor quotas
+    manager.quota_planner.ledger.policies.clear()
+    for vendor in MOCK_VENDORS:
+        server.attach(manager.integrations[vendor])
+    
+    user_ids = [f"bench-user-{i}" for i in range(scenario.users)]
+    for user_id in user_ids:
+        manager.user_profiles[user_id] = UserDeviceProfile(
+            user_id=user_id,
+            connected_devices={
+                vendor: server.connect(manager.integrations[vendor], user_id)
+                for vendor in MOCK_VENDORS
+            },
+            sync_preferences={},
+            data_quality_scores={}
+        )
+    
+    end_date = BENCHMARK_END
+    start_date = end_date - timedelta(days=scenario.days - 1)
+    semaphore = asyncio.Semaphore(scenario.concurrency)
+    latencies_ms: List[float] = []
+    results: List[SyncResult] = []
+    
+    async def sync_user(user_id: str):
+        async with semaphore:
+            started = time.perf_counter()
+            synced = await manager.sync_user_data(user_id, start_date, end_date)
+            latencies_ms.append((time.perf_counter() - started) * 1000)
+            results.extend(synced.values())
+    
+    async def sync_vendor(user_id: str, vendor: str):
+        async with semaphore:
+            integration = manager.integrations[vendor]
+            connection = manager.user_profiles[user_id].connected_devices[vendor]
+            started = time.perf_counter()
+            async with integration:
+                result = await integration.sync_metrics(connection, start_date, end_date)
+            latencies_ms.append((time.perf_counter() - started) * 1000)
+            results.append(result)
+    
+    if scenario.mode == 'manager':
+        tasks = [sync_user(user_id) for user_id in user_ids]
+    elif scenario.mode == 'vendor':
+        tasks = [sync_vendor(user_id, vendor) for user_id in user_ids for vendor in MOCK_VENDORS]
+    else:
+        raise ValueError(f"Unknown benchmark mode: {scenario.mode}")
+    
+    monitor = LoopMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        wall = time.perf_counter() - started
+        await monitor.stop()
+        await server.stop()
+    
+    calls = sum(stats.requests for stats in server.stats.values())
+    metrics = sum(result.metrics_synced for result in results)
+    status_counts: Dict[str, int] = {}
+    for stats in server.stats.values():
+        for status, count in stats.by_status.items():
+            status_counts[str(status)] = status_counts.get(str(status), 0) + count
+    
+    return ScenarioResult(
+        name=scenario.name,
+        scenario=asdict(scenario),
+        wall_seconds=wall,
+        calls=calls,
+        calls_per_second=calls / wall if wall else 0.0,
+        metrics=metrics,
+        metrics_per_second=metrics / wall if wall else 0.0,
+        syncs=len(results),
+        failed_syncs=sum(1 for result in results if not result.success),
+        sync_p50_ms=percentile(latencies_ms, 0.5),
+        sync_p99_ms=percentile(latencies_ms, 0.99),
+        start_rss_mb=start_rss_mb,
+        peak_rss_mb=monitor.peak_rss_mb,
+        loop_lag_p50_ms=percentile(monitor.lags_ms, 0.5),
+        loop_lag_p99_ms=percentile(monitor.lags_ms, 0.99),
+        loop_lag_max_ms=max(monitor.lags_ms, default=0.0),
+        status_counts=status_counts
+    )
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_benchmarks(scenarios: List[Scenario], max_metrics: int,
+                         seed: int = 0) -> Dict[str, Any]:
+    """Run scenarios in order; ones predicted to exceed max_metrics are recorded as skipped"""
+    results = []
+    for scenario in scenarios:
+        if scenario.estimated_metrics > max_metrics:
+            results.append(ScenarioResult(
+                name=scenario.name,
+                scenario=asdict(scenario),
+                status='skipped',
+                note=f"~{scenario.estimated_metrics} metrics exceeds --max-metrics {max_metrics}"
+            ))
+            print(f"{scenario.name:<40} skipped ({results[-1].note})")
+            continue
+        
+        result = await run_scenario(scenario, seed)
+        results.append(result)
+        print(
+            f"{result.name:<40} {result.calls_per_second:>9.0f} calls/s "
+            f"{result.metrics_per_second:>10.0f} metrics/s  "
+            f"p50 {result.sync_p50_ms:>8.1f}ms  p99 {result.sync_p99_ms:>8.1f}ms  "
+            f"rss {result.peak_rss_mb:>7.1f}MB  lag p99 {result.loop_lag_p99_ms:>6.1f}ms"
+        )
+    
+    return {
+        'benchmark': 'sync_throughput',
+        'created': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'seed': seed,
+        'results': [asdict(result) for result in results],
+    }
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any],
+            threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """Per-scenario relative changes; lines for moves beyond threshold are flagged"""
+    base_results = {r['name']: r for r in baseline['results'] if r['status'] == 'ok'}
+    lines = [f"{baseline.get('commit') or 'baseline'} -> {current.get('commit') or 'current'}"]
+    
+    for result in current['results']:
+        base = base_results.get(result['name'])
+        if result['status'] != 'ok' or base is None:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = base[metric], result[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = 'REGRESSION' if worse > threshold else ('improved' if worse < -threshold else '')
+            lines.append(
+                f"{result['name']:<40} {metric:<20} {before:>12.2f} -> {after:>12.2f} "
+                f"({change:+.1%}) {flag}".rstrip()
+            )
+    return lines
+
+def _int_list(text: str) -> List[int]:
+    return [int(part) for part in text.split(',') if part]
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync throughput benchmarks against the mock vendor server")
+    parser.add_argument('--users', type=_int_list, default=[1, 100, 10_000])
+    parser.add_argument('--days', type=_int_list, default=[1, 7, 30, 365])
+    parser.add_argument('--intraday', default='on,off', help="'on', 'off' or 'on,off'")
+    parser.add_argument('--mode', default='manager', choices=('manager', 'vendor'))
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--max-metrics', type=int, default=5_000_000,
+                        help="skip scenarios predicted to sync more metrics than this")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help="compare two result files instead of running")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        lines = compare(baseline, current, args.threshold)
+        print('\n'.join(lines))
+        sys.exit(1 if any(line.endswith('REGRESSION') for line in lines) else 0)
+    
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    
+    scenarios = [
+        Scenario(users, days, intraday == 'on', args.mode, args.concurrency, args.latency_ms)
+        for users in args.users
+        for days in args.days
+        for intraday in args.intraday.split(',')
+    ]
+    report = asyncio.run(run_benchmarks(scenarios, args.max_metrics, args.seed))
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
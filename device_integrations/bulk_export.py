@@ -0,0 +1,365 @@
+"""
+Bulk NDJSON / FHIR Observation export of stored metrics
+Streams every series of every user in a shard, one day window at a time, into
+gzip-compressed NDJSON part files; shards run in parallel worker processes and a
+per-shard cursor lets an interrupted export resume where it stopped
+"""
+
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
+import numpy as np
+
+from .cohort_analytics import shard_for
+from .common.rollups import EPOCH, epoch_seconds
+
+EXPORT_FORMATS = ('fhir', 'ndjson')
+
+# metric_type -> (LOINC code, display, UCUM unit, observation category)
+FHIR_CODES: Dict[str, Tuple[str, str, str, str]] = {
+    'heart_rate': ('8867-4', 'Heart rate', '/min', 'vital-signs'),
+    'resting_heart_rate': ('40443-4', 'Heart rate --resting', '/min', 'vital-signs'),
+    'hrv_sdnn': ('80404-7', 'R-R interval.standard deviation (Heart rate variability)', 'ms', 'vital-signs'),
+    # LOINC has no RMSSD code, so it keeps the local code system with a display
+    'hrv_rmssd': (None, 'Heart rate variability RMSSD', 'ms', 'vital-signs'),
+    'respiratory_rate': ('9279-1', 'Respiratory rate', '/min', 'vital-signs'),
+    'body_temperature': ('8310-5', 'Body temperature', 'Cel', 'vital-signs'),
+    'blood_oxygen': ('59408-5', 'Oxygen saturation in Arterial blood by Pulse oximetry', '%', 'vital-signs'),
+    'steps': ('55423-8', 'Number of steps in unspecified time Pedometer', '{steps}', 'activity'),
+    'calories_burned': ('41981-2', 'Calories burned', 'kcal', 'activity'),
+    'distance_km': ('55430-3', 'Walking distance 24 hour Calculated', 'km', 'activity'),
+    'sleep_duration': ('93832-4', 'Sleep duration', 'h', 'activity'),
+}
+LOCAL_CODE_SYSTEM = 'urn:health-optimization:metric'
+UCUM_SYSTEM = 'http://unitsofmeasure.org'
+
+# Stored unit -> UCUM code for metrics without a FHIR_CODES entry; other units are
+# exported as text only, without a system or code
+UCUM_UNITS: Dict[str, str] = {
+    'bpm': '/min',
+    'breaths/min': '/min',
+    'celsius': 'Cel',
+    'count': '1',
+    'hours': 'h',
+    'kcal': 'kcal',
+    'kg': 'kg',
+    'km': 'km',
+    'minutes': 'min',
+    'ms': 'ms',
+    'percent': '%',
+    'score': '1',
+}
+QUALITY_EXTENSION = 'urn:health-optimization:quality-score'
+
+# Exporter used by forked shard workers (inherits the parent's in-memory store)
+_WORKER_EXPORTER: Optional['BulkExporter'] = None
+
+@dataclass
+class ExportCursor:
+    """Next unit of work for a shard and where its current part file stands"""
+    start: str
+    end: str
+    format: str
+    # Next series to export, by identity so users or series added since don't shift it
+    user_id: Optional[str] = None
+    metric_type: Optional[str] = None
+    source_device: Optional[str] = None
+    day: Optional[int] = None      # next day number within that series
+    part: int = 0
+    offset: int = 0                # bytes of the current part that are complete
+    part_count: int = 0            # observations in the current part
+    total: int = 0
+    files: List[str] = field(default_factory=list)
+    done: bool = False
+
+@dataclass
+class ShardExport:
+    """Outcome of exporting one shard"""
+    shard: int
+    count: int
+    files: List[str]
+    resumed: bool
+
+class _PartWriter:
+    """
+    Append-only gzip part file written as one gzip member per checkpoint, so a
+    resume can truncate to the last checkpoint and keep appending
+    """
+    
+    def __init__(self, path: str, offset: int, compresslevel: int):
+        self.path = path
+        self.compresslevel = compresslevel
+        mode = 'r+b' if offset and os.path.exists(path) else 'wb'
+        self.raw = open(path, mode)
+        self.raw.truncate(offset)
+        self.raw.seek(offset)
+        self.buffered: List[str] = []
+        self.buffered_count = 0
+    
+    def add(self, lines: List[str]):
+        self.buffered.extend(lines)
+        self.buffered_count += len(lines)
+    
+    def checkpoint(self) -> int:
+        """Compress buffered lines as a complete member; returns the durable offset"""
+        if self.buffered:
+            with gzip.GzipFile(fileobj=self.raw, mode='wb', compresslevel=self.compresslevel) as member:
+                member.write(''.join(self.buffered).encode())
+            self.buffered = []
+            self.buffered_count = 0
+        self.raw.flush()
+        return self.raw.tell()
+    
+    def close(self) -> int:
+        offset = self.checkpoint()
+        self.raw.close()
+        return offset
+
+class BulkExporter:
+    """
+    Exports a metric store as FHIR Observation or flat NDJSON bulk files
+    """
+    
+    def __init__(self, store, output_dir: str, format: str = 'fhir',
+                 shard_count: int = 8, part_size: int = 1_000_000,
+                 flush_lines: int = 100_000, compresslevel: int = 1,
+                 max_workers: int = None):
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        
+        self.store = store
+        self.output_dir = output_dir
+        self.format = format
+        self.shard_count = shard_count
+        self.part_size = part_size
+        self.flush_lines = flush_lines
+        self.compresslevel = compresslevel
+        self.max_workers = max_workers
+    
+    def _shard_dir(self, shard: int) -> str:
+        return os.path.join(self.output_dir, f"shard-{shard:03d}")
+    
+    def _part_path(self, shard: int, part: int) -> str:
+        name = 'Observation' if self.format == 'fhir' else 'metrics'
+        return os.path.join(self._shard_dir(shard), f"{name}.{part:05d}.ndjson.gz")
+    
+    def _load_cursor(self, shard: int, start: datetime, end: datetime) -> Tuple[ExportCursor, bool]:
+        path = os.path.join(self._shard_dir(shard), 'cursor.json')
+        fresh = ExportCursor(start.isoformat(), end.isoformat(), self.format)
+        if not os.path.exists(path):
+            return fresh, False
+        
+        with open(path) as f:
+            try:
+                cursor = ExportCursor(**json.load(f))
+            except TypeError:
+                # Written by an older exporter with positional cursors
+                return fresh, False
+        # A cursor from a different export can't be resumed
+        if (cursor.start, cursor.end, cursor.format) != (fresh.start, fresh.end, fresh.format):
+            return fresh, False
+        return cursor, not cursor.done
+    
+    def _save_cursor(self, shard: int, cursor: ExportCursor):
+        path = os.path.join(self._shard_dir(shard), 'cursor.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(asdict(cursor), f)
+        os.replace(path + '.tmp', path)
+    
+    def _format_lines(self, user_id: str, user_ref: str, key: Tuple[str, str, str], unit: Optional[str],
+                      timestamps_ms: np.ndarray, values: np.ndarray,
+                      quality: np.ndarray) -> List[str]:
+        _, metric_type, source_device = key
+        # Stored times are naive local time
+        times = np.datetime_as_string(timestamps_ms.astype('datetime64[ms]'), unit='ms')
+        
+        if self.format == 'ndjson':
+            prefix = (
+                f'{{"user_id":{json.dumps(user_id)},"metric_type":{json.dumps(metric_type)},'
+                f'"unit":{json.dumps(unit)},"source_device":{json.dumps(source_device)},'
+            )
+            return [
+                f'{prefix}"timestamp":"{t}","value":{v!r},"quality_score":{q!r}}}\n'
+                for t, v, q in zip(times.tolist(), values.tolist(), quality.tolist())
+            ]
+        
+        code, display, ucum, category = FHIR_CODES.get(
+            metric_type, (None, metric_type, UCUM_UNITS.get(unit), 'activity')
+        )
+        coding = (
+            f'{{"system":"http://loinc.org","code":"{code}","display":{json.dumps(display)}}}'
+            if code else
+            f'{{"system":"{LOCAL_CODE_SYSTEM}","code":{json.dumps(metric_type)},"display":{json.dumps(display)}}}'
+        )
+        id_prefix = f"{user_ref}.{metric_type.replace('_', '-')}.{source_device.replace('_', '-')}"
+        # Everything but the id, timestamp, value and quality is fixed per series
+        head = '{"resourceType":"Observation","id":"'
+        middle = (
+            '","status":"final","category":[{"coding":[{"system":'
+            '"http://terminology.hl7.org/CodeSystem/observation-category",'
+            f'"code":"{category}"}}]}}],"code":{{"coding":[{coding}],"text":{json.dumps(metric_type)}}},'
+            f'"subject":{{"reference":{json.dumps("Patient/" + user_id)}}},'
+            f'"device":{{"display":{json.dumps(source_device)}}},"effectiveDateTime":"'
+        )
+        if ucum:
+            quantity = f',"unit":{json.dumps(unit or ucum)},"system":"{UCUM_SYSTEM}","code":"{ucum}"}},'
+        elif unit:
+            quantity = f',"unit":{json.dumps(unit)}}},'
+        else:
+            quantity = '},'
+        tail = f'"extension":[{{"url":"{QUALITY_EXTENSION}","valueDecimal":'
+        
+        # FHIR dateTimes with a time need a zone: the local offset at each sample,
+        # computed once per call unless a DST change falls inside it
+        first = _utc_offset(EPOCH + timedelta(milliseconds=int(timestamps_ms[0])))
+        last = _utc_offset(EPOCH + timedelta(milliseconds=int(timestamps_ms[-1])))
+        offsets = [first] * len(times) if first == last else [
+            _utc_offset(EPOCH + timedelta(milliseconds=ms)) for ms in timestamps_ms.tolist()
+        ]
+        
+        return [
+            f'{head}{id_prefix}.{ms}{middle}{t}{z}","valueQuantity":{{"value":{v!r}{quantity}{tail}{q!r}}}]}}\n'
+            for ms, t, z, v, q in zip(timestamps_ms.tolist(), times.tolist(), offsets,
+                                      values.tolist(), quality.tolist())
+        ]
+    
+    def export_shard(self, shard: int, user_ids: List[str],
+                     start: datetime, end: datetime) -> ShardExport:
+        """Export one shard's users, resuming from its cursor when one matches"""
+        os.makedirs(self._shard_dir(shard), exist_ok=True)
+        cursor, resumed = self._load_cursor(shard, start, end)
+        if cursor.done:
+            return ShardExport(shard, cursor.total, cursor.files, resumed=False)
+        
+        users = sorted(user_ids)
+        first_day = int(epoch_seconds(start) // 86400)
+        end_day = int(-(-epoch_seconds(end) // 86400))
+        
+        writer = _PartWriter(self._part_path(shard, cursor.part), cursor.offset, self.compresslevel)
+        if self._part_path(shard, cursor.part) not in cursor.files:
+            cursor.files.append(self._part_path(shard, cursor.part))
+        
+        def checkpoint(key: Optional[Tuple[str, str, str]], day: Optional[int], rotate: bool = True):
+            nonlocal writer
+            written = writer.buffered_count
+            cursor.offset = writer.checkpoint()
+            cursor.part_count += written
+            cursor.total += written
+            cursor.user_id, cursor.metric_type, cursor.source_device = key or (None, None, None)
+            cursor.day = day
+            
+            if rotate and cursor.part_count >= self.part_size:
+                writer.close()
+                cursor.part += 1
+                cursor.offset = cursor.part_count = 0
+                writer = _PartWriter(self._part_path(shard, cursor.part), 0, self.compresslevel)
+                cursor.files.append(self._part_path(shard, cursor.part))
+            self._save_cursor(shard, cursor)
+        
+        # Series are visited in (user_id, metric_type, source_device) order; resume at the
+        # cursor's series, or the next one after it if that series is gone
+        resume_key = (cursor.user_id, cursor.metric_type, cursor.source_device) \
+            if cursor.user_id is not None else None
+        
+        for user_id in users:
+            if resume_key and user_id < resume_key[0]:
+                continue
+            user_ref = hashlib.blake2b(user_id.encode(), digest_size=6).hexdigest()
+            
+            for key in sorted(self.store.series_keys(user_id)):
+                if resume_key and key < resume_key:
+                    continue
+                unit = self.store.unit(*key)
+                resume_day = cursor.day if key == resume_key and cursor.day is not None else first_day
+                
+                for day in range(resume_day, end_day):
+                    day_start = max(EPOCH + timedelta(days=day), start)
+                    day_end = min(EPOCH + timedelta(days=day + 1), end)
+                    timestamps_ms, values, quality = self.store.read_arrays(
+                        key[0], key[1], day_start, day_end, key[2]
+                    )
+                    if len(values):
+                        writer.add(self._format_lines(
+                            user_id, user_ref, key, unit, timestamps_ms, values, quality
+                        ))
+                    if writer.buffered_count >= self.flush_lines:
+                        checkpoint(key, day + 1)
+        
+        checkpoint(None, None, rotate=False)
+        writer.close()
+        cursor.done = True
+        self._save_cursor(shard, cursor)
+        
+        logger.info(f"Exported {cursor.total} observations for shard {shard} ({len(users)} users)")
+        return ShardExport(shard, cursor.total, cursor.files, resumed)
+    
+    def export(self, user_ids: List[str], start: datetime, end: datetime) -> Dict[str, Any]:
+        """
+        Export all metrics for the users in [start, end); returns a FHIR bulk-data
+        style manifest (also written to manifest.json)
+        """
+        global _WORKER_EXPORTER
+        started = datetime.now()
+        os.makedirs(self.output_dir, exist_ok=True)
+        
+        shards: Dict[int, List[str]] = {}
+        for user_id in user_ids:
+            shards.setdefault(shard_for(user_id, self.shard_count), []).append(user_id)
+        
+        # Workers must share the in-memory store, which only fork provides
+        if len(shards) > 1 and self.max_workers != 1 and 'fork' in multiprocessing.get_all_start_methods():
+            _WORKER_EXPORTER = self
+            try:
+                with ProcessPoolExecutor(max_workers=self.max_workers,
+                                         mp_context=multiprocessing.get_context('fork')) as pool:
+                    futures = [
+                        pool.submit(_export_shard_worker, shard, shard_users, start, end)
+                        for shard, shard_users in sorted(shards.items())
+                    ]
+                    results = [future.result() for future in futures]
+            finally:
+                _WORKER_EXPORTER = None
+        else:
+            results = [
+                self.export_shard(shard, shard_users, start, end)
+                for shard, shard_users in sorted(shards.items())
+            ]
+        
+        elapsed = (datetime.now() - started).total_seconds()
+        total = sum(r.count for r in results)
+        manifest = {
+            'transactionTime': started.isoformat(),
+            'requiresAccessToken': False,
+            'output': [
+                {'type': 'Observation', 'url': os.path.relpath(path, self.output_dir), 'shard': r.shard}
+                for r in results for path in r.files
+            ],
+            'error': [],
+            'count': total,
+            'elapsed_seconds': elapsed,
+        }
+        with open(os.path.join(self.output_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        
+        logger.info(
+            f"Bulk export wrote {total} observations from {len(user_ids)} users "
+            f"in {elapsed:.1f}s ({total / max(elapsed, 1e-9) * 60:,.0f}/min)"
+        )
+        return manifest
+
+def _utc_offset(moment: datetime) -> str:
+    """ISO 8601 offset of the local zone at a naive local time, e.g. '+02:00'"""
+    minutes = int(moment.astimezone().utcoffset().total_seconds() // 60)
+    sign = '-' if minutes < 0 else '+'
+    return f"{sign}{abs(minutes) // 60:02d}:{abs(minutes) % 60:02d}"
+
+def _export_shard_worker(shard: int, user_ids: List[str],
+                         start: datetime, end: datetime) -> ShardExport:
+    return _WORKER_EXPORTER.export_shard(shard, user_ids, start, end)
@@ -0,0 +1,293 @@
+"""
+Cohort-scale analytics over stored device metrics
+Users are split into shards, each shard is reduced to mergeable partial aggregates,
+and the partials are merged into per-metric distributions, trend summaries and
+data-quality summaries
+"""
+
+import zlib
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
+import numpy as np
+
+from .common.sketches import QuantileSketch
+from .metric_fusion import RankTable, metric_rank
+
+# Percentiles reported for every distribution
+COHORT_PERCENTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+# Days scoring below this quality count against a metric's quality summary
+LOW_QUALITY_THRESHOLD = 0.7
+
+# A user's trend is rising/falling when it moves at least this fraction of their mean per week
+TREND_THRESHOLD = 0.02
+
+# Per-user input to a shard reduction: metric_type -> (day offsets, daily values, daily quality)
+UserSeries = Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+def parse_age_group(age_group: str) -> Tuple[float, float]:
+    """
+    [low, high) ages of an age group: '40-60', '<40' or '60+' as the cohort heatmap
+    sends them; anything else raises ValueError
+    """
+    text = age_group.strip()
+    try:
+        if text.startswith('<'):
+            return float('-inf'), float(text[1:])
+        if text.endswith('+'):
+            return float(text[:-1]), float('inf')
+        low, separator, high = text.partition('-')
+        if separator and low and high:
+            return float(low), float(high)
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid age group {age_group!r}: expected 'N-M', '<N' or 'N+'")
+
+@dataclass
+class CohortFilter:
+    """Cohort selection matching the cohort analytics endpoint's query parameters"""
+    age_group: str = 'all'      # '40-60', '<40' or '60+'
+    condition: str = 'all'      # e.g. 'Hypertension'
+    risk_level: str = 'all'     # 'low' | 'moderate' | 'high'
+    
+    def __post_init__(self):
+        # Parsed once so a malformed group fails here rather than per user
+        self._ages = None if self.age_group == 'all' else parse_age_group(self.age_group)
+    
+    def matches(self, attributes: Dict[str, Any]) -> bool:
+        if self._ages is not None:
+            age = attributes.get('age')
+            if age is None or not (self._ages[0] <= age < self._ages[1]):
+                return False
+        
+        if self.condition != 'all' and self.condition not in attributes.get('conditions', ()):
+            return False
+        
+        if self.risk_level != 'all' and attributes.get('risk_level') != self.risk_level:
+            return False
+        
+        return True
+
+@dataclass
+class MetricPartial:
+    """Mergeable aggregate of one metric over a set of users"""
+    users: int = 0
+    days: int = 0
+    sum: float = 0.0
+    sum_sq: float = 0.0
+    min: Optional[float] = None
+    max: Optional[float] = None
+    daily_sketch: QuantileSketch = field(default_factory=QuantileSketch)
+    user_mean_sketch: QuantileSketch = field(default_factory=QuantileSketch)
+    
+    # Per-user least-squares slopes (units per day)
+    slopes: int = 0
+    slope_sum: float = 0.0
+    slope_sum_sq: float = 0.0
+    rising: int = 0
+    falling: int = 0
+    
+    # Data quality
+    quality_sum: float = 0.0
+    low_quality_days: int = 0
+    expected_days: int = 0
+    
+    def add_user(self, day_offsets: np.ndarray, values: np.ndarray,
+                 quality: np.ndarray, expected_days: int):
+        """Fold one user's daily values into the partial"""
+        self.expected_days += expected_days
+        if not len(values):
+            return
+        
+        self.users += 1
+        self.days += len(values)
+        self.sum += float(values.sum())
+        self.sum_sq += float((values * values).sum())
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.daily_sketch.add_many(values)
+        
+        user_mean = float(values.mean())
+        self.user_mean_sketch.add(user_mean)
+        
+        self.quality_sum += float(quality.sum())
+        self.low_quality_days += int((quality < LOW_QUALITY_THRESHOLD).sum())
+        
+        if len(values) >= 3:
+            x = day_offsets - day_offsets.mean()
+            denominator = float((x * x).sum())
+            if denominator > 0:
+                slope = float((x * (values - user_mean)).sum()) / denominator
+                self.slopes += 1
+                self.slope_sum += slope
+                self.slope_sum_sq += slope * slope
+                if abs(slope * 7) >= TREND_THRESHOLD * abs(user_mean):
+                    if slope > 0:
+                        self.rising += 1
+                    else:
+                        self.falling += 1
+    
+    def merge(self, other: 'MetricPartial'):
+        self.users += other.users
+        self.days += other.days
+        self.sum += other.sum
+        self.sum_sq += other.sum_sq
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self.daily_sketch.merge(other.daily_sketch)
+        self.user_mean_sketch.merge(other.user_mean_sketch)
+        
+        self.slopes += other.slopes
+        self.slope_sum += other.slope_sum
+        self.slope_sum_sq += other.slope_sum_sq
+        self.rising += other.rising
+        self.falling += other.falling
+        
+        self.quality_sum += other.quality_sum
+        self.low_quality_days += other.low_quality_days
+        self.expected_days += other.expected_days
+    
+    def summary(self) -> Dict[str, Any]:
+        """Distribution, trend and quality summary as plain JSON-ready values"""
+        mean = self.sum / self.days if self.days else None
+        variance = self.sum_sq / self.days - mean * mean if self.days else None
+        slope_mean = self.slope_sum / self.slopes if self.slopes else None
+        slope_variance = (self.slope_sum_sq / self.slopes - slope_mean * slope_mean
+                          if self.slopes else None)
+        
+        return {
+            'users': self.users,
+            'days': self.days,
+            'distribution': {
+                'mean': mean,
+                'std': float(np.sqrt(max(variance, 0.0))) if variance is not None else None,
+                'min': self.min,
+                'max': self.max,
+                'percentiles': {
+                    f"p{int(q * 100)}": self.daily_sketch.quantile(q) for q in COHORT_PERCENTILES
+                },
+                'user_mean_percentiles': {
+                    f"p{int(q * 100)}": self.user_mean_sketch.quantile(q) for q in COHORT_PERCENTILES
+                },
+            },
+            'trend': {
+                'mean_slope_per_day': slope_mean,
+                'slope_std': (float(np.sqrt(max(slope_variance, 0.0)))
+                              if slope_variance is not None else None),
+                'rising': self.rising,
+                'falling': self.falling,
+                'flat': self.slopes - self.rising - self.falling,
+            },
+            'quality': {
+                'mean_quality': self.quality_sum / self.days if self.days else 0.0,
+                'low_quality_fraction': self.low_quality_days / self.days if self.days else 0.0,
+                'coverage': self.days / self.expected_days if self.expected_days else 0.0,
+            },
+        }
+
+@dataclass
+class CohortPartial:
+    """Per-metric partials for one shard (or a merge of shards)"""
+    users: int = 0
+    metrics: Dict[str, MetricPartial] = field(default_factory=dict)
+    
+    def merge(self, other: 'CohortPartial'):
+        self.users += other.users
+        for metric_type, partial in other.metrics.items():
+            if metric_type in self.metrics:
+                self.metrics[metric_type].merge(partial)
+            else:
+                self.metrics[metric_type] = partial
+
+def reduce_shard(shard: List[UserSeries], metric_types: List[str],
+                 expected_days: int) -> CohortPartial:
+    """Reduce one shard of users to a CohortPartial"""
+    partial = CohortPartial(metrics={m: MetricPartial() for m in metric_types})
+    empty = np.empty(0)
+    
+    for user_series in shard:
+        partial.users += 1
+        for metric_type in metric_types:
+            day_offsets, values, quality = user_series.get(metric_type, (empty, empty, empty))
+            partial.metrics[metric_type].add_user(day_offsets, values, quality, expected_days)
+    
+    return partial
+
+def shard_for(user_id: str, shard_count: int) -> int:
+    """Stable user -> shard assignment (independent of Python's hash seed)"""
+    return zlib.crc32(user_id.encode()) % shard_count
+
+class CohortAnalytics:
+    """
+    Computes cohort summaries from daily rollups in the metric store
+    """
+    
+    def __init__(self, store, rank_table: RankTable = None, shard_count: int = 32):
+        self.store = store
+        self.rank_table = rank_table or {}
+        self.shard_count = shard_count
+    
+    def _preferred_source(self, user_id: str, metric_type: str) -> Optional[str]:
+        sources = self.store.sources(user_id, metric_type)
+        if not sources:
+            return None
+        return min(sources, key=lambda d: metric_rank(self.rank_table, metric_type, d))
+    
+    def _user_series(self, user_id: str, metric_types: List[str],
+                     start: datetime, end: datetime) -> UserSeries:
+        """Daily values from the user's preferred device for each metric"""
+        series = {}
+        for metric_type in metric_types:
+            source_device = self._preferred_source(user_id, metric_type)
+            if source_device is None:
+                continue
+            
+            buckets = self.store.rollup(user_id, metric_type, start, end, 'day', source_device)
+            if not buckets:
+                continue
+            series[metric_type] = (
+                np.array([(day - start).total_seconds() / 86400 for day, _ in buckets]),
+                np.array([bucket.value(metric_type) for _, bucket in buckets], dtype=np.float64),
+                np.array([bucket.mean_quality for _, bucket in buckets], dtype=np.float64),
+            )
+        return series
+    
+    def compute(self, user_ids: List[str], metric_types: List[str],
+                start: datetime, end: datetime) -> Dict[str, Any]:
+        """
+        Summaries for each metric type across the given users over [start, end)
+        Runs in-process: the rollup reads dominate and need the store, and shipping
+        the extracted series to a process pool cost more than the reduction saves.
+        Each shard is reduced as soon as it is read, so only one shard's series is held
+        """
+        started = datetime.now()
+        expected_days = max((end - start).days, 0)
+        
+        shards: List[List[str]] = [[] for _ in range(self.shard_count)]
+        for user_id in user_ids:
+            shards[shard_for(user_id, self.shard_count)].append(user_id)
+        shards = [shard for shard in shards if shard]
+        
+        total = CohortPartial(metrics={m: MetricPartial() for m in metric_types})
+        for shard in shards:
+            total.merge(reduce_shard(
+                [self._user_series(user_id, metric_types, start, end) for user_id in shard],
+                metric_types, expected_days
+            ))
+        
+        elapsed = (datetime.now() - started).total_seconds()
+        logger.info(f"Cohort analytics for {total.users} users across {len(shards)} shards in {elapsed:.2f}s")
+        
+        return {
+            'users': total.users,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'metrics': {
+                metric_type: partial.summary() for metric_type, partial in total.metrics.items()
+            },
+            'computed_in_seconds': elapsed,
+        }
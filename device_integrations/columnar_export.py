@@ -0,0 +1,299 @@
+"""
+Columnar Parquet / Arrow IPC export and import of the metric history
+Files are hive-partitioned by user shard and month and sorted by series and time,
+so readers prune partitions and row groups from filters; imports stream record
+batches back into the metric store through its bulk array path.
+Every export run adds its own part file to each partition it touches, so a partial
+export never replaces rows written by an earlier one; readers resolve rows exported
+more than once to the newest run's copy. Vendor record IDs travel in natural_id so
+a store seeded by an import deduplicates the next sync of those records
+"""
+
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List
+from loguru import logger
+import numpy as np
+
+from .cohort_analytics import shard_for
+from .common.base_device import IngestStats
+
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
+def _require_pyarrow():
+    """pyarrow is optional; only columnar export/import needs it"""
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("pyarrow is required for columnar export (pip install pyarrow)") from e
+    return pa, ds, pq
+
+def metric_schema():
+    pa, _, _ = _require_pyarrow()
+    return pa.schema([
+        ('user_id', pa.dictionary(pa.int32(), pa.string())),
+        ('metric_type', pa.dictionary(pa.int16(), pa.string())),
+        ('source_device', pa.dictionary(pa.int16(), pa.string())),
+        ('timestamp', pa.timestamp('ms')),
+        ('value', pa.float64()),
+        ('quality', pa.float32()),
+        ('unit', pa.dictionary(pa.int16(), pa.string())),
+        ('natural_id', pa.string()),  # vendor record ID, null for timestamp-keyed rows
+    ])
+
+# Identifies a row across export runs
+ROW_KEY = ('user_id', 'metric_type', 'source_device', 'timestamp')
+
+def _month_starts(start: datetime, end: datetime) -> List[datetime]:
+    month = datetime(start.year, start.month, 1)
+    months = []
+    while month < end:
+        months.append(month)
+        month = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+    return months
+
+class ColumnarExporter:
+    """
+    Writes and reads a metric store as a shard/month partitioned columnar dataset
+    """
+    
+    def __init__(self, store, root: str, format: str = 'parquet', shard_count: int = 16,
+                 row_group_size: int = 256_000, compression: str = 'zstd'):
+        if format not in COLUMNAR_FORMATS:
+            raise ValueError(f"Unknown columnar format: {format}")
+        
+        self.store = store
+        self.root = root
+        self.format = format
+        self.shard_count = shard_count
+        self.row_group_size = row_group_size
+        self.compression = compression
+    
+    def _partition_path(self, shard: int, month: datetime, run_id: str) -> str:
+        extension = 'parquet' if self.format == 'parquet' else 'arrow'
+        return os.path.join(
+            self.root, f"shard={shard}", f"month={month:%Y-%m}", f"part-{run_id}.{extension}"
+        )
+    
+    def _shard_month_table(self, user_ids: List[str], start: datetime, end: datetime):
+        """One shard's rows for [start, end) as a table sorted by series and time"""
+        pa, _, _ = _require_pyarrow()
+        columns: Dict[str, List[Any]] = {name: [] for name in
+                                         ('user_id', 'metric_type', 'source_device',
+                                          'timestamp', 'value', 'quality', 'unit',
+                                          'natural_id')}
+        
+        for user_id in sorted(user_ids):
+            for key in sorted(self.store.series_keys(user_id)):
+                timestamps_ms, values, quality = self.store.read_arrays(
+                    user_id, key[1], start, end, key[2]
+                )
+                if not len(values):
+                    continue
+                n = len(values)
+                columns['user_id'].append(np.full(n, user_id, dtype=object))
+                columns['metric_type'].append(np.full(n, key[1], dtype=object))
+                columns['source_device'].append(np.full(n, key[2], dtype=object))
+                columns['timestamp'].append(timestamps_ms)
+                columns['value'].append(values)
+                columns['quality'].append(quality.astype(np.float32))
+                columns['unit'].append(np.full(n, self.store.unit(*key), dtype=object))
+                natural_ids = self.store.natural_ids(*key)
+                columns['natural_id'].append(
+                    np.array([natural_ids.get(ms) for ms in timestamps_ms.tolist()], dtype=object)
+                    if natural_ids else np.full(n, None, dtype=object)
+                )
+        
+        if not columns['value']:
+            return None
+        
+        schema = metric_schema()
+        arrays = []
+        for field in schema:
+            data = np.concatenate(columns[field.name])
+            if field.name == 'timestamp':
+                arrays.append(pa.array(data.astype('datetime64[ms]'), type=field.type))
+            elif pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(data, type=pa.string()).dictionary_encode()
+                              .cast(field.type))
+            else:
+                arrays.append(pa.array(data, type=field.type))
+        # Rows are already grouped by (user, metric, device) and time-sorted within each
+        return pa.Table.from_arrays(arrays, schema=schema)
+    
+    def export(self, user_ids: List[str], start: datetime, end: datetime) -> Dict[str, Any]:
+        """
+        Write one new file per (shard, month); returns the written paths and row count
+        Re-exporting rows that are already in the dataset adds them again in the new
+        run's file; read(), iter_batches() and import_into() return only the newest copy
+        """
+        pa, _, pq = _require_pyarrow()
+        started = datetime.now()
+        # Sorts part files by run; the suffix keeps concurrent runs apart
+        run_id = f"{started:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        
+        shards: Dict[int, List[str]] = {}
+        for user_id in user_ids:
+            shards.setdefault(shard_for(user_id, self.shard_count), []).append(user_id)
+        
+        files, rows = [], 0
+        for shard, shard_users in sorted(shards.items()):
+            for month in _month_starts(start, end):
+                month_end = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+                table = self._shard_month_table(shard_users, max(month, start), min(month_end, end))
+                if table is None:
+                    continue
+                
+                path = self._partition_path(shard, month, run_id)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.format == 'parquet':
+                    pq.write_table(
+                        table, path, row_group_size=self.row_group_size,
+                        compression=self.compression, write_statistics=True
+                    )
+                else:
+                    options = pa.ipc.IpcWriteOptions(compression=self.compression)
+                    with pa.ipc.new_file(path, table.schema, options=options) as writer:
+                        writer.write_table(table, max_chunksize=self.row_group_size)
+                
+                files.append(path)
+                rows += table.num_rows
+        
+        elapsed = (datetime.now() - started).total_seconds()
+        logger.info(f"Columnar export wrote {rows} rows to {len(files)} {self.format} files in {elapsed:.1f}s")
+        return {'files': files, 'rows': rows, 'elapsed_seconds': elapsed}
+    
+    def dataset(self):
+        pa, ds, _ = _require_pyarrow()
+        partition_schema = pa.schema([('shard', pa.int32()), ('month', pa.string())])
+        # An explicit schema reads files written before a column existed as nulls
+        return ds.dataset(
+            self.root, format='parquet' if self.format == 'parquet' else 'ipc',
+            schema=pa.schema(list(metric_schema()) + list(partition_schema)),
+            partitioning=ds.partitioning(partition_schema, flavor='hive')
+        )
+    
+    def filter_expression(self, user_ids: List[str] = None, metric_types: List[str] = None,
+                          start: datetime = None, end: datetime = None):
+        """
+        Filter over partition columns (shard, month) and row-group statistics
+        (user_id, metric_type, timestamp); None means no filter
+        """
+        pa, ds, _ = _require_pyarrow()
+        conditions = []
+        if user_ids is not None:
+            shards = sorted({shard_for(user_id, self.shard_count) for user_id in user_ids})
+            conditions.append(ds.field('shard').isin(shards))
+            conditions.append(ds.field('user_id').isin(list(user_ids)))
+        if metric_types is not None:
+            conditions.append(ds.field('metric_type').isin(list(metric_types)))
+        if start is not None:
+            conditions.append(ds.field('month') >= f"{start:%Y-%m}")
+            conditions.append(ds.field('timestamp') >= pa.scalar(start, type=pa.timestamp('ms')))
+        if end is not None:
+            last = end - timedelta(milliseconds=1)
+            conditions.append(ds.field('month') <= f"{last:%Y-%m}")
+            conditions.append(ds.field('timestamp') < pa.scalar(end, type=pa.timestamp('ms')))
+        
+        expression = None
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+    
+    def _partition_tables(self, expression, columns: List[str] = None) -> Iterator:
+        """
+        Matching rows one (shard, month) partition at a time, sorted by series and time
+        A row exported by several runs appears once, from the newest run's part file
+        (part file names sort by run)
+        """
+        pa, _, _ = _require_pyarrow()
+        dataset = self.dataset()
+        partitions: Dict[str, list] = {}
+        for fragment in dataset.get_fragments(filter=expression):
+            partitions.setdefault(os.path.dirname(fragment.path), []).append(fragment)
+        
+        read_columns = None if columns is None else list(dict.fromkeys(list(ROW_KEY) + list(columns)))
+        for directory in sorted(partitions):
+            fragments = sorted(partitions[directory], key=lambda fragment: fragment.path)
+            tables = [fragment.to_table(schema=dataset.schema, columns=read_columns, filter=expression)
+                      for fragment in fragments]
+            runs = np.concatenate([np.full(table.num_rows, run, dtype=np.int64)
+                                   for run, table in enumerate(tables)])
+            table = pa.concat_tables(tables)
+            if not table.num_rows:
+                continue
+            
+            # Codes sort like the strings, so one lexsort orders rows by series and
+            # time with the newest run first among copies of a row
+            keys = [np.unique(table.column(name).cast(pa.string()).to_numpy(), return_inverse=True)[1]
+                    for name in ROW_KEY[:3]]
+            keys.append(table.column('timestamp').cast(pa.int64()).to_numpy())
+            order = np.lexsort([-runs] + keys[::-1])
+            first = np.ones(len(order), dtype=bool)
+            sorted_keys = np.stack([key[order] for key in keys])
+            first[1:] = np.any(sorted_keys[:, 1:] != sorted_keys[:, :-1], axis=0)
+            
+            table = table.take(pa.array(order[first]))
+            yield table if columns is None else table.select(columns)
+    
+    def read(self, user_ids: List[str] = None, metric_types: List[str] = None,
+             start: datetime = None, end: datetime = None, columns: List[str] = None):
+        """Filtered rows as a pyarrow Table; untouched partitions and row groups are skipped"""
+        expression = self.filter_expression(user_ids, metric_types, start, end)
+        tables = list(self._partition_tables(expression, columns))
+        if not tables:
+            return self.dataset().to_table(columns=columns, filter=expression)
+        pa, _, _ = _require_pyarrow()
+        return pa.concat_tables(tables)
+    
+    def iter_batches(self, user_ids: List[str] = None, metric_types: List[str] = None,
+                     start: datetime = None, end: datetime = None,
+                     batch_size: int = 256_000) -> Iterator:
+        """Record batches of read()'s rows; one partition is held in memory at a time"""
+        expression = self.filter_expression(user_ids, metric_types, start, end)
+        for table in self._partition_tables(expression):
+            yield from table.to_batches(max_chunksize=batch_size)
+    
+    def import_into(self, store, user_ids: List[str] = None, metric_types: List[str] = None,
+                    start: datetime = None, end: datetime = None) -> IngestStats:
+        """
+        Stream matching rows into a metric store batch by batch
+        Each contiguous (user, metric, device) run becomes one bulk write
+        """
+        started = datetime.now()
+        stats = IngestStats()
+        
+        for batch in self.iter_batches(user_ids, metric_types, start, end):
+            if not batch.num_rows:
+                continue
+            
+            users = batch.column('user_id').to_numpy(zero_copy_only=False)
+            metrics = batch.column('metric_type').to_numpy(zero_copy_only=False)
+            devices = batch.column('source_device').to_numpy(zero_copy_only=False)
+            units = batch.column('unit').to_numpy(zero_copy_only=False)
+            natural_ids = batch.column('natural_id').to_numpy(zero_copy_only=False)
+            timestamps_ms = batch.column('timestamp').cast('int64').to_numpy()
+            values = batch.column('value').to_numpy()
+            quality = batch.column('quality').to_numpy().astype(np.float64)
+            
+            changes = (users[1:] != users[:-1]) | (metrics[1:] != metrics[:-1]) | \
+                      (devices[1:] != devices[:-1])
+            starts = np.r_[0, np.flatnonzero(changes) + 1]
+            ends = np.r_[starts[1:], batch.num_rows]
+            
+            for lo, hi in zip(starts.tolist(), ends.tolist()):
+                stats.merge(store.write_arrays(
+                    users[lo], metrics[lo], devices[lo],
+                    timestamps_ms[lo:hi], values[lo:hi], quality[lo:hi], units[lo],
+                    natural_ids[lo:hi]
+                ))
+        
+        elapsed = (datetime.now() - started).total_seconds()
+        logger.info(
+            f"Columnar import: {stats.inserted} inserted, {stats.updated} updated, "
+            f"{stats.unchanged} unchanged in {elapsed:.1f}s"
+        )
+        return stats
@@ -4,14 +4,23 @@ Provides common interface for all device types
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any, Tuple
+from typing import Callable, Dict, List, Optional, Any, Tuple
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
 import asyncio
+import time
 import aiohttp
 from loguru import logger
 import json
 
+from .quota import QuotaLedger, DEFAULT_APP_ID
+from .sleep_sessions import SleepSession
+from .telemetry import normalize_endpoint
+from .tracing import SyncTrace, span
+
+# Metrics per metric store write before a sync yields to the event loop
+STORE_CHUNK_SIZE = 500
+
 @dataclass
 class HealthMetric:
     """Standardized health metric data structure"""
@@ -40,6 +49,25 @@ class DeviceConnection:
     last_sync: Optional[datetime] = None
     status: str = 'active'  # 'active', 'expired', 'revoked'
 
+@dataclass
+class IngestStats:
+    """Outcome counts for a batch written to the metric store"""
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    
+    @property
+    def written(self) -> int:
+        return self.inserted + self.updated
+    
+    def record(self, outcome: str):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+    
+    def merge(self, other: 'IngestStats'):
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+
 @dataclass
 class SyncResult:
     """Result of device synchronization"""
@@ -49,6 +77,9 @@ class SyncResult:
     last_sync_time: datetime
     next_sync_time: Optional[datetime] = None
     data_quality_score: float = 1.0
+    ingest_stats: Optional[IngestStats] = None  # inserted/updated/unchanged in the store
+    timings: Optional[Dict[str, float]] = None  # seconds per traced phase, plus 'total'
+    trace: Optional[SyncTrace] = None
 
 class BaseDeviceIntegration(ABC):
     """
@@ -58,7 +89,24 @@ class BaseDeviceIntegration(ABC):
     def __init__(self, device_type: str):
         self.device_type = device_type
         self.session: Optional[aiohttp.ClientSession] = None
-        self.rate_limit_delay = 1.0  # seconds between requests
+        self._session_users = 0  # concurrent syncs sharing the session
+        self.request_interval = 1.0  # seconds between requests when not throttled
+        self.rate_limit_delay = self.request_interval
+        
+        # Shared quota accounting (attached by DeviceManager)
+        self.quota_ledger: Optional[QuotaLedger] = None
+        self.app_id = DEFAULT_APP_ID
+        
+        # Metric store and sleep-session index for synced data (attached by DeviceManager)
+        self.metric_store = None
+        self.sleep_stitcher = None
+        
+        # Prometheus-style instruments (attached by DeviceManager)
+        self.telemetry = None
+        
+        # Called with a connection whose tokens changed, so they can be persisted
+        # (attached by DeviceManager)
+        self.on_connection_changed: Optional[Callable[[DeviceConnection], None]] = None
         
         # Metric type mappings (device-specific to standardized)
         self.metric_mappings = {}
@@ -72,13 +120,19 @@ class BaseDeviceIntegration(ABC):
         }
     
     async def __aenter__(self):
-        """Async context manager entry"""
-        self.session = aiohttp.ClientSession()
+        """
+        Async context manager entry
+        Overlapping syncs on one integration share a session; the last one out closes it
+        """
+        if self._session_users == 0:
+            self.session = aiohttp.ClientSession()
+        self._session_users += 1
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit"""
-        if self.session:
+        self._session_users -= 1
+        if self._session_users == 0 and self.session:
             await self.session.close()
     
     @abstractmethod
@@ -108,14 +162,67 @@ class BaseDeviceIntegration(ABC):
         """Get real-time/recent data from device"""
         pass
     
+    def store_metrics(self, connection: DeviceConnection,
+                      metrics: List[HealthMetric]) -> IngestStats:
+        """
+        Write validated metrics to the attached metric store, if any
+        Re-synced records are deduplicated by the store
+        """
+        if self.metric_store is None:
+            return IngestStats()
+        with span('store_write', metrics=len(metrics)):
+            stats = self.metric_store.write(connection.user_id, metrics)
+        
+        if self.telemetry:
+            counts: Dict[str, int] = {}
+            for metric in metrics:
+                counts[metric.metric_type] = counts.get(metric.metric_type, 0) + 1
+            self.telemetry.observe_ingest(self.device_type, counts, stats)
+        return stats
+    
+    async def ingest_metrics(self, connection: DeviceConnection,
+                             metrics: List[HealthMetric]) -> IngestStats:
+        """
+        store_metrics() for a sync's whole batch, in chunks that yield to the event loop
+        between them so large intraday batches don't stall other syncs
+        """
+        stats = IngestStats()
+        for i in range(0, len(metrics), STORE_CHUNK_SIZE):
+            if i:
+                await asyncio.sleep(0)
+            stats.merge(self.store_metrics(connection, metrics[i:i + STORE_CHUNK_SIZE]))
+        return stats
+    
+    def store_metric_arrays(self, connection: DeviceConnection, metric_type: str,
+                            timestamps_ms, values, quality, unit: str) -> IngestStats:
+        """Bulk-write one series to the attached metric store, if any"""
+        if self.metric_store is None:
+            return IngestStats()
+        with span('store_write', metric_type=metric_type, metrics=len(values)):
+            stats = self.metric_store.write_arrays(
+                connection.user_id, metric_type, self.device_type,
+                timestamps_ms, values, quality, unit
+            )
+        
+        if self.telemetry:
+            self.telemetry.observe_ingest(self.device_type, {metric_type: len(values)}, stats)
+        return stats
+    
+    def record_sleep_session(self, session: SleepSession):
+        """Hand a sleep interval to the cross-device stitcher, if attached"""
+        if self.sleep_stitcher is not None:
+            self.sleep_stitcher.add(session)
+    
     def standardize_metric_type(self, device_metric: str) -> str:
         """Convert device-specific metric name to standardized type"""
         return self.metric_mappings.get(device_metric, device_metric)
     
     def calculate_quality_score(self, metrics: List[HealthMetric], 
-                               expected_count: int = None) -> float:
+                               expected_count: int = None,
+                               user_id: str = None) -> float:
         """
         Calculate data quality score based on multiple factors
+        Freshness and consistency use the user's stored baselines when available
         """
         if not metrics:
             return 0.0
@@ -136,9 +243,29 @@ class BaseDeviceIntegration(ABC):
         ) / len(metrics)
         scores['freshness'] = max(0, 1 - (avg_age_hours / 24))  # Decay over 24 hours
         
-        # Consistency score (variance in data)
+        baselines = getattr(self.metric_store, 'baselines', None)
+        if baselines is not None and user_id:
+            # Relative to each series' own cadence, so daily summaries aren't penalized
+            freshness = [
+                baselines.freshness(user_id, metric_type, source_device, now)
+                for metric_type, source_device in {(m.metric_type, m.source_device) for m in metrics}
+            ]
+            freshness = [f for f in freshness if f is not None]
+            if freshness:
+                scores['freshness'] = sum(freshness) / len(freshness)
+        
+        # Consistency score (deviation from the user's baseline, else variance in data)
         values = [m.value for m in metrics if m.value is not None]
-        if len(values) > 1:
+        z_scores = [
+            abs(m.metadata['baseline_z']) for m in metrics
+            if m.metadata and 'baseline_z' in m.metadata
+        ]
+        if z_scores:
+            # Within 1 sigma is fully consistent; 4 sigma or more scores zero
+            scores['consistency'] = sum(
+                1 - min(max(z - 1, 0) / 3, 1) for z in z_scores
+            ) / len(z_scores)
+        elif len(values) > 1:
             mean_val = sum(values) / len(values)
             variance = sum((v - mean_val) ** 2 for v in values) / len(values)
             cv = (variance ** 0.5) / mean_val if mean_val > 0 else 0
@@ -212,44 +339,108 @@ class BaseDeviceIntegration(ABC):
                 wait_time = self.rate_limit_delay * 2  # Exponential backoff
             
             logger.warning(f"Rate limited by {self.device_type} API. Waiting {wait_time}s")
-            await asyncio.sleep(wait_time)
+            with span('rate_limit_wait', reason='throttled'):
+                await asyncio.sleep(wait_time)
+            if self.telemetry:
+                self.telemetry.observe_rate_limit_wait(self.device_type, 'throttled', wait_time)
             self.rate_limit_delay = min(wait_time * 2, 60)  # Cap at 60 seconds
             return True
         
         # Reset rate limit delay on successful request
         if response.status == 200:
-            self.rate_limit_delay = 1.0
+            self.rate_limit_delay = self.request_interval
         
         return False
     
+    async def pace(self):
+        """Wait out the current request spacing before the next vendor call"""
+        delay = self.rate_limit_delay
+        with span('rate_limit_wait', reason='pacing'):
+            await asyncio.sleep(delay)
+        if self.telemetry:
+            self.telemetry.observe_rate_limit_wait(self.device_type, 'pacing', delay)
+    
     async def make_authenticated_request(self, connection: DeviceConnection,
                                        method: str, url: str, 
                                        **kwargs) -> aiohttp.ClientResponse:
         """
         Make authenticated request with automatic token refresh
+        The body is read before the connection is released, so callers can still
+        parse it after this returns
         """
         headers = kwargs.get('headers', {})
         headers['Authorization'] = f'Bearer {connection.access_token}'
         kwargs['headers'] = headers
         
-        async with self.session.request(method, url, **kwargs) as response:
-            # Handle token expiration
-            if response.status == 401:
-                logger.info(f"Token expired for {self.device_type}, refreshing...")
-                connection = await self.refresh_token(connection)
-                headers['Authorization'] = f'Bearer {connection.access_token}'
-                
-                # Retry with new token
-                async with self.session.request(method, url, **kwargs) as retry_response:
-                    return retry_response
-            
-            # Handle rate limiting
-            if await self.handle_rate_limiting(response):
-                # Retry after rate limit delay
-                async with self.session.request(method, url, **kwargs) as retry_response:
-                    return retry_response
+        response = await self._send(connection, method, url, **kwargs)
+        
+        # Handle token expiration
+        if response.status == 401:
+            logger.info(f"Token expired for {self.device_type}, refreshing...")
+            try:
+                with span('token_refresh'):
+                    connection = await self.refresh_token(connection)
+            except Exception:
+                if self.telemetry:
+                    self.telemetry.token_refreshed(self.device_type, False)
+                raise
+            if self.telemetry:
+                self.telemetry.token_refreshed(self.device_type, True)
+            # Vendors rotate refresh tokens; losing the new one forces a re-authorization
+            if self.on_connection_changed:
+                self.on_connection_changed(connection)
+            headers['Authorization'] = f'Bearer {connection.access_token}'
             
-            return response
+            # Retry with new token
+            return await self._send(connection, method, url, **kwargs)
+        
+        # Handle rate limiting
+        if await self.handle_rate_limiting(response):
+            # Retry after rate limit delay
+            return await self._send(connection, method, url, **kwargs)
+        
+        return response
+    
+    async def _send(self, connection: DeviceConnection, method: str, url: str,
+                    **kwargs) -> aiohttp.ClientResponse:
+        """One vendor call with its body read, accounted against quota and telemetry"""
+        with span('http') as request_span:
+            started = time.perf_counter()
+            async with self.session.request(method, url, **kwargs) as response:
+                body = await response.read()
+            elapsed = time.perf_counter() - started
+            if request_span is not None:
+                request_span.attributes.update(
+                    endpoint=normalize_endpoint(url), status=response.status, bytes=len(body)
+                )
+        
+        self._record_quota_call(connection, response)
+        if self.telemetry:
+            self.telemetry.observe_request(self.device_type, url, response.status, elapsed)
+        return response
+    
+    async def read_json(self, response: aiohttp.ClientResponse) -> Any:
+        """Decode a response body that make_authenticated_request already read"""
+        with span('json_decode'):
+            return await response.json()
+    
+    def _record_quota_call(self, connection: DeviceConnection,
+                           response: aiohttp.ClientResponse):
+        """Account a vendor call (and any back-off request) against the quota ledger"""
+        if not self.quota_ledger:
+            return
+        
+        self.quota_ledger.record_call(
+            self.device_type, connection.user_id, self.app_id, status=response.status
+        )
+        
+        if response.status == 429:
+            retry_after = response.headers.get('Retry-After')
+            self.quota_ledger.record_throttle(
+                self.device_type, connection.user_id,
+                float(retry_after) if retry_after else self.rate_limit_delay * 2,
+                self.app_id
+            )
     
     def normalize_timestamp(self, timestamp_str: str, timezone: str = None) -> datetime:
         """
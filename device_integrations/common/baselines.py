@@ -0,0 +1,193 @@
+"""
+Per-user rolling baselines and streaming anomaly detection
+Each (user, metric_type, source_device) keeps a time-decayed EWMA of its mean,
+variance and sampling interval, updated in O(1) per ingested sample; samples far
+from the user's own baseline are flagged as they arrive. Devices are kept apart
+because they measure differently and at different cadences (a daily resting
+value and minute-level samples must not share a mean or an interval)
+"""
+
+import math
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from .rollups import epoch_seconds
+
+# Baselines need this many samples before deviations are flagged
+MIN_BASELINE_SAMPLES = 7
+
+# Weight of a sample halves after this long
+DEFAULT_HALF_LIFE = timedelta(days=14)
+
+# metric_type -> (direction that is clinically concerning, z-score threshold)
+ANOMALY_RULES: Dict[str, Tuple[str, float]] = {
+    'hrv_rmssd': ('low', 2.0),
+    'resting_heart_rate': ('high', 2.0),
+    'sleep_duration': ('low', 2.0),
+    'sleep_efficiency': ('low', 2.0),
+    'readiness_score': ('low', 2.0),
+    'body_temperature': ('both', 2.0),
+    'blood_oxygen': ('low', 2.5),
+}
+DEFAULT_RULE = ('both', 3.0)
+
+# Anomalies kept per user for alerting
+MAX_ANOMALIES_PER_USER = 100
+
+@dataclass
+class Baseline:
+    """Exponentially weighted mean/variance of one user's metric from one device"""
+    mean: float = 0.0
+    variance: float = 0.0
+    count: int = 0
+    last_seconds: Optional[float] = None
+    interval: Optional[float] = None  # EWMA of seconds between samples
+    
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.variance)
+    
+    def z_score(self, value: float) -> Optional[float]:
+        if self.count < MIN_BASELINE_SAMPLES or self.variance <= 0:
+            return None
+        return (value - self.mean) / self.std
+    
+    def update(self, value: float, seconds: float, half_life: float):
+        """Fold one sample in; weight decays with elapsed time, not sample count"""
+        elapsed = 0.0
+        if self.last_seconds is not None:
+            elapsed = max(seconds - self.last_seconds, 0.0)
+        
+        # Plain cumulative averaging until the baseline has warmed up
+        alpha = max(1 - 0.5 ** (elapsed / half_life), 1 / (self.count + 1))
+        delta = value - self.mean
+        increment = alpha * delta
+        self.mean += increment
+        self.variance = (1 - alpha) * (self.variance + delta * increment)
+        
+        if self.last_seconds is not None and elapsed > 0:
+            self.interval = elapsed if self.interval is None else (
+                self.interval + alpha * (elapsed - self.interval)
+            )
+        self.count += 1
+        self.last_seconds = seconds if self.last_seconds is None else max(self.last_seconds, seconds)
+
+@dataclass
+class Anomaly:
+    """A sample that deviates from the user's baseline"""
+    user_id: str
+    metric_type: str
+    source_device: str
+    timestamp: datetime
+    value: float
+    baseline_mean: float
+    baseline_std: float
+    z_score: float
+    direction: str  # 'low' | 'high'
+
+class BaselineTracker:
+    """
+    Streaming baselines for every (user, metric_type, source_device) seen at ingest
+    """
+    
+    def __init__(self, half_life: timedelta = DEFAULT_HALF_LIFE,
+                 rules: Dict[str, Tuple[str, float]] = None):
+        self.half_life = half_life.total_seconds()
+        self.rules = rules or ANOMALY_RULES
+        self.baselines: Dict[Tuple[str, str, str], Baseline] = {}
+        self.anomalies: Dict[str, Deque[Anomaly]] = {}
+    
+    def observe(self, user_id: str, metric) -> Optional[Anomaly]:
+        """
+        Score a newly ingested HealthMetric against the baseline, then update it
+        The z-score is written to metric.metadata['baseline_z'] once the baseline is warm
+        """
+        key = (user_id, metric.metric_type, metric.source_device)
+        baseline = self.baselines.get(key)
+        if baseline is None:
+            baseline = self.baselines[key] = Baseline()
+        
+        anomaly = None
+        z = baseline.z_score(metric.value)
+        if z is not None:
+            # Copied so metrics built from one shared metadata dict don't overwrite each other
+            metric.metadata = {**(metric.metadata or {}), 'baseline_z': round(z, 3)}
+            
+            direction, threshold = self.rules.get(metric.metric_type, DEFAULT_RULE)
+            if (z <= -threshold and direction in ('low', 'both')) or \
+               (z >= threshold and direction in ('high', 'both')):
+                anomaly = Anomaly(
+                    user_id=user_id,
+                    metric_type=metric.metric_type,
+                    source_device=metric.source_device,
+                    timestamp=metric.timestamp,
+                    value=metric.value,
+                    baseline_mean=baseline.mean,
+                    baseline_std=baseline.std,
+                    z_score=z,
+                    direction='low' if z < 0 else 'high'
+                )
+                metric.metadata['baseline_anomaly'] = anomaly.direction
+                self.anomalies.setdefault(
+                    user_id, deque(maxlen=MAX_ANOMALIES_PER_USER)
+                ).append(anomaly)
+        
+        baseline.update(metric.value, epoch_seconds(metric.timestamp), self.half_life)
+        return anomaly
+    
+    def update_many(self, user_id: str, metric_type: str, source_device: str,
+                    seconds: List[float], values: List[float]):
+        """Advance a baseline over historical samples without flagging them"""
+        key = (user_id, metric_type, source_device)
+        baseline = self.baselines.get(key)
+        if baseline is None:
+            baseline = self.baselines[key] = Baseline()
+        for timestamp, value in zip(seconds, values):
+            baseline.update(value, timestamp, self.half_life)
+    
+    def baseline(self, user_id: str, metric_type: str, source_device: str) -> Optional[Baseline]:
+        return self.baselines.get((user_id, metric_type, source_device))
+    
+    def freshness(self, user_id: str, metric_type: str, source_device: str,
+                  now: datetime = None) -> Optional[float]:
+        """
+        1.0 while the latest sample is within the series' usual interval, decaying
+        to 0 over three further intervals; None before a cadence is known
+        """
+        baseline = self.baselines.get((user_id, metric_type, source_device))
+        if baseline is None or not baseline.interval:
+            return None
+        
+        age = epoch_seconds(now or datetime.now()) - baseline.last_seconds
+        overdue = max(age - baseline.interval, 0.0)
+        return max(0.0, 1 - overdue / (3 * baseline.interval))
+    
+    def restore_anomalies(self, user_id: str, anomalies: List[Anomaly]):
+        """Re-attach anomalies flagged elsewhere (e.g. before a user moved between workers)"""
+        self.anomalies.setdefault(user_id, deque(maxlen=MAX_ANOMALIES_PER_USER)).extend(anomalies)
+    
+    def drop_users(self, user_ids: Set[str]):
+        """Forget the baselines and anomalies of the given users"""
+        self.baselines = {key: baseline for key, baseline in self.baselines.items()
+                          if key[0] not in user_ids}
+        for user_id in user_ids:
+            self.anomalies.pop(user_id, None)
+    
+    def recent_anomalies(self, user_id: str, since: datetime = None,
+                         metric_type: str = None) -> List[Anomaly]:
+        return [
+            a for a in self.anomalies.get(user_id, ())
+            if (since is None or a.timestamp >= since)
+            and (metric_type is None or a.metric_type == metric_type)
+        ]
+    
+    def flagged_users(self, user_ids: List[str], metric_type: str, direction: str,
+                      since: datetime = None) -> List[str]:
+        """Users with a recent anomaly of the given metric and direction ('both' matches either)"""
+        return [
+            user_id for user_id in user_ids
+            if any(direction in ('both', a.direction)
+                   for a in self.recent_anomalies(user_id, since, metric_type))
+        ]
@@ -0,0 +1,267 @@
+"""
+Compressed time-series chunk encoding for the metric store
+Timestamps use delta-of-delta encoding; values use fixed-point deltas when they
+have few decimals (heart rate, steps) and Gorilla-style XOR encoding otherwise
+"""
+
+import struct
+from dataclasses import dataclass
+from datetime import date
+from typing import Tuple
+
+import numpy as np
+
+CHUNK_MAGIC = b'HMC1'
+MAX_DECIMALS = 3
+
+# Value column encodings
+ENCODING_FIXED = 0
+ENCODING_XOR = 1
+
+# (prefix bits, prefix length, payload bits) from smallest to largest bucket
+TIMESTAMP_BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12)]
+DELTA_BUCKETS = [(0b10, 2, 4), (0b110, 3, 8), (0b1110, 4, 16)]
+
+@dataclass
+class Chunk:
+    """Encoded samples for one (user, metric_type, source_device, day)"""
+    user_id: str
+    metric_type: str
+    source_device: str
+    day: date
+    unit: str
+    count: int
+    payload: bytes
+    sketch: bytes = b''  # serialized QuantileSketch of the day's values
+    
+    @property
+    def nbytes(self) -> int:
+        return len(self.payload)
+    
+    @property
+    def bytes_per_sample(self) -> float:
+        return self.nbytes / self.count if self.count else 0.0
+
+class BitWriter:
+    """Appends variable-width bit fields to a byte buffer"""
+    
+    def __init__(self):
+        self.buffer = bytearray()
+        self._acc = 0
+        self._bits = 0
+    
+    def write(self, value: int, nbits: int):
+        self._acc = (self._acc << nbits) | (value & ((1 << nbits) - 1))
+        self._bits += nbits
+        while self._bits >= 8:
+            self._bits -= 8
+            self.buffer.append((self._acc >> self._bits) & 0xFF)
+        self._acc &= (1 << self._bits) - 1
+    
+    def getvalue(self) -> bytes:
+        if self._bits:
+            return bytes(self.buffer) + bytes([(self._acc << (8 - self._bits)) & 0xFF])
+        return bytes(self.buffer)
+
+class BitReader:
+    """Reads variable-width bit fields written by BitWriter"""
+    
+    def __init__(self, data: bytes, offset: int = 0):
+        self.data = data
+        self.position = offset * 8
+    
+    def read(self, nbits: int) -> int:
+        value = 0
+        while nbits:
+            byte = self.data[self.position >> 3]
+            available = 8 - (self.position & 7)
+            take = min(available, nbits)
+            shift = available - take
+            value = (value << take) | ((byte >> shift) & ((1 << take) - 1))
+            self.position += take
+            nbits -= take
+        return value
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+def _write_bucketed(writer: BitWriter, value: int, buckets):
+    """Write a signed integer with a short prefix selecting its bit width"""
+    if value == 0:
+        writer.write(0, 1)
+        return
+    
+    encoded = _zigzag(value)
+    for prefix, prefix_len, payload_bits in buckets:
+        if encoded < (1 << payload_bits):
+            writer.write(prefix, prefix_len)
+            writer.write(encoded, payload_bits)
+            return
+    
+    writer.write(0b1111, 4)
+    writer.write(encoded, 64)
+
+def _read_bucketed(reader: BitReader, buckets) -> int:
+    # The prefix is a run of '1' bits (at most four) selecting the bucket
+    ones = 0
+    while ones < 4 and reader.read(1) == 1:
+        ones += 1
+    
+    if ones == 0:
+        return 0
+    if ones == 4:
+        return _unzigzag(reader.read(64))
+    return _unzigzag(reader.read(buckets[ones - 1][2]))
+
+def _fixed_point_decimals(values: np.ndarray) -> int:
+    """Smallest number of decimals that represents every value exactly, or -1"""
+    if not np.all(np.isfinite(values)):
+        return -1
+    
+    for decimals in range(MAX_DECIMALS + 1):
+        scaled = values * (10 ** decimals)
+        if not np.all(np.abs(scaled) < 2 ** 52):
+            return -1
+        # Must round-trip bit for bit, as the decoder computes it; near misses go to XOR
+        if np.array_equal(np.round(scaled) / (10 ** decimals), values):
+            return decimals
+    return -1
+
+def _float_bits(value: float) -> int:
+    return struct.unpack('>Q', struct.pack('>d', value))[0]
+
+def _bits_float(bits: int) -> float:
+    return struct.unpack('>d', struct.pack('>Q', bits))[0]
+
+def _write_xor(writer: BitWriter, values: np.ndarray):
+    """Gorilla XOR encoding of a float column"""
+    previous = _float_bits(float(values[0]))
+    writer.write(previous, 64)
+    prev_leading, prev_trailing = -1, -1
+    
+    for value in values[1:]:
+        bits = _float_bits(float(value))
+        xor = bits ^ previous
+        previous = bits
+        
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        
+        leading = min(64 - xor.bit_length(), 31)
+        trailing = (xor & -xor).bit_length() - 1
+        
+        if prev_leading >= 0 and leading >= prev_leading and trailing >= prev_trailing:
+            # Meaningful bits fit in the previous window
+            writer.write(0b10, 2)
+            writer.write(xor >> prev_trailing, 64 - prev_leading - prev_trailing)
+        else:
+            significant = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(significant - 1, 6)
+            writer.write(xor >> trailing, significant)
+            prev_leading, prev_trailing = leading, trailing
+
+def _read_xor(reader: BitReader, count: int) -> np.ndarray:
+    values = np.empty(count, dtype=np.float64)
+    previous = reader.read(64)
+    values[0] = _bits_float(previous)
+    leading, trailing = 0, 0
+    
+    for i in range(1, count):
+        if reader.read(1) == 0:
+            values[i] = values[i - 1]
+            continue
+        
+        if reader.read(1) == 1:
+            leading = reader.read(5)
+            significant = reader.read(6) + 1
+            trailing = 64 - leading - significant
+        
+        xor = reader.read(64 - leading - trailing) << trailing
+        previous ^= xor
+        values[i] = _bits_float(previous)
+    
+    return values
+
+def encode_arrays(timestamps_ms: np.ndarray, values: np.ndarray,
+                  quality: np.ndarray = None) -> bytes:
+    """
+    Encode time-sorted samples into a compressed payload
+    timestamps_ms: int64 epoch milliseconds, values: float64, quality: 0-1 scores
+    """
+    timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    quality = (np.ones(len(values)) if quality is None
+               else np.asarray(quality, dtype=np.float64))
+    count = len(timestamps_ms)
+    
+    if count == 0:
+        return CHUNK_MAGIC + struct.pack('<IqBb', 0, 0, ENCODING_FIXED, 0)
+    if np.any(np.diff(timestamps_ms) < 0):
+        raise ValueError("Chunk timestamps must be sorted")
+    
+    decimals = _fixed_point_decimals(values)
+    encoding = ENCODING_FIXED if decimals >= 0 else ENCODING_XOR
+    header = CHUNK_MAGIC + struct.pack(
+        '<IqBb', count, int(timestamps_ms[0]), encoding, max(decimals, 0)
+    )
+    
+    writer = BitWriter()
+    
+    # Timestamps: delta-of-delta, so regular sampling costs one bit per sample
+    previous_delta = 0
+    for i in range(1, count):
+        delta = int(timestamps_ms[i] - timestamps_ms[i - 1])
+        _write_bucketed(writer, delta - previous_delta, TIMESTAMP_BUCKETS)
+        previous_delta = delta
+    
+    # Values
+    if encoding == ENCODING_FIXED:
+        scaled = np.round(values * (10 ** decimals)).astype(np.int64)
+        writer.write(_zigzag(int(scaled[0])), 64)
+        for delta in np.diff(scaled).tolist():
+            _write_bucketed(writer, delta, DELTA_BUCKETS)
+    else:
+        _write_xor(writer, values)
+    
+    # Quality scores are nearly always constant within a chunk
+    _write_xor(writer, quality)
+    
+    return header + writer.getvalue()
+
+def decode_arrays(payload: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Decode a payload into (timestamps_ms int64, values float64, quality float64) arrays"""
+    if payload[:4] != CHUNK_MAGIC:
+        raise ValueError("Not a metric chunk")
+    
+    count, first_timestamp, encoding, decimals = struct.unpack_from('<IqBb', payload, 4)
+    if count == 0:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+                np.empty(0, dtype=np.float64))
+    
+    reader = BitReader(payload, 4 + struct.calcsize('<IqBb'))
+    
+    deltas = np.empty(count, dtype=np.int64)
+    deltas[0] = first_timestamp
+    delta = 0
+    for i in range(1, count):
+        delta += _read_bucketed(reader, TIMESTAMP_BUCKETS)
+        deltas[i] = delta
+    timestamps = np.cumsum(deltas)
+    
+    if encoding == ENCODING_FIXED:
+        scaled = np.empty(count, dtype=np.int64)
+        scaled[0] = _unzigzag(reader.read(64))
+        for i in range(1, count):
+            scaled[i] = _read_bucketed(reader, DELTA_BUCKETS)
+        values = np.cumsum(scaled) / (10 ** decimals)
+    else:
+        values = _read_xor(reader, count)
+    
+    quality = _read_xor(reader, count)
+    return timestamps, values, quality
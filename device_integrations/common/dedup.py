@@ -0,0 +1,118 @@
+"""
+Idempotent ingest support for re-synced metrics
+Records are identified by natural keys (vendor IDs or date + family) and compared
+by content hash, so overlapping sync windows don't duplicate data and vendor
+revisions replace the values they supersede.
+Only vendor-ID records are indexed here; a timestamp-keyed record's identity is its
+position in the stored series, so the store resolves those against its own data
+"""
+
+import hashlib
+from datetime import datetime
+from typing import Dict, Optional, Set, Tuple
+
+from .base_device import HealthMetric, IngestStats
+
+INSERTED = 'inserted'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+
+def has_vendor_id(metric: HealthMetric) -> bool:
+    return (metric.metadata or {}).get('natural_id') is not None
+
+def natural_key(metric: HealthMetric) -> str:
+    """
+    Stable identity of a record across re-syncs
+    Integrations set metadata['natural_id'] when the vendor has one (e.g. Oura sleep_id);
+    otherwise the timestamp identifies it, which for daily summaries is the date
+    """
+    natural_id = (metric.metadata or {}).get('natural_id')
+    if natural_id is None:
+        natural_id = metric.timestamp.isoformat()
+    return f"{metric.source_device}:{metric.metric_type}:{natural_id}"
+
+def _digest(value: float, unit: str, timestamp: datetime) -> bytes:
+    # float() so 8000 and 8000.0 (e.g. after a columnar round trip) hash alike
+    content = f"{float(value)!r}|{unit}|{timestamp.isoformat()}"
+    return hashlib.blake2b(content.encode(), digest_size=8).digest()
+
+def content_hash(metric: HealthMetric) -> bytes:
+    """Digest of the fields a vendor revision can change"""
+    return _digest(metric.value, metric.unit, metric.timestamp)
+
+class DedupIndex:
+    """
+    Natural key -> (content hash, stored location) for records with a vendor ID
+    Intraday samples are timestamp-keyed and never enter the index, so it grows with
+    sessions and daily records rather than with every stored sample
+    """
+    
+    def __init__(self):
+        # user_id -> natural key -> (content hash, epoch seconds, value)
+        self.entries: Dict[str, Dict[str, Tuple[bytes, float, float]]] = {}
+    
+    def classify(self, user_id: str, metric: HealthMetric,
+                 stored: Tuple[float, float, Optional[str]] = None
+                 ) -> Tuple[str, Optional[Tuple[float, float]]]:
+        """
+        Outcome for an incoming record and, for updates, the (seconds, value)
+        of the stored record it replaces
+        For records without a vendor ID, `stored` is the (seconds, value, unit) the
+        store holds at the record's timestamp in its series, or None
+        """
+        if has_vendor_id(metric):
+            entry = self.entries.get(user_id, {}).get(natural_key(metric))
+        elif stored is not None:
+            seconds, value, unit = stored
+            entry = (_digest(value, unit, metric.timestamp), seconds, value)
+        else:
+            entry = None
+        
+        if entry is None:
+            return INSERTED, None
+        if entry[0] == content_hash(metric):
+            return UNCHANGED, None
+        return UPDATED, (entry[1], entry[2])
+    
+    def remember(self, user_id: str, metric: HealthMetric, seconds: float):
+        if has_vendor_id(metric):
+            self.entries.setdefault(user_id, {})[natural_key(metric)] = (
+                content_hash(metric), seconds, metric.value
+            )
+    
+    def adopt(self, user_id: str, metric: HealthMetric,
+              stored: Optional[Tuple[float, float, Optional[str]]]):
+        """
+        Index a record already stored at the metric's timestamp, (seconds, value, unit),
+        under the metric's natural key unless that key is indexed, e.g. when a bulk
+        import names the vendor ID of a sample the store already holds
+        """
+        if stored is None or not has_vendor_id(metric):
+            return
+        seconds, value, unit = stored
+        self.entries.setdefault(user_id, {}).setdefault(
+            natural_key(metric), (_digest(value, unit, metric.timestamp), seconds, value)
+        )
+    
+    def natural_ids(self, user_id: str, metric_type: str, source_device: str) -> Dict[int, str]:
+        """Vendor IDs of a series' indexed records by timestamp in epoch milliseconds"""
+        prefix = f"{source_device}:{metric_type}:"
+        return {
+            int(round(entry[1] * 1000)): key[len(prefix):]
+            for key, entry in self.entries.get(user_id, {}).items() if key.startswith(prefix)
+        }
+    
+    def user_entries(self, user_id: str) -> Dict[str, Tuple[bytes, float, float]]:
+        """A user's entries by natural key, e.g. to hand them to another worker"""
+        return dict(self.entries.get(user_id, {}))
+    
+    def restore(self, user_id: str, entries: Dict[str, Tuple[bytes, float, float]]):
+        """Re-register entries taken from user_entries (e.g. on another worker)"""
+        self.entries.setdefault(user_id, {}).update(entries)
+    
+    def drop_users(self, user_ids: Set[str]):
+        for user_id in user_ids:
+            self.entries.pop(user_id, None)
+    
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self.entries.values())
@@ -0,0 +1,564 @@
+"""
+Metric store for synchronized device data
+Keeps raw samples per (user, metric_type, source_device) with rollups maintained alongside;
+completed days can be compacted into compressed chunks
+"""
+
+import bisect
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+from loguru import logger
+import numpy as np
+
+from .base_device import HealthMetric
+from .chunk_codec import Chunk, encode_arrays, decode_arrays
+from .dedup import DedupIndex, IngestStats, INSERTED, UPDATED, has_vendor_id
+from .baselines import BaselineTracker
+from .rollups import RollupEngine, RollupBucket, EPOCH, epoch_seconds
+from .sketches import QuantileSketch
+
+SECONDS_PER_DAY = 86400
+
+# (user_id, metric_type, source_device)
+SeriesKey = Tuple[str, str, str]
+
+class MetricSeries:
+    """Time-ordered raw samples for one (user, metric_type, source_device)"""
+    
+    def __init__(self):
+        self.timestamps: List[float] = []  # epoch seconds, sorted
+        self.metrics: List[HealthMetric] = []
+        self.unit: Optional[str] = None
+        
+        # Compacted days: day start (epoch seconds) -> encoded chunk
+        self.chunks: Dict[int, Chunk] = {}
+        
+        # Last chunk decoded by find(), keyed by its payload object
+        self._decoded: Optional[Tuple[bytes, Tuple[np.ndarray, np.ndarray, np.ndarray]]] = None
+    
+    def __len__(self) -> int:
+        return len(self.timestamps) + sum(chunk.count for chunk in self.chunks.values())
+    
+    def insert(self, seconds: float, metric: HealthMetric):
+        # Vendors return data in time order, so appends are the common case
+        if not self.timestamps or seconds >= self.timestamps[-1]:
+            self.timestamps.append(seconds)
+            self.metrics.append(metric)
+        else:
+            index = bisect.bisect_right(self.timestamps, seconds)
+            self.timestamps.insert(index, seconds)
+            self.metrics.insert(index, metric)
+        self.unit = metric.unit
+    
+    def remove(self, seconds: float, value: float) -> bool:
+        """Remove one stored sample (raw or compacted) matching timestamp and value"""
+        lo = bisect.bisect_left(self.timestamps, seconds)
+        hi = bisect.bisect_right(self.timestamps, seconds)
+        for index in range(lo, hi):
+            if self.metrics[index].value == value:
+                del self.timestamps[index]
+                del self.metrics[index]
+                return True
+        
+        day_start = int(seconds // SECONDS_PER_DAY) * SECONDS_PER_DAY
+        chunk = self.chunks.get(day_start)
+        if chunk is None:
+            return False
+        
+        timestamps, values, quality = decode_arrays(chunk.payload)
+        matches = np.flatnonzero(
+            (timestamps == int(round(seconds * 1000))) & (values == value)
+        )
+        if not len(matches):
+            return False
+        
+        keep = np.ones(len(timestamps), dtype=bool)
+        keep[matches[0]] = False
+        if keep.any():
+            chunk.payload = encode_arrays(timestamps[keep], values[keep], quality[keep])
+            chunk.count = int(keep.sum())
+        else:
+            del self.chunks[day_start]
+        return True
+    
+    def find(self, seconds: float) -> Optional[Tuple[float, float, Optional[str]]]:
+        """(seconds, value, unit) of the stored sample at exactly this timestamp, if any"""
+        index = bisect.bisect_left(self.timestamps, seconds)
+        if index < len(self.timestamps) and self.timestamps[index] == seconds:
+            metric = self.metrics[index]
+            return seconds, metric.value, metric.unit
+        
+        chunk = self.chunks.get(int(seconds // SECONDS_PER_DAY) * SECONDS_PER_DAY)
+        if chunk is None:
+            return None
+        
+        # A re-sync probes a compacted day sample by sample; decode it once
+        if self._decoded is None or self._decoded[0] is not chunk.payload:
+            self._decoded = (chunk.payload, decode_arrays(chunk.payload))
+        timestamps, values, _ = self._decoded[1]
+        timestamp_ms = int(round(seconds * 1000))
+        index = int(np.searchsorted(timestamps, timestamp_ms))
+        if index < len(timestamps) and timestamps[index] == timestamp_ms:
+            return seconds, float(values[index]), chunk.unit
+        return None
+    
+    def range(self, start_seconds: float, end_seconds: float) -> List[HealthMetric]:
+        lo = bisect.bisect_left(self.timestamps, start_seconds)
+        hi = bisect.bisect_left(self.timestamps, end_seconds)
+        return self.metrics[lo:hi]
+    
+    def chunks_in_range(self, start_seconds: float, end_seconds: float) -> List[Chunk]:
+        first_day = int(start_seconds // SECONDS_PER_DAY) * SECONDS_PER_DAY
+        if len(self.chunks) < (end_seconds - first_day) / SECONDS_PER_DAY:
+            days = sorted(d for d in self.chunks if first_day <= d < end_seconds)
+        else:
+            # ceil: a day starting inside a fractional end second is still in range
+            days = [d for d in range(first_day, int(np.ceil(end_seconds)), SECONDS_PER_DAY)
+                    if d in self.chunks]
+        return [self.chunks[d] for d in days]
+    
+    def arrays(self, start_seconds: float,
+               end_seconds: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(timestamps_ms, values, quality) for [start, end) from chunks and raw samples"""
+        start_ms = int(round(start_seconds * 1000))
+        end_ms = int(round(end_seconds * 1000))
+        parts = []
+        
+        for chunk in self.chunks_in_range(start_seconds, end_seconds):
+            timestamps, values, quality = decode_arrays(chunk.payload)
+            lo, hi = np.searchsorted(timestamps, [start_ms, end_ms])
+            parts.append((timestamps[lo:hi], values[lo:hi], quality[lo:hi]))
+        
+        raw = self.range(start_seconds, end_seconds)
+        if raw:
+            lo = bisect.bisect_left(self.timestamps, start_seconds)
+            parts.append((
+                np.round(np.array(self.timestamps[lo:lo + len(raw)]) * 1000).astype(np.int64),
+                np.array([m.value for m in raw], dtype=np.float64),
+                np.array([m.quality_score for m in raw], dtype=np.float64)
+            ))
+        
+        if not parts:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+                    np.empty(0, dtype=np.float64))
+        
+        timestamps = np.concatenate([p[0] for p in parts])
+        values = np.concatenate([p[1] for p in parts])
+        quality = np.concatenate([p[2] for p in parts])
+        
+        # Late samples for compacted days sit in the raw list
+        if len(parts) > 1 and np.any(np.diff(timestamps) < 0):
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, values, quality = timestamps[order], values[order], quality[order]
+        return timestamps, values, quality
+
+class MetricStore:
+    """
+    In-process store of ingested metrics and their minute/hour/day rollups
+    """
+    
+    def __init__(self, rollups: RollupEngine = None, baselines: BaselineTracker = None):
+        self.series: Dict[SeriesKey, MetricSeries] = {}
+        self.rollups = rollups or RollupEngine()
+        self.dedup = DedupIndex()
+        self.baselines = baselines or BaselineTracker()
+        
+        # Called as listener(user_id, day_numbers) after writes that change stored data
+        self.listeners: List[Callable[[str, Set[int]], None]] = []
+        
+        # user_id -> series keys, so per-user lookups don't scan every series
+        self._user_series: Dict[str, List[SeriesKey]] = {}
+    
+    def drop_users(self, user_ids: Set[str]):
+        """Forget the users' series, rollups, dedup entries and baselines"""
+        for user_id in user_ids:
+            for key in self._user_series.pop(user_id, ()):
+                del self.series[key]
+        self.rollups.drop_users(user_ids)
+        self.dedup.drop_users(user_ids)
+        self.baselines.drop_users(user_ids)
+    
+    def _get_series(self, key: SeriesKey) -> MetricSeries:
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = MetricSeries()
+            self._user_series.setdefault(key[0], []).append(key)
+        return series
+    
+    def write(self, user_id: str, metrics: List[HealthMetric]) -> IngestStats:
+        """
+        Store metrics for a user and update rollups and baselines
+        Re-synced records are matched on natural key: identical content is skipped
+        and revised content replaces the stored record
+        """
+        stats = IngestStats()
+        revised_days = set()
+        touched_days = set()
+        anomalies = 0
+        
+        for metric in metrics:
+            if metric.value is None:
+                continue
+            
+            key = (user_id, metric.metric_type, metric.source_device)
+            seconds = epoch_seconds(metric.timestamp)
+            series = self.series.get(key)
+            
+            stored = None
+            if series is not None and not has_vendor_id(metric):
+                stored = series.find(seconds)
+            outcome, replaced = self.dedup.classify(user_id, metric, stored)
+            if outcome not in (INSERTED, UPDATED):
+                stats.record(outcome)
+                continue
+            
+            if series is None:
+                series = self._get_series(key)
+            
+            if outcome == UPDATED:
+                old_seconds, old_value = replaced
+                series.remove(old_seconds, old_value)
+                revised_days.add((key, int(old_seconds // SECONDS_PER_DAY)))
+                revised_days.add((key, int(seconds // SECONDS_PER_DAY)))
+                series.insert(seconds, metric)
+            else:
+                series.insert(seconds, metric)
+                self.rollups.ingest(
+                    user_id, metric.metric_type, metric.source_device,
+                    metric.timestamp, metric.value, metric.quality_score
+                )
+                # Revisions aren't re-scored: an EWMA can't retract the value it replaces
+                if self.baselines.observe(user_id, metric):
+                    anomalies += 1
+            
+            self.dedup.remember(user_id, metric, seconds)
+            stats.record(outcome)
+            touched_days.add(int(seconds // SECONDS_PER_DAY))
+        
+        # Min/max can't be retracted, so revised days are re-rolled from raw data
+        for key, day in revised_days:
+            self._rebuild_rollups(key, day)
+            chunk = self.series[key].chunks.get(day * SECONDS_PER_DAY)
+            if chunk:
+                chunk.sketch = self._day_sketch_bytes(key, day * SECONDS_PER_DAY)
+            touched_days.add(day)
+        
+        if touched_days:
+            for listener in self.listeners:
+                listener(user_id, touched_days)
+        
+        logger.debug(
+            f"Stored metrics for user {user_id}: {stats.inserted} inserted, "
+            f"{stats.updated} updated, {stats.unchanged} unchanged"
+        )
+        if anomalies:
+            logger.info(f"Flagged {anomalies} metrics deviating from baseline for user {user_id}")
+        return stats
+    
+    def write_arrays(self, user_id: str, metric_type: str, source_device: str,
+                     timestamps_ms: np.ndarray, values: np.ndarray,
+                     quality: np.ndarray = None, unit: str = None,
+                     natural_ids: np.ndarray = None) -> IngestStats:
+        """
+        Bulk-load one series from arrays (e.g. a columnar import)
+        New rows go straight into day chunks with vectorized rollup updates; rows whose
+        timestamp is already stored take the regular write() path so revisions apply
+        natural_ids holds each row's vendor ID or None; rows with one are registered
+        for dedup, so the next sync of those records doesn't insert them again
+        """
+        timestamps_ms = np.asarray(timestamps_ms, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        quality = np.ones(len(values)) if quality is None else np.asarray(quality, dtype=np.float64)
+        order = np.argsort(timestamps_ms, kind='stable')
+        timestamps_ms, values, quality = timestamps_ms[order], values[order], quality[order]
+        if natural_ids is not None:
+            natural_ids = np.asarray(natural_ids, dtype=object)[order]
+        
+        key = (user_id, metric_type, source_device)
+        series = self.series.get(key)
+        if series is not None and len(timestamps_ms):
+            stored_ms, _, _ = series.arrays(timestamps_ms[0] / 1000, (timestamps_ms[-1] + 1) / 1000)
+            known = np.isin(timestamps_ms, stored_ms)
+        else:
+            known = np.zeros(len(timestamps_ms), dtype=bool)
+        
+        def row_metric(i: int) -> HealthMetric:
+            natural_id = natural_ids[i] if natural_ids is not None else None
+            return HealthMetric(
+                metric_type=metric_type,
+                value=float(values[i]),
+                unit=unit,
+                timestamp=EPOCH + timedelta(milliseconds=int(timestamps_ms[i])),
+                source_device=source_device,
+                quality_score=float(quality[i]),
+                metadata={'natural_id': natural_id} if natural_id is not None else None
+            )
+        
+        stats = IngestStats()
+        if known.any():
+            metrics = [row_metric(i) for i in np.flatnonzero(known).tolist()]
+            # A vendor ID the index hasn't seen names the sample stored at its timestamp
+            for metric in metrics:
+                self.dedup.adopt(user_id, metric, series.find(epoch_seconds(metric.timestamp)))
+            stats.merge(self.write(user_id, metrics))
+        
+        new = np.flatnonzero(~known)
+        if not len(new):
+            return stats
+        if natural_ids is not None:
+            for i in new[np.not_equal(natural_ids[new], None)].tolist():
+                self.dedup.remember(user_id, row_metric(i), timestamps_ms[i] / 1000)
+        timestamps_ms, values, quality = timestamps_ms[new], values[new], quality[new]
+        seconds = timestamps_ms / 1000
+        
+        series = self._get_series(key)
+        series.unit = unit
+        
+        days = timestamps_ms // (SECONDS_PER_DAY * 1000)
+        boundaries = np.flatnonzero(np.diff(days)) + 1
+        for lo, hi in zip(np.r_[0, boundaries], np.r_[boundaries, len(days)]):
+            day_start = int(days[lo]) * SECONDS_PER_DAY
+            day_ts, day_values, day_quality = timestamps_ms[lo:hi], values[lo:hi], quality[lo:hi]
+            
+            existing = series.chunks.get(day_start)
+            if existing:
+                old_ts, old_values, old_quality = decode_arrays(existing.payload)
+                day_ts = np.concatenate([old_ts, day_ts])
+                merge_order = np.argsort(day_ts, kind='stable')
+                day_ts = day_ts[merge_order]
+                day_values = np.concatenate([old_values, day_values])[merge_order]
+                day_quality = np.concatenate([old_quality, day_quality])[merge_order]
+            
+            series.chunks[day_start] = Chunk(
+                user_id=user_id,
+                metric_type=metric_type,
+                source_device=source_device,
+                day=(EPOCH + timedelta(seconds=day_start)).date(),
+                unit=unit,
+                count=len(day_ts),
+                payload=encode_arrays(day_ts, day_values, day_quality)
+            )
+        
+        self.rollups.ingest_arrays(user_id, metric_type, source_device, seconds, values, quality)
+        for day in np.unique(days).tolist():
+            series.chunks[day * SECONDS_PER_DAY].sketch = self._day_sketch_bytes(key, day * SECONDS_PER_DAY)
+        self.baselines.update_many(user_id, metric_type, source_device, seconds.tolist(), values.tolist())
+        stats.inserted += len(new)
+        
+        touched_days = set(np.unique(days).tolist())
+        for listener in self.listeners:
+            listener(user_id, touched_days)
+        
+        logger.debug(f"Bulk loaded {len(new)} {metric_type} samples for user {user_id} from {source_device}")
+        return stats
+    
+    def natural_ids(self, user_id: str, metric_type: str, source_device: str) -> Dict[int, str]:
+        """Vendor IDs of a series' records by timestamp in epoch ms (e.g. for export)"""
+        return self.dedup.natural_ids(user_id, metric_type, source_device)
+    
+    def _rebuild_rollups(self, key: SeriesKey, day: int):
+        day_start = EPOCH + timedelta(days=day)
+        day_end = day_start + timedelta(days=1)
+        timestamps, values, quality = self.series[key].arrays(
+            epoch_seconds(day_start), epoch_seconds(day_end)
+        )
+        samples = [
+            (EPOCH + timedelta(milliseconds=t), v, q)
+            for t, v, q in zip(timestamps.tolist(), values.tolist(), quality.tolist())
+        ]
+        self.rollups.rebuild(key[0], key[1], key[2], samples, day_start, day_end)
+    
+    def _day_sketch_bytes(self, key: SeriesKey, day_start: int) -> bytes:
+        bucket = self.rollups.rollups.get((*key, 'day'), {}).get(day_start)
+        return bucket.sketch.to_bytes() if bucket else b''
+    
+    def read(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+             source_device: str = None) -> List[HealthMetric]:
+        """Raw metrics in [start, end), merged across devices unless one is given"""
+        start_seconds = epoch_seconds(start)
+        end_seconds = epoch_seconds(end)
+        
+        results = []
+        for key in self.series_keys(user_id, metric_type, source_device):
+            series = self.series[key]
+            for chunk in series.chunks_in_range(start_seconds, end_seconds):
+                results.extend(
+                    m for m in self._chunk_metrics(chunk)
+                    if start_seconds <= epoch_seconds(m.timestamp) < end_seconds
+                )
+            results.extend(series.range(start_seconds, end_seconds))
+        
+        results.sort(key=lambda m: epoch_seconds(m.timestamp))
+        return results
+    
+    def read_arrays(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+                    source_device: str = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (timestamps_ms, values, quality) NumPy arrays for [start, end) without
+        building HealthMetric objects; devices are merged in time order
+        """
+        start_seconds = epoch_seconds(start)
+        end_seconds = epoch_seconds(end)
+        
+        parts = [
+            self.series[key].arrays(start_seconds, end_seconds)
+            for key in self.series_keys(user_id, metric_type, source_device)
+        ]
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64),
+                    np.empty(0, dtype=np.float64))
+        
+        timestamps = np.concatenate([p[0] for p in parts])
+        order = np.argsort(timestamps, kind='stable')
+        return (timestamps[order], np.concatenate([p[1] for p in parts])[order],
+                np.concatenate([p[2] for p in parts])[order])
+    
+    def compact(self, before: datetime = None) -> int:
+        """
+        Encode raw samples of complete days before `before` into one compressed
+        chunk per (user, metric_type, source_device, day) and drop the raw rows.
+        Only timestamp, value and quality survive compaction; metadata does not.
+        Returns the number of chunks written.
+        """
+        before = before or datetime.now()
+        cutoff = int(epoch_seconds(before) // SECONDS_PER_DAY) * SECONDS_PER_DAY
+        written = 0
+        
+        for key, series in self.series.items():
+            split = bisect.bisect_left(series.timestamps, cutoff)
+            if split == 0:
+                continue
+            
+            timestamps = np.array(series.timestamps[:split])
+            values = np.array([m.value for m in series.metrics[:split]], dtype=np.float64)
+            quality = np.array([m.quality_score for m in series.metrics[:split]], dtype=np.float64)
+            days = (timestamps // SECONDS_PER_DAY).astype(np.int64) * SECONDS_PER_DAY
+            boundaries = np.flatnonzero(np.diff(days)) + 1
+            
+            for lo, hi in zip(np.r_[0, boundaries], np.r_[boundaries, split]):
+                day_start = int(days[lo])
+                timestamps_ms = np.round(timestamps[lo:hi] * 1000).astype(np.int64)
+                day_values, day_quality = values[lo:hi], quality[lo:hi]
+                
+                # Fold late samples into an already compacted day
+                existing = series.chunks.get(day_start)
+                if existing:
+                    old_ts, old_values, old_quality = decode_arrays(existing.payload)
+                    timestamps_ms = np.concatenate([old_ts, timestamps_ms])
+                    order = np.argsort(timestamps_ms, kind='stable')
+                    timestamps_ms = timestamps_ms[order]
+                    day_values = np.concatenate([old_values, day_values])[order]
+                    day_quality = np.concatenate([old_quality, day_quality])[order]
+                
+                series.chunks[day_start] = Chunk(
+                    user_id=key[0],
+                    metric_type=key[1],
+                    source_device=key[2],
+                    day=(EPOCH + timedelta(seconds=day_start)).date(),
+                    unit=series.unit,
+                    count=len(timestamps_ms),
+                    payload=encode_arrays(timestamps_ms, day_values, day_quality),
+                    sketch=self._day_sketch_bytes(key, day_start)
+                )
+                written += 1
+            
+            del series.timestamps[:split]
+            del series.metrics[:split]
+        
+        logger.info(f"Compacted {written} metric chunks before {before.date()}")
+        return written
+    
+    def _chunk_metrics(self, chunk: Chunk) -> List[HealthMetric]:
+        timestamps, values, quality = decode_arrays(chunk.payload)
+        return [
+            HealthMetric(
+                metric_type=chunk.metric_type,
+                value=value,
+                unit=chunk.unit,
+                timestamp=EPOCH + timedelta(milliseconds=timestamp),
+                source_device=chunk.source_device,
+                quality_score=score
+            )
+            for timestamp, value, score in zip(
+                timestamps.tolist(), values.tolist(), quality.tolist()
+            )
+        ]
+    
+    def series_keys(self, user_id: str, metric_type: str = None,
+                    source_device: str = None) -> List[SeriesKey]:
+        """Series stored for a user, optionally filtered by metric type and device"""
+        return [
+            key for key in self._user_series.get(user_id, [])
+            if (metric_type is None or key[1] == metric_type)
+            and (source_device is None or key[2] == source_device)
+        ]
+    
+    def sources(self, user_id: str, metric_type: str) -> List[str]:
+        """Devices with stored samples for the user's metric"""
+        return [key[2] for key in self.series_keys(user_id, metric_type)]
+    
+    def unit(self, user_id: str, metric_type: str, source_device: str) -> Optional[str]:
+        series = self.series.get((user_id, metric_type, source_device))
+        return series.unit if series else None
+    
+    def rollup(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+               resolution: Union[str, timedelta] = 'day',
+               source_device: str = None) -> List[Tuple[datetime, RollupBucket]]:
+        """Pre-aggregated summaries for [start, end) at the requested resolution"""
+        return self.rollups.query(
+            user_id, metric_type, start, end, resolution,
+            [source_device] if source_device else None
+        )
+    
+    def day_sketches(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+                     source_device: str = None) -> Dict[datetime, QuantileSketch]:
+        """
+        Per-day quantile sketches for [start, end), built during ingest
+        Days with several devices get a merged copy; single-device days are the stored sketch
+        """
+        return {
+            day_start: bucket.sketch
+            for day_start, bucket in self.rollup(user_id, metric_type, start, end, 'day', source_device)
+        }
+    
+    def sketch(self, user_ids: List[str], metric_type: str, start: datetime, end: datetime,
+               source_device: str = None) -> QuantileSketch:
+        """
+        Distribution of a metric across users and days, merged from per-day sketches
+        Cost is O(days x sketch size) per user instead of a scan of raw samples
+        """
+        merged = QuantileSketch()
+        for user_id in user_ids:
+            devices = [source_device] if source_device else self.sources(user_id, metric_type)
+            for device in devices:
+                for _, bucket in self.rollup(user_id, metric_type, start, end, 'day', device):
+                    merged.merge(bucket.sketch)
+        return merged
+    
+    def daily_metrics(self, user_id: str, source_device: str,
+                      date: datetime) -> List[HealthMetric]:
+        """One summary HealthMetric per metric type for a device and day"""
+        day_start = datetime.combine(date, datetime.min.time())
+        day_end = day_start + timedelta(days=1)
+        
+        metrics = []
+        for key in self.series_keys(user_id, source_device=source_device):
+            metric_type = key[1]
+            buckets = self.rollup(user_id, metric_type, day_start, day_end, 'day', source_device)
+            if not buckets:
+                continue
+            
+            _, bucket = buckets[0]
+            metrics.append(HealthMetric(
+                metric_type=metric_type,
+                value=bucket.value(metric_type),
+                unit=self.series[key].unit,
+                timestamp=day_start,
+                source_device=source_device,
+                quality_score=bucket.mean_quality,
+                metadata={'samples': bucket.count}
+            ))
+        
+        return metrics
@@ -0,0 +1,400 @@
+"""
+Memory-mapped per-user time-series files
+Each (user, metric_type, source_device) series is a fixed-layout, time-ordered record
+file with a small day-offset index, read back as zero-copy NumPy views.
+It can be attached to an integration in place of MetricStore as a durable archive:
+it serves the same write and read calls, but has no baselines or listeners, and
+rollups are computed from the mapped records at query time. A series holds one
+record per timestamp, so re-synced windows replace records instead of adding
+copies; without a vendor-ID index, a revision that moves a record's timestamp
+leaves the old record in place
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import quote, unquote
+from loguru import logger
+import numpy as np
+
+from .base_device import HealthMetric
+from .dedup import IngestStats
+from .rollups import RollupBucket, RollupEngine, epoch_seconds
+
+RECORD_DTYPE = np.dtype([
+    ('timestamp_ms', '<i8'),
+    ('value', '<f8'),
+    ('quality', '<f4'),
+    ('flags', '<u4'),
+])
+
+# (day number, first row of that day)
+INDEX_DTYPE = np.dtype([('day', '<i8'), ('row', '<i8')])
+
+FILE_MAGIC = b'HMTS0001'
+HEADER_SIZE = 64  # keeps records aligned to cache lines and pages; magic, then the unit
+MS_PER_DAY = 86400 * 1000
+
+def _file_name(name: str) -> str:
+    """Percent-encode a key part, dots included, so '.' only ever separates parts"""
+    return quote(name, safe='').replace('.', '%2E')
+
+def _header(unit: Optional[str]) -> bytes:
+    return (FILE_MAGIC + (unit or '').encode()[:HEADER_SIZE - len(FILE_MAGIC)]).ljust(HEADER_SIZE, b'\0')
+
+def _day_index(timestamps_ms: np.ndarray, first_row: int = 0) -> np.ndarray:
+    """Index entries for every day that starts inside a time-sorted run of records"""
+    days = timestamps_ms // MS_PER_DAY
+    starts = np.flatnonzero(np.r_[True, np.diff(days) != 0])
+    index = np.empty(len(starts), dtype=INDEX_DTYPE)
+    index['day'] = days[starts]
+    index['row'] = starts + first_row
+    return index
+
+class MmapMetricStore:
+    """
+    File-backed metric store whose reads are views over mapped pages
+    Appends must be time-ordered per series; out-of-order batches trigger a rewrite
+    """
+    
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        
+        # data path -> (record count, mapping); invalidated on append
+        self._maps: Dict[str, Tuple[int, np.memmap]] = {}
+        self._indexes: Dict[str, np.ndarray] = {}
+    
+    def _paths(self, user_id: str, metric_type: str, source_device: str) -> Tuple[str, str]:
+        user_dir = os.path.join(self.root, _file_name(user_id))
+        base = os.path.join(user_dir, f"{_file_name(metric_type)}.{_file_name(source_device)}")
+        return base + '.dat', base + '.idx'
+    
+    def _record_count(self, data_path: str) -> int:
+        if not os.path.exists(data_path):
+            return 0
+        # A torn trailing record from a crash is ignored by readers; append() cuts it off
+        return max(os.path.getsize(data_path) - HEADER_SIZE, 0) // RECORD_DTYPE.itemsize
+    
+    def _repair(self, data_path: str, index_path: str):
+        """
+        Cut a torn tail left by a crashed append and rebuild the day index to match,
+        so the next append starts on a record boundary
+        """
+        if not os.path.exists(data_path):
+            return
+        count = self._record_count(data_path)
+        size = HEADER_SIZE + count * RECORD_DTYPE.itemsize
+        if os.path.getsize(data_path) == size:
+            return
+        
+        if count == 0:
+            os.remove(data_path)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            self._maps.pop(data_path, None)
+            self._indexes.pop(index_path, None)
+        else:
+            with open(data_path, 'r+b') as f:
+                f.truncate(size)
+            self._maps.pop(data_path, None)
+            index = _day_index(np.asarray(self._records(data_path)['timestamp_ms']))
+            with open(index_path, 'wb') as f:
+                f.write(index.tobytes())
+            self._indexes[index_path] = index
+        logger.warning(f"Truncated torn records in {data_path} to {count} records")
+    
+    def _records(self, data_path: str) -> np.ndarray:
+        count = self._record_count(data_path)
+        cached = self._maps.get(data_path)
+        if cached and cached[0] == count:
+            return cached[1]
+        
+        if count == 0:
+            records = np.empty(0, dtype=RECORD_DTYPE)
+        else:
+            records = np.memmap(data_path, dtype=RECORD_DTYPE, mode='r',
+                                offset=HEADER_SIZE, shape=(count,))
+        self._maps[data_path] = (count, records)
+        return records
+    
+    def _index(self, index_path: str) -> np.ndarray:
+        index = self._indexes.get(index_path)
+        if index is None:
+            if os.path.exists(index_path):
+                with open(index_path, 'rb') as f:
+                    payload = f.read()
+                index = np.frombuffer(
+                    payload[:len(payload) - len(payload) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE
+                )
+            else:
+                index = np.empty(0, dtype=INDEX_DTYPE)
+            self._indexes[index_path] = index
+        return index
+    
+    def append(self, user_id: str, metric_type: str, source_device: str,
+               timestamps_ms: np.ndarray, values: np.ndarray,
+               quality: np.ndarray = None, unit: str = None) -> IngestStats:
+        """
+        Add samples to a series, matched to stored records by timestamp: new ones are
+        appended, stored ones whose value or quality changed are overwritten in place
+        and identical ones are skipped
+        """
+        stats = IngestStats()
+        batch = np.empty(len(timestamps_ms), dtype=RECORD_DTYPE)
+        if not len(batch):
+            return stats
+        
+        batch['timestamp_ms'] = timestamps_ms
+        batch['value'] = values
+        batch['quality'] = 1.0 if quality is None else quality
+        batch['flags'] = 0
+        batch.sort(order='timestamp_ms', kind='stable')
+        # The last sample for a repeated timestamp wins, as it would across writes
+        batch = batch[np.r_[batch['timestamp_ms'][1:] != batch['timestamp_ms'][:-1], True]]
+        
+        data_path, index_path = self._paths(user_id, metric_type, source_device)
+        self._repair(data_path, index_path)
+        existing = self._records(data_path)
+        
+        if len(existing):
+            batch = self._apply_stored(data_path, existing, batch, stats)
+            if not len(batch):
+                return stats
+        stats.inserted = len(batch)
+        
+        if len(existing) and batch['timestamp_ms'][0] < existing['timestamp_ms'][-1]:
+            # Slow path: merge and rewrite the whole series
+            merged = np.concatenate([np.asarray(existing), batch])
+            merged = merged[np.argsort(merged['timestamp_ms'], kind='stable')]
+            self._rewrite(data_path, index_path, merged,
+                          unit or self.unit(user_id, metric_type, source_device))
+            return stats
+        
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        first_row = len(existing)
+        
+        with open(data_path, 'ab') as f:
+            if first_row == 0:
+                f.truncate(0)
+                f.write(_header(unit))
+            f.write(batch.tobytes())
+        
+        # Index every day that starts inside this batch
+        index = self._index(index_path)
+        new_entries = _day_index(batch['timestamp_ms'], first_row)
+        if len(index) and new_entries['day'][0] == index['day'][-1]:
+            new_entries = new_entries[1:]
+        
+        with open(index_path, 'ab') as f:
+            f.write(new_entries.tobytes())
+        self._indexes[index_path] = np.concatenate([index, new_entries])
+        
+        return stats
+    
+    def _apply_stored(self, data_path: str, existing: np.ndarray, batch: np.ndarray,
+                      stats: IngestStats) -> np.ndarray:
+        """
+        Overwrite the stored records a batch revises and count them and the identical
+        ones in stats; returns the batch rows whose timestamps aren't stored yet
+        Only the stored rows within the batch's time span are read
+        """
+        stored_ts = existing['timestamp_ms']
+        lo = int(np.searchsorted(stored_ts, batch['timestamp_ms'][0], side='left'))
+        hi = int(np.searchsorted(stored_ts, batch['timestamp_ms'][-1], side='right'))
+        overlap = np.asarray(stored_ts[lo:hi])
+        
+        positions = np.searchsorted(overlap, batch['timestamp_ms'])
+        found = positions < len(overlap)
+        found[found] = overlap[positions[found]] == batch['timestamp_ms'][found]
+        if not found.any():
+            return batch
+        
+        rows = lo + positions[found]
+        incoming = batch[found]
+        current = np.asarray(existing[rows])
+        changed = (current['value'] != incoming['value']) | (current['quality'] != incoming['quality'])
+        stats.unchanged += int(np.count_nonzero(~changed))
+        
+        if changed.any():
+            incoming = incoming[changed]
+            incoming['flags'] = current['flags'][changed]
+            # Same timestamps, so the records stay in place and the day index stays valid
+            with open(data_path, 'r+b') as f:
+                for row, record in zip(rows[changed].tolist(), incoming):
+                    f.seek(HEADER_SIZE + row * RECORD_DTYPE.itemsize)
+                    f.write(record.tobytes())
+            self._maps.pop(data_path, None)
+            stats.updated += len(incoming)
+        return batch[~found]
+    
+    def _rewrite(self, data_path: str, index_path: str, records: np.ndarray, unit: str = None):
+        index = _day_index(records['timestamp_ms'])
+        
+        # Write beside the live files and swap, so readers never see a partial file
+        for path, payload in ((data_path, _header(unit) + records.tobytes()),
+                              (index_path, index.tobytes())):
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        
+        self._maps.pop(data_path, None)
+        self._indexes[index_path] = index
+        logger.debug(f"Rewrote {data_path} with {len(records)} records")
+    
+    def write(self, user_id: str, metrics: List[HealthMetric]) -> IngestStats:
+        """
+        Store HealthMetrics grouped by series; same contract as MetricStore.write,
+        with records matched on timestamp alone
+        """
+        by_series: Dict[Tuple[str, str], List[HealthMetric]] = {}
+        for metric in metrics:
+            if metric.value is not None:
+                by_series.setdefault((metric.metric_type, metric.source_device), []).append(metric)
+        
+        stats = IngestStats()
+        for (metric_type, source_device), series_metrics in by_series.items():
+            stats.merge(self.append(
+                user_id, metric_type, source_device,
+                np.array([round(epoch_seconds(m.timestamp) * 1000) for m in series_metrics],
+                         dtype=np.int64),
+                np.array([m.value for m in series_metrics], dtype=np.float64),
+                np.array([m.quality_score for m in series_metrics], dtype=np.float32),
+                series_metrics[0].unit
+            ))
+        return stats
+    
+    def write_arrays(self, user_id: str, metric_type: str, source_device: str,
+                     timestamps_ms: np.ndarray, values: np.ndarray,
+                     quality: np.ndarray = None, unit: str = None,
+                     natural_ids: np.ndarray = None) -> IngestStats:
+        """
+        Bulk-load one series from arrays; same contract as MetricStore.write_arrays
+        except that natural_ids are ignored, as there is no dedup index to register them in
+        """
+        return self.append(
+            user_id, metric_type, source_device,
+            np.asarray(timestamps_ms, dtype=np.int64), np.asarray(values, dtype=np.float64),
+            None if quality is None else np.asarray(quality, dtype=np.float32), unit
+        )
+    
+    def read_range(self, user_id: str, metric_type: str, source_device: str,
+                   start: datetime, end: datetime) -> np.ndarray:
+        """
+        Records in [start, end) as a view over the mapped file (no copy)
+        Only the day index and the pages holding the requested days are touched
+        """
+        data_path, index_path = self._paths(user_id, metric_type, source_device)
+        records = self._records(data_path)
+        if not len(records):
+            return records
+        
+        start_ms = int(round(epoch_seconds(start) * 1000))
+        end_ms = int(round(epoch_seconds(end) * 1000))
+        
+        # Narrow to whole days with the index, then bisect inside those days
+        index = self._index(index_path)
+        first = np.searchsorted(index['day'], start_ms // MS_PER_DAY, side='right') - 1
+        last = np.searchsorted(index['day'], (end_ms - 1) // MS_PER_DAY, side='right')
+        lo_row = int(index['row'][max(first, 0)])
+        hi_row = int(index['row'][last]) if last < len(index) else len(records)
+        
+        window = records[lo_row:hi_row]
+        lo, hi = np.searchsorted(window['timestamp_ms'], [start_ms, end_ms])
+        return window[lo:hi]
+    
+    def read_arrays(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+                    source_device: str = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(timestamps_ms, values, quality) for [start, end); views when a single device is read"""
+        devices = [source_device] if source_device else self.sources(user_id, metric_type)
+        parts = [self.read_range(user_id, metric_type, device, start, end) for device in devices]
+        
+        if len(parts) == 1:
+            records = parts[0]
+        elif parts:
+            records = np.concatenate(parts)
+            records = records[np.argsort(records['timestamp_ms'], kind='stable')]
+        else:
+            records = np.empty(0, dtype=RECORD_DTYPE)
+        
+        return records['timestamp_ms'], records['value'], records['quality']
+    
+    def rollup(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+               resolution: Union[str, timedelta] = 'day',
+               source_device: str = None) -> List[Tuple[datetime, RollupBucket]]:
+        """Summaries for [start, end) at the requested resolution, folded from the mapped records"""
+        devices = [source_device] if source_device else self.sources(user_id, metric_type)
+        granularity = RollupEngine().coarsest_granularity(start, end, resolution)
+        engine = RollupEngine([granularity])
+        for device in devices:
+            records = self.read_range(user_id, metric_type, device, start, end)
+            engine.ingest_arrays(
+                user_id, metric_type, device, records['timestamp_ms'] / 1000.0,
+                records['value'].astype(np.float64), records['quality'].astype(np.float64)
+            )
+        return engine.query(user_id, metric_type, start, end, resolution, devices)
+    
+    def daily_metrics(self, user_id: str, source_device: str,
+                      date: datetime) -> List[HealthMetric]:
+        """One summary HealthMetric per metric type for a device and day"""
+        day_start = datetime.combine(date, datetime.min.time())
+        day_end = day_start + timedelta(days=1)
+        
+        metrics = []
+        for _, metric_type, _ in self.series_keys(user_id, source_device=source_device):
+            buckets = self.rollup(user_id, metric_type, day_start, day_end, 'day', source_device)
+            if not buckets:
+                continue
+            
+            _, bucket = buckets[0]
+            metrics.append(HealthMetric(
+                metric_type=metric_type,
+                value=bucket.value(metric_type),
+                unit=self.unit(user_id, metric_type, source_device),
+                timestamp=day_start,
+                source_device=source_device,
+                quality_score=bucket.mean_quality,
+                metadata={'samples': bucket.count}
+            ))
+        
+        return metrics
+    
+    def natural_ids(self, user_id: str, metric_type: str, source_device: str) -> Dict[int, str]:
+        """No vendor IDs are kept, so exports of this store carry none"""
+        return {}
+    
+    def unit(self, user_id: str, metric_type: str, source_device: str) -> Optional[str]:
+        data_path, _ = self._paths(user_id, metric_type, source_device)
+        if not os.path.exists(data_path):
+            return None
+        with open(data_path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        return header[len(FILE_MAGIC):].rstrip(b'\0').decode() or None
+    
+    def sources(self, user_id: str, metric_type: str) -> List[str]:
+        """Devices with a stored series for the user's metric"""
+        return [key[2] for key in self.series_keys(user_id, metric_type)]
+    
+    def series_keys(self, user_id: str, metric_type: str = None,
+                    source_device: str = None) -> List[Tuple[str, str, str]]:
+        """Series stored for a user, optionally filtered by metric type and device"""
+        return [
+            (user_id, stored_type, device) for stored_type, device in self.series(user_id)
+            if (metric_type is None or stored_type == metric_type)
+            and (source_device is None or device == source_device)
+        ]
+    
+    def series(self, user_id: str) -> List[Tuple[str, str]]:
+        """(metric_type, source_device) pairs stored for a user"""
+        user_dir = os.path.join(self.root, _file_name(user_id))
+        if not os.path.isdir(user_dir):
+            return []
+        
+        pairs = []
+        for name in sorted(os.listdir(user_dir)):
+            if name.endswith('.dat'):
+                # Parts are encoded with dots escaped, so the only '.' is the separator
+                metric_type, source_device = name[:-4].split('.')
+                pairs.append((unquote(metric_type), unquote(source_device)))
+        return pairs
@@ -0,0 +1,364 @@
+"""
+Durable store of user device profiles and their connections
+Backed by a local SQLite file in WAL mode so worker processes can share it; loaded
+profiles are cached in memory and changed ones are written back in batches. Indexed
+columns let schedulers and token refreshers ask who is due or expiring without
+scanning every profile.
+Writes go through one writer thread, so commits (which can wait on busy_timeout)
+stay off the event loop and land in the order their snapshots were taken
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+from loguru import logger
+
+from .base_device import DeviceConnection
+from .sync_history import SyncHistory
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    user_id TEXT PRIMARY KEY,
+    sync_preferences TEXT NOT NULL,
+    data_quality_scores TEXT NOT NULL,
+    last_full_sync REAL,
+    next_sync_due REAL,
+    sync_history TEXT
+);
+CREATE TABLE IF NOT EXISTS connections (
+    user_id TEXT NOT NULL,
+    device_type TEXT NOT NULL,
+    access_token TEXT NOT NULL,
+    refresh_token TEXT,
+    token_expires_at REAL,
+    permissions TEXT,
+    last_sync REAL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (user_id, device_type)
+);
+CREATE INDEX IF NOT EXISTS profiles_next_sync_due ON profiles (next_sync_due);
+CREATE INDEX IF NOT EXISTS connections_device_status ON connections (device_type, status);
+CREATE INDEX IF NOT EXISTS connections_status_expiry ON connections (status, token_expires_at);
+"""
+
+@dataclass
+class UserDeviceProfile:
+    """Complete device profile for a user"""
+    user_id: str
+    connected_devices: Dict[str, DeviceConnection]
+    sync_preferences: Dict[str, Any]
+    data_quality_scores: Dict[str, float]
+    last_full_sync: Optional[datetime] = None
+    next_sync_due: Optional[datetime] = None
+    sync_history: SyncHistory = field(default_factory=SyncHistory)
+    
+    @property
+    def sync_errors(self) -> List[str]:
+        """Most recent sync error messages, oldest first (bounded by the history)"""
+        return self.sync_history.recent_errors(self.sync_history.errors.maxlen)
+
+def _seconds(value: Optional[datetime]) -> Optional[float]:
+    return value.timestamp() if value is not None else None
+
+def _datetime(value: Optional[float]) -> Optional[datetime]:
+    return datetime.fromtimestamp(value) if value is not None else None
+
+class ProfileStore(MutableMapping):
+    """
+    user_id -> UserDeviceProfile mapping persisted to SQLite
+    Profiles are mutated in place, so callers mark_dirty() after changing one; dirty
+    profiles are flushed together once batch_size accumulate or flush_interval
+    seconds pass, and before any indexed query. Inside an event loop a background
+    task flushes every flush_interval and writes are awaited on the writer thread;
+    call aclose() (or close() outside a loop) so the last changes are written
+    """
+    
+    def __init__(self, path: str = ':memory:', batch_size: int = 500,
+                 flush_interval: float = 5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        
+        if path != ':memory:':
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Connections hold OAuth tokens, so the file is private to the service user
+            os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        
+        # Shared by the caller's thread (reads) and the writer thread, one at a time
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile-store')
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA busy_timeout=5000')
+        self.db.executescript(SCHEMA)
+        
+        self._cache: Dict[str, UserDeviceProfile] = {}
+        self._dirty: Set[str] = set()
+        self._last_flush = time.monotonic()
+        
+        # Periodic flush task and flushes in flight, when used from an event loop
+        self._flusher: Optional[asyncio.Task] = None
+        self._flushes: Set[asyncio.Task] = set()
+    
+    # Mapping interface
+    
+    def __getitem__(self, user_id: str) -> UserDeviceProfile:
+        profile = self._cache.get(user_id)
+        if profile is None:
+            profile = self._load(user_id)
+            if profile is None:
+                raise KeyError(user_id)
+            self._cache[user_id] = profile
+        return profile
+    
+    def __contains__(self, user_id) -> bool:
+        if user_id in self._cache:
+            return True
+        try:
+            self[user_id]
+        except KeyError:
+            return False
+        return True
+    
+    def __setitem__(self, user_id: str, profile: UserDeviceProfile):
+        self._cache[user_id] = profile
+        self.mark_dirty(user_id)
+    
+    def __delitem__(self, user_id: str):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._cache.pop(user_id, None)
+        self._dirty.discard(user_id)
+        # Queued behind any flush still writing the profile
+        self._writer.submit(self._delete, user_id).result()
+    
+    def __iter__(self) -> Iterator[str]:
+        self.flush()
+        return iter([row[0] for row in self._query('SELECT user_id FROM profiles ORDER BY user_id')])
+    
+    def __len__(self) -> int:
+        self.flush()
+        return self._query('SELECT COUNT(*) FROM profiles')[0][0]
+    
+    # Persistence
+    
+    def mark_dirty(self, user_id: str, immediate: bool = False):
+        """
+        Queue a cached profile for the next batched write
+        immediate writes it without waiting for the batch, for changes a restart must
+        not lose (new or removed connections, rotated refresh tokens)
+        """
+        self._dirty.add(user_id)
+        due = immediate or len(self._dirty) >= self.batch_size
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if due or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+            return
+        
+        if self._flusher is None or self._flusher.done():
+            self._flusher = loop.create_task(self._flush_periodically())
+        if due:
+            task = loop.create_task(self.flush_async())
+            self._flushes.add(task)
+            task.add_done_callback(self._flush_done)
+    
+    def _flush_done(self, task: asyncio.Task):
+        self._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Profile flush failed: {task.exception()}")
+    
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self._dirty:
+                try:
+                    await self.flush_async()
+                except sqlite3.Error as e:
+                    # The profiles stay dirty and go out with the next flush
+                    logger.error(f"Periodic profile flush failed: {e}")
+    
+    def flush(self) -> int:
+        """Write every dirty profile and its connections in one transaction"""
+        rows = self._take_dirty()
+        if rows is None:
+            return 0
+        future = self._writer.submit(self._write, rows)
+        try:
+            future.result()
+        except BaseException:
+            self._dirty.update(row[0] for row in rows[0])
+            raise
+        return len(rows[0])
+    
+    async def flush_async(self) -> int:
+        """flush() without blocking the event loop on the commit"""
+        rows = self._take_dirty()
+        if rows is None:
+            return 0
+        future = self._writer.submit(self._write, rows)
+        try:
+            await asyncio.wrap_future(future)
+        except BaseException:
+            self._dirty.update(row[0] for row in rows[0])
+            raise
+        return len(rows[0])
+    
+    def _take_dirty(self) -> Optional[Tuple[list, list]]:
+        """
+        Serialize the dirty profiles on the caller's thread, where they are mutated,
+        as (profile rows, connection rows); None when nothing is dirty
+        """
+        self._last_flush = time.monotonic()
+        if not self._dirty:
+            return None
+        
+        profiles = [self._cache[user_id] for user_id in self._dirty if user_id in self._cache]
+        self._dirty.clear()
+        return (
+            [(
+                p.user_id, json.dumps(p.sync_preferences), json.dumps(p.data_quality_scores),
+                _seconds(p.last_full_sync), _seconds(p.next_sync_due),
+                json.dumps(p.sync_history.to_state())
+            ) for p in profiles],
+            [(
+                p.user_id, device_type, c.access_token, c.refresh_token,
+                _seconds(c.token_expires_at), json.dumps(c.permissions),
+                _seconds(c.last_sync), c.status
+            ) for p in profiles for device_type, c in p.connected_devices.items()]
+        )
+    
+    def _write(self, rows: Tuple[list, list]):
+        """Runs on the writer thread"""
+        profile_rows, connection_rows = rows
+        with self._lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?)', profile_rows)
+            # Replace rather than upsert so disconnected devices disappear
+            self.db.executemany(
+                'DELETE FROM connections WHERE user_id = ?', [(row[0],) for row in profile_rows]
+            )
+            self.db.executemany('INSERT INTO connections VALUES (?, ?, ?, ?, ?, ?, ?, ?)', connection_rows)
+    
+    def _delete(self, user_id: str):
+        """Runs on the writer thread"""
+        with self._lock, self.db:
+            self.db.execute('DELETE FROM connections WHERE user_id = ?', (user_id,))
+            self.db.execute('DELETE FROM profiles WHERE user_id = ?', (user_id,))
+    
+    def _query(self, query: str, params: Tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self.db.execute(query, params).fetchall()
+    
+    def _load(self, user_id: str) -> Optional[UserDeviceProfile]:
+        rows = self._query(
+            'SELECT sync_preferences, data_quality_scores, last_full_sync, next_sync_due, '
+            'sync_history FROM profiles WHERE user_id = ?', (user_id,)
+        )
+        if not rows:
+            return None
+        
+        connections = {}
+        for device_type, access_token, refresh_token, expires_at, permissions, last_sync, status \
+                in self._query(
+                    'SELECT device_type, access_token, refresh_token, token_expires_at, '
+                    'permissions, last_sync, status FROM connections WHERE user_id = ?',
+                    (user_id,)
+                ):
+            connections[device_type] = DeviceConnection(
+                user_id=user_id,
+                device_type=device_type,
+                access_token=access_token,
+                refresh_token=refresh_token,
+                token_expires_at=_datetime(expires_at),
+                permissions=json.loads(permissions) if permissions else None,
+                last_sync=_datetime(last_sync),
+                status=status
+            )
+        
+        preferences, quality_scores, last_full_sync, next_sync_due, history = rows[0]
+        return UserDeviceProfile(
+            user_id=user_id,
+            connected_devices=connections,
+            sync_preferences=json.loads(preferences),
+            data_quality_scores=json.loads(quality_scores),
+            last_full_sync=_datetime(last_full_sync),
+            next_sync_due=_datetime(next_sync_due),
+            sync_history=SyncHistory.from_state(json.loads(history)) if history else SyncHistory()
+        )
+    
+    def reload(self, user_id: str):
+        """Drop a cached profile so the next access reads what other processes wrote"""
+        if user_id in self._dirty:
+            self.flush()
+        self._cache.pop(user_id, None)
+    
+    def close(self):
+        """Write pending changes and close; outside an event loop, else use aclose()"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self.flush()
+        self._writer.shutdown(wait=True)
+        self.db.close()
+    
+    async def aclose(self):
+        """Stop the periodic flush, write pending changes off the loop and close"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+        await self.flush_async()
+        await asyncio.to_thread(self._writer.shutdown, True)
+        self.db.close()
+    
+    # Indexed queries
+    
+    def due_for_sync(self, now: datetime = None, limit: int = None) -> List[str]:
+        """Users whose next scheduled sync is due, most overdue first"""
+        self.flush()
+        query = ('SELECT user_id FROM profiles WHERE next_sync_due <= ? '
+                 'ORDER BY next_sync_due')
+        params: Tuple = (_seconds(now or datetime.now()),)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params += (limit,)
+        return [row[0] for row in self._query(query, params)]
+    
+    def expiring_tokens(self, before: datetime,
+                        device_type: str = None) -> List[Tuple[str, str]]:
+        """(user_id, device_type) of active connections whose token expires before `before`"""
+        self.flush()
+        query = ("SELECT user_id, device_type FROM connections WHERE status = 'active' "
+                 "AND token_expires_at < ?")
+        params: Tuple = (_seconds(before),)
+        if device_type is not None:
+            query += ' AND device_type = ?'
+            params += (device_type,)
+        return [tuple(row) for row in self._query(query + ' ORDER BY token_expires_at', params)]
+    
+    def users_with_device(self, device_type: str, status: str = 'active') -> List[str]:
+        self.flush()
+        return [row[0] for row in self._query(
+            'SELECT user_id FROM connections WHERE device_type = ? AND status = ? ORDER BY user_id',
+            (device_type, status)
+        )]
+    
+    def connections_with_status(self, status: str) -> List[Tuple[str, str]]:
+        """(user_id, device_type) of connections in a status, e.g. 'expired' or 'revoked'"""
+        self.flush()
+        return [tuple(row) for row in self._query(
+            'SELECT user_id, device_type FROM connections WHERE status = ? ORDER BY user_id',
+            (status,)
+        )]
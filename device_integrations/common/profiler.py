@@ -0,0 +1,185 @@
+"""
+Opt-in profiling of sync work on a running event loop
+The sampling mode captures event-loop thread stacks from a background thread and
+attributes each sample to the asyncio task running at the time and, through the
+task's sync trace, to a vendor and phase; samples are written as folded stacks
+(one file per vendor and phase) for flamegraph.pl, speedscope or Perfetto.
+The cprofile mode records deterministic cProfile stats for the loop thread instead
+"""
+
+import asyncio
+import cProfile
+import json
+import os
+import selectors
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger
+
+from .tracing import task_trace
+
+PROFILE_MODES = ('sample', 'cprofile')
+
+# Handle._run steps tasks and callbacks; frames below it are loop machinery
+_HANDLE_RUN_FILE = asyncio.events.__file__
+_SELECTORS_FILE = selectors.__file__
+
+class SyncProfiler:
+    """
+    One profiling session over the event-loop thread that started it
+    Sampling overhead is bounded by the interval (one stack walk per tick) and by
+    max_samples, after which sampling stops
+    """
+    
+    def __init__(self, output_dir: str, mode: str = 'sample', interval: float = 0.01,
+                 max_syncs: Optional[int] = None, max_samples: int = 200_000):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}")
+        
+        self.output_dir = output_dir
+        self.mode = mode
+        self.interval = interval
+        self.max_syncs = max_syncs
+        self.max_samples = max_samples
+        
+        self.syncs_finished = 0
+        self.samples = 0
+        self.sampling_seconds = 0.0  # time the sampler spent holding the GIL
+        # (vendor, phase) -> folded stack -> samples
+        self.stacks: Dict[Tuple[str, str], Dict[Tuple[str, ...], int]] = {}
+        
+        self.started_at: Optional[datetime] = None
+        self._started = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._labels: Dict[Any, str] = {}  # code object -> frame label
+    
+    def start(self):
+        """Begin profiling the calling thread's running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        
+        if self.mode == 'cprofile':
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        else:
+            self._thread = threading.Thread(
+                target=self._sample_loop, name='sync-profiler', daemon=True
+            )
+            self._thread.start()
+        logger.info(f"Sync profiling started ({self.mode}, output {self.output_dir})")
+    
+    def sync_finished(self) -> bool:
+        """Count a completed sync; True once the session's sync budget is used up"""
+        self.syncs_finished += 1
+        return self.max_syncs is not None and self.syncs_finished >= self.max_syncs
+    
+    def _frame_label(self, frame) -> str:
+        code = frame.f_code
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = (
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+        return label
+    
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            started = time.perf_counter()
+            self._sample()
+            self.sampling_seconds += time.perf_counter() - started
+            if self.samples >= self.max_samples:
+                logger.warning(f"Sync profiler reached {self.max_samples} samples; sampling stopped")
+                return
+    
+    def _sample(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        
+        idle = frame.f_code.co_filename == _SELECTORS_FILE
+        stack: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            if code.co_name == '_run' and code.co_filename == _HANDLE_RUN_FILE:
+                break
+            stack.append(self._frame_label(frame))
+            frame = frame.f_back
+        stack.reverse()
+        
+        task = asyncio.current_task(self._loop)
+        trace = task_trace(task)
+        if trace is not None:
+            active = trace.active
+            key = (trace.vendor, active.name if active is not None else 'sync')
+        elif task is not None:
+            key = ('untraced', 'task')
+        else:
+            # Between task steps: selector wait, callbacks, I/O handling
+            key = ('loop', 'idle' if idle else 'callbacks')
+        
+        if task is not None:
+            coro = task.get_coro()
+            stack.insert(0, f"task:{getattr(coro, '__qualname__', task.get_name())}")
+        
+        folded = self.stacks.setdefault(key, {})
+        stack_key = tuple(stack)
+        folded[stack_key] = folded.get(stack_key, 0) + 1
+        self.samples += 1
+    
+    def stop(self) -> Dict[str, Any]:
+        """End the session and write its output; returns a summary with the file paths"""
+        elapsed = time.perf_counter() - self._started
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+        
+        session_dir = os.path.join(
+            self.output_dir, f"profile-{self.started_at:%Y%m%d-%H%M%S}-{self.mode}"
+        )
+        os.makedirs(session_dir, exist_ok=True)
+        files = []
+        
+        if self._cprofile is not None:
+            path = os.path.join(session_dir, 'loop.prof')
+            self._cprofile.dump_stats(path)
+            files.append(path)
+        
+        samples_by_phase = {}
+        for (vendor, phase), folded in sorted(self.stacks.items()):
+            path = os.path.join(session_dir, f"{vendor}.{phase}.folded")
+            with open(path, 'w') as folded_file:
+                for stack, count in sorted(folded.items(), key=lambda item: -item[1]):
+                    folded_file.write(f"{';'.join(stack)} {count}\n")
+            files.append(path)
+            samples_by_phase[f"{vendor}.{phase}"] = sum(folded.values())
+        
+        summary = {
+            'mode': self.mode,
+            'started_at': self.started_at.isoformat(),
+            'duration_seconds': elapsed,
+            'syncs': self.syncs_finished,
+            'interval_seconds': self.interval,
+            'samples': self.samples,
+            'samples_by_phase': samples_by_phase,
+            'sampler_overhead': self.sampling_seconds / elapsed if elapsed else 0.0,
+            'files': files
+        }
+        with open(os.path.join(session_dir, 'summary.json'), 'w') as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        
+        logger.info(
+            f"Sync profiling stopped after {elapsed:.1f}s and {self.syncs_finished} syncs: "
+            f"{self.samples} samples written to {session_dir}"
+        )
+        return summary
@@ -0,0 +1,417 @@
+"""
+Vendor API quota accounting and budget planning
+Records actual calls per (vendor, user, app, window) and allocates the remaining
+budget across pending syncs by priority so low-priority work is deferred
+instead of running into 429 responses
+"""
+
+import math
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+from loguru import logger
+
+# Sync priorities (lower value is served first)
+PRIORITY_CLINICIAN_VIEWED = 0
+PRIORITY_SCHEDULED = 1
+PRIORITY_BACKFILL = 2
+
+DEFAULT_APP_ID = 'default'
+
+# Documents per day in each Oura v2 collection a sync reads (heart rate comes in
+# 5-minute windows) and the documents Oura returns per next_token page
+OURA_DOCUMENTS_PER_DAY = {'sleep': 2, 'daily_activity': 1, 'daily_readiness': 1, 'heartrate': 288}
+OURA_PAGE_SIZE = 100
+
+EPOCH = datetime(1970, 1, 1)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS quota_calls (
+    vendor TEXT NOT NULL,
+    app_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    window_start REAL NOT NULL,
+    calls INTEGER NOT NULL,
+    PRIMARY KEY (vendor, app_id, user_id, window_start)
+);
+CREATE TABLE IF NOT EXISTS quota_throttles (
+    vendor TEXT NOT NULL,
+    app_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    until REAL NOT NULL,
+    PRIMARY KEY (vendor, app_id, user_id)
+);
+"""
+
+# user_id under which app-wide totals and app-scoped back-offs are stored
+APP_ROW = ''
+
+def _seconds(moment: datetime) -> float:
+    return (moment - EPOCH).total_seconds()
+
+@dataclass
+class QuotaPolicy:
+    """Published rate limit for a vendor API"""
+    vendor: str
+    limit: int               # requests allowed per window
+    window: timedelta
+    scope: str = 'app'       # 'app' (shared by all users) or 'user' (per user)
+    reserve_fraction: float = 0.05  # headroom kept back for retries and refreshes
+    
+    @property
+    def usable_limit(self) -> int:
+        return int(self.limit * (1 - self.reserve_fraction))
+
+# Oura allows 5000 requests per day, Fitbit 150 requests per user per hour
+DEFAULT_POLICIES = {
+    'oura': QuotaPolicy('oura', 5000, timedelta(days=1), scope='app'),
+    'fitbit': QuotaPolicy('fitbit', 150, timedelta(hours=1), scope='user'),
+}
+
+@dataclass
+class SyncDemand:
+    """Predicted vendor calls for a queued sync"""
+    vendor: str
+    user_id: str
+    estimated_calls: int
+    priority: int = PRIORITY_SCHEDULED
+    due_at: datetime = field(default_factory=datetime.now)
+    app_id: str = DEFAULT_APP_ID
+
+@dataclass
+class QuotaDecision:
+    """Outcome of asking the planner whether a sync may run now"""
+    admitted: bool
+    estimated_calls: int
+    available_calls: int
+    retry_at: Optional[datetime] = None
+    reason: str = ''
+
+class QuotaLedger:
+    """
+    Counts vendor calls per (vendor, user, app, window)
+    Windows are aligned to the vendor policy so counts reset naturally
+    """
+    
+    def __init__(self, policies: Dict[str, QuotaPolicy] = None):
+        self.policies = dict(policies or DEFAULT_POLICIES)
+        
+        # (vendor, user_id, app_id, window_start) -> calls
+        self.user_calls: Dict[Tuple[str, str, str, datetime], int] = {}
+        # (vendor, app_id, window_start) -> calls, kept alongside for O(1) app totals
+        self.app_calls: Dict[Tuple[str, str, datetime], int] = {}
+        # (vendor, user_id or None, app_id) -> time until which the vendor told us to back off
+        self.throttled_until: Dict[Tuple[str, Optional[str], str], datetime] = {}
+        self.throttle_events: Dict[str, int] = {}
+        self._last_prune = datetime.now()
+    
+    def window_start(self, vendor: str, at: datetime = None) -> datetime:
+        """Start of the quota window containing `at`"""
+        at = at or datetime.now()
+        policy = self.policies.get(vendor)
+        if not policy:
+            return at
+        
+        window_seconds = policy.window.total_seconds()
+        elapsed = _seconds(at)
+        return EPOCH + timedelta(seconds=elapsed - (elapsed % window_seconds))
+    
+    def next_window(self, vendor: str, at: datetime = None) -> datetime:
+        """Start of the window after the one containing `at`"""
+        policy = self.policies.get(vendor)
+        start = self.window_start(vendor, at)
+        return start + policy.window if policy else start
+    
+    def record_call(self, vendor: str, user_id: str, app_id: str = DEFAULT_APP_ID,
+                    at: datetime = None, status: int = None):
+        """Record a single vendor API call"""
+        at = at or datetime.now()
+        window = self.window_start(vendor, at)
+        
+        # Expired windows are dropped hourly so long-running workers stay bounded
+        if at - self._last_prune > timedelta(hours=1):
+            self.prune(at)
+        
+        user_key = (vendor, user_id, app_id, window)
+        self.user_calls[user_key] = self.user_calls.get(user_key, 0) + 1
+        
+        app_key = (vendor, app_id, window)
+        self.app_calls[app_key] = self.app_calls.get(app_key, 0) + 1
+        
+        if status == 429:
+            self.throttle_events[vendor] = self.throttle_events.get(vendor, 0) + 1
+    
+    def record_throttle(self, vendor: str, user_id: Optional[str], retry_after: float,
+                        app_id: str = DEFAULT_APP_ID, at: datetime = None):
+        """Remember a vendor-imposed back-off so the planner stops admitting work"""
+        at = at or datetime.now()
+        policy = self.policies.get(vendor)
+        scope_user = user_id if policy and policy.scope == 'user' else None
+        until = at + timedelta(seconds=retry_after)
+        
+        key = (vendor, scope_user, app_id)
+        self.throttled_until[key] = max(until, self.throttled_until.get(key, until))
+    
+    def used(self, vendor: str, user_id: str = None, app_id: str = DEFAULT_APP_ID,
+             at: datetime = None) -> int:
+        """Calls used in the current window, for the user or the whole app"""
+        window = self.window_start(vendor, at)
+        if user_id is None:
+            return self.app_calls.get((vendor, app_id, window), 0)
+        return self.user_calls.get((vendor, user_id, app_id, window), 0)
+    
+    def remaining(self, vendor: str, user_id: str, app_id: str = DEFAULT_APP_ID,
+                  at: datetime = None) -> int:
+        """Calls still usable in the current window under the vendor's scope"""
+        policy = self.policies.get(vendor)
+        if not policy:
+            return 1 << 30  # unmetered vendor
+        
+        if policy.scope == 'user':
+            used = self.used(vendor, user_id, app_id, at)
+        else:
+            used = self.used(vendor, None, app_id, at)
+        return max(policy.usable_limit - used, 0)
+    
+    def throttled(self, vendor: str, user_id: str, app_id: str = DEFAULT_APP_ID,
+                  at: datetime = None) -> Optional[datetime]:
+        """Time until which the vendor asked us to back off, if still in effect"""
+        at = at or datetime.now()
+        for key in ((vendor, None, app_id), (vendor, user_id, app_id)):
+            until = self.throttled_until.get(key)
+            if until and until > at:
+                return until
+        return None
+    
+    def prune(self, at: datetime = None):
+        """Drop counters from windows that have fully elapsed"""
+        at = at or datetime.now()
+        self._last_prune = at
+        
+        self.user_calls = {
+            key: calls for key, calls in self.user_calls.items()
+            if key[3] >= self.window_start(key[0], at)
+        }
+        self.app_calls = {
+            key: calls for key, calls in self.app_calls.items()
+            if key[2] >= self.window_start(key[0], at)
+        }
+        self.throttled_until = {
+            key: until for key, until in self.throttled_until.items() if until > at
+        }
+    
+    def close(self):
+        """Nothing to release in memory; SharedQuotaLedger closes its database"""
+
+class SharedQuotaLedger(QuotaLedger):
+    """
+    QuotaLedger whose call counts and back-offs live in a SQLite file, so every
+    process that opens the same file spends one budget (e.g. the workers of a
+    sharded deployment sharing an app-wide daily limit)
+    """
+    
+    def __init__(self, path: str, policies: Dict[str, QuotaPolicy] = None):
+        super().__init__(policies)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA busy_timeout=2000')
+        self.db.executescript(SCHEMA)
+    
+    def record_call(self, vendor: str, user_id: str, app_id: str = DEFAULT_APP_ID,
+                    at: datetime = None, status: int = None):
+        at = at or datetime.now()
+        window = _seconds(self.window_start(vendor, at))
+        if at - self._last_prune > timedelta(hours=1):
+            self.prune(at)
+        
+        # The user's and the app's counters move together in one transaction
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO quota_calls VALUES (?, ?, ?, ?, 1) '
+                'ON CONFLICT (vendor, app_id, user_id, window_start) DO UPDATE SET calls = calls + 1',
+                [(vendor, app_id, user_id, window), (vendor, app_id, APP_ROW, window)]
+            )
+        
+        if status == 429:
+            self.throttle_events[vendor] = self.throttle_events.get(vendor, 0) + 1
+    
+    def record_throttle(self, vendor: str, user_id: Optional[str], retry_after: float,
+                        app_id: str = DEFAULT_APP_ID, at: datetime = None):
+        at = at or datetime.now()
+        policy = self.policies.get(vendor)
+        scope_user = user_id if policy and policy.scope == 'user' else APP_ROW
+        with self.db:
+            self.db.execute(
+                'INSERT INTO quota_throttles VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (vendor, app_id, user_id) DO UPDATE SET until = max(until, excluded.until)',
+                (vendor, app_id, scope_user, _seconds(at) + retry_after)
+            )
+    
+    def used(self, vendor: str, user_id: str = None, app_id: str = DEFAULT_APP_ID,
+             at: datetime = None) -> int:
+        row = self.db.execute(
+            'SELECT calls FROM quota_calls '
+            'WHERE vendor = ? AND app_id = ? AND user_id = ? AND window_start = ?',
+            (vendor, app_id, APP_ROW if user_id is None else user_id,
+             _seconds(self.window_start(vendor, at)))
+        ).fetchone()
+        return row[0] if row else 0
+    
+    def throttled(self, vendor: str, user_id: str, app_id: str = DEFAULT_APP_ID,
+                  at: datetime = None) -> Optional[datetime]:
+        row = self.db.execute(
+            'SELECT max(until) FROM quota_throttles '
+            'WHERE vendor = ? AND app_id = ? AND user_id IN (?, ?) AND until > ?',
+            (vendor, app_id, APP_ROW, user_id, _seconds(at or datetime.now()))
+        ).fetchone()
+        return EPOCH + timedelta(seconds=row[0]) if row[0] is not None else None
+    
+    def prune(self, at: datetime = None):
+        at = at or datetime.now()
+        self._last_prune = at
+        with self.db:
+            for vendor in self.policies:
+                self.db.execute(
+                    'DELETE FROM quota_calls WHERE vendor = ? AND window_start < ?',
+                    (vendor, _seconds(self.window_start(vendor, at)))
+                )
+            self.db.execute('DELETE FROM quota_throttles WHERE until <= ?', (_seconds(at),))
+    
+    def close(self):
+        self.db.close()
+
+class QuotaPlanner:
+    """
+    Allocates the remaining vendor budget across queued syncs by priority
+    """
+    
+    def __init__(self, ledger: QuotaLedger = None, oura_page_size: int = OURA_PAGE_SIZE):
+        self.ledger = ledger or QuotaLedger()
+        self.oura_page_size = oura_page_size
+        
+        # Pending demand from the scheduler queue: (vendor, user_id, app_id) -> demand
+        self.pending: Dict[Tuple[str, str, str], SyncDemand] = {}
+    
+    def estimate_calls(self, vendor: str, start_date: datetime, end_date: datetime) -> int:
+        """Predict how many vendor calls a sync of the date range will make"""
+        days = max((end_date.date() - start_date.date()).days + 1, 1)
+        
+        if vendor == 'fitbit':
+            # Activity, heart rate and sleep are fetched per day, weight once per range
+            return 3 * days + 1
+        if vendor == 'oura':
+            # Each collection is paged, so calls grow with the window's documents
+            return sum(
+                max(math.ceil(per_day * days / self.oura_page_size), 1)
+                for per_day in OURA_DOCUMENTS_PER_DAY.values()
+            )
+        if vendor == 'apple':
+            # Exports are read from local files, not fetched from a vendor API
+            return 0
+        return days
+    
+    def enqueue(self, demand: SyncDemand):
+        """Register a sync the scheduler intends to run"""
+        self.pending[(demand.vendor, demand.user_id, demand.app_id)] = demand
+    
+    def dequeue(self, vendor: str, user_id: str, app_id: str = DEFAULT_APP_ID):
+        """Remove a demand once its sync has run or been cancelled"""
+        self.pending.pop((vendor, user_id, app_id), None)
+    
+    def predicted_demand(self, vendor: str, app_id: str = DEFAULT_APP_ID,
+                         until: datetime = None) -> int:
+        """Total calls queued for the vendor and due before `until`"""
+        until = until or self.ledger.next_window(vendor)
+        return sum(
+            demand.estimated_calls for demand in self.pending.values()
+            if demand.vendor == vendor and demand.app_id == app_id and demand.due_at < until
+        )
+    
+    def allocate(self, vendor: str, app_id: str = DEFAULT_APP_ID,
+                 at: datetime = None) -> Dict[str, int]:
+        """
+        Split the remaining budget of the current window across pending demand
+        Higher priority (then earlier due) demand is served first
+        """
+        at = at or datetime.now()
+        policy = self.ledger.policies.get(vendor)
+        window_end = self.ledger.next_window(vendor, at)
+        
+        queued = sorted(
+            (d for d in self.pending.values()
+             if d.vendor == vendor and d.app_id == app_id and d.due_at < window_end),
+            key=lambda d: (d.priority, d.due_at)
+        )
+        
+        allocation = {}
+        app_remaining = self.ledger.remaining(vendor, None, app_id, at)
+        user_remaining: Dict[str, int] = {}
+        
+        for demand in queued:
+            if policy and policy.scope == 'user':
+                budget = user_remaining.setdefault(
+                    demand.user_id, self.ledger.remaining(vendor, demand.user_id, app_id, at)
+                )
+            else:
+                budget = app_remaining
+            
+            granted = min(demand.estimated_calls, budget)
+            allocation[demand.user_id] = allocation.get(demand.user_id, 0) + granted
+            
+            if policy and policy.scope == 'user':
+                user_remaining[demand.user_id] = budget - granted
+            else:
+                app_remaining = budget - granted
+        
+        return allocation
+    
+    def admit(self, vendor: str, user_id: str, estimated_calls: int,
+              priority: int = PRIORITY_SCHEDULED, app_id: str = DEFAULT_APP_ID,
+              at: datetime = None) -> QuotaDecision:
+        """
+        Decide whether a sync may run now or should be deferred to a later window
+        """
+        at = at or datetime.now()
+        policy = self.ledger.policies.get(vendor)
+        
+        if not policy:
+            return QuotaDecision(True, estimated_calls, estimated_calls)
+        
+        throttled_until = self.ledger.throttled(vendor, user_id, app_id, at)
+        if throttled_until:
+            return QuotaDecision(
+                False, estimated_calls, 0, retry_at=throttled_until,
+                reason=f"{vendor} asked to back off until {throttled_until.isoformat()}"
+            )
+        
+        available = self.ledger.remaining(vendor, user_id, app_id, at)
+        
+        # Budget already promised to higher-priority syncs queued in this window
+        if policy.scope == 'app':
+            window_end = self.ledger.next_window(vendor, at)
+            reserved = sum(
+                d.estimated_calls for d in self.pending.values()
+                if d.vendor == vendor and d.app_id == app_id and d.user_id != user_id
+                and d.priority < priority and d.due_at < window_end
+            )
+            available = max(available - reserved, 0)
+        
+        # Syncs larger than a whole window only need a fresh window to start;
+        # the integration's own pacing spreads the rest over following windows
+        required = min(estimated_calls, policy.usable_limit)
+        
+        if available >= required:
+            return QuotaDecision(True, estimated_calls, available)
+        
+        retry_at = self.ledger.next_window(vendor, at)
+        logger.info(
+            f"Deferring {vendor} sync for {user_id} (priority {priority}): "
+            f"needs {required} calls, {available} available until {retry_at}"
+        )
+        return QuotaDecision(
+            False, estimated_calls, available, retry_at=retry_at,
+            reason=f"{vendor} quota exhausted for current window"
+        )
@@ -0,0 +1,260 @@
+"""
+Incremental minute/hour/day rollups for intraday metrics
+Keeps count, sum, min, max and mean per (user, metric_type, bucket), plus a quantile
+sketch for hour and day buckets (a sketch per minute would cost more than the samples)
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+from .sketches import QuantileSketch
+
+# Rollup granularities in seconds, finest first
+GRANULARITIES = {
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+# Granularities whose buckets carry a quantile sketch
+SKETCH_GRANULARITIES = ('hour', 'day')
+
+# Metrics whose daily value is a total rather than an average
+ADDITIVE_METRICS = {'steps', 'calories_burned', 'distance_km', 'active_minutes'}
+
+EPOCH = datetime(1970, 1, 1)
+
+def epoch_seconds(timestamp: datetime) -> float:
+    """Seconds since epoch for naive (local wall clock) or aware timestamps"""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return (timestamp - EPOCH).total_seconds()
+
+def resolution_seconds(resolution: Union[str, timedelta]) -> int:
+    """Convert 'minute'/'hour'/'day' or a timedelta to whole seconds"""
+    if isinstance(resolution, timedelta):
+        return int(resolution.total_seconds())
+    if resolution not in GRANULARITIES:
+        raise ValueError(f"Unknown resolution: {resolution}")
+    return GRANULARITIES[resolution]
+
+@dataclass
+class RollupBucket:
+    """Mergeable summary of the samples that fall in one time bucket"""
+    count: int = 0
+    sum: float = 0.0
+    min: Optional[float] = None
+    max: Optional[float] = None
+    quality_sum: float = 0.0
+    sketch: Optional[QuantileSketch] = None  # None for unsketched (minute) buckets
+    
+    @property
+    def mean(self) -> Optional[float]:
+        return self.sum / self.count if self.count else None
+    
+    @property
+    def mean_quality(self) -> float:
+        return self.quality_sum / self.count if self.count else 0.0
+    
+    def add(self, value: float, quality: float = 1.0):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.quality_sum += quality
+        if self.sketch is not None:
+            self.sketch.add(value)
+    
+    def merge(self, other: 'RollupBucket'):
+        if not other.count:
+            return
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.quality_sum += other.quality_sum
+        if other.sketch is not None:
+            if self.sketch is None:
+                self.sketch = QuantileSketch()
+            self.sketch.merge(other.sketch)
+    
+    def percentile(self, q: float) -> Optional[float]:
+        return self.sketch.quantile(q) if self.sketch is not None else None
+    
+    def value(self, metric_type: str) -> Optional[float]:
+        """Representative value: total for additive metrics, mean otherwise"""
+        return self.sum if metric_type in ADDITIVE_METRICS else self.mean
+
+# (user_id, metric_type, source_device, granularity)
+RollupKey = Tuple[str, str, str, str]
+
+class RollupEngine:
+    """
+    Maintains rollups at every granularity as samples are ingested
+    """
+    
+    def __init__(self, granularities: List[str] = None):
+        self.granularities = granularities or list(GRANULARITIES)
+        self.rollups: Dict[RollupKey, Dict[int, RollupBucket]] = {}
+        # (user_id, metric_type) -> contributing devices
+        self._sources: Dict[Tuple[str, str], set] = {}
+    
+    def ingest(self, user_id: str, metric_type: str, source_device: str,
+               timestamp: datetime, value: float, quality: float = 1.0):
+        """Fold one sample into every granularity"""
+        seconds = epoch_seconds(timestamp)
+        self._sources.setdefault((user_id, metric_type), set()).add(source_device)
+        
+        for granularity in self.granularities:
+            width = GRANULARITIES[granularity]
+            buckets = self.rollups.setdefault(
+                (user_id, metric_type, source_device, granularity), {}
+            )
+            bucket_start = int(seconds // width) * width
+            bucket = buckets.get(bucket_start)
+            if bucket is None:
+                bucket = buckets[bucket_start] = RollupBucket(
+                    sketch=QuantileSketch() if granularity in SKETCH_GRANULARITIES else None
+                )
+            bucket.add(value, quality)
+    
+    def ingest_arrays(self, user_id: str, metric_type: str, source_device: str,
+                      seconds: np.ndarray, values: np.ndarray, quality: np.ndarray):
+        """Fold a time-sorted batch into every granularity, one merge per bucket"""
+        if not len(values):
+            return
+        self._sources.setdefault((user_id, metric_type), set()).add(source_device)
+        
+        for granularity in self.granularities:
+            width = GRANULARITIES[granularity]
+            buckets = self.rollups.setdefault(
+                (user_id, metric_type, source_device, granularity), {}
+            )
+            bucket_ids = (seconds // width).astype(np.int64) * width
+            starts = np.flatnonzero(np.r_[True, np.diff(bucket_ids) != 0])
+            ends = np.r_[starts[1:], len(values)]
+            
+            sums = np.add.reduceat(values, starts)
+            lows = np.minimum.reduceat(values, starts)
+            highs = np.maximum.reduceat(values, starts)
+            quality_sums = np.add.reduceat(quality, starts)
+            
+            sketched = granularity in SKETCH_GRANULARITIES
+            for i, (lo, hi) in enumerate(zip(starts.tolist(), ends.tolist())):
+                partial = RollupBucket(
+                    count=hi - lo, sum=float(sums[i]), min=float(lows[i]),
+                    max=float(highs[i]), quality_sum=float(quality_sums[i])
+                )
+                if sketched:
+                    partial.sketch = QuantileSketch()
+                    partial.sketch.add_many(values[lo:hi])
+                
+                bucket_start = int(bucket_ids[lo])
+                if bucket_start in buckets:
+                    buckets[bucket_start].merge(partial)
+                else:
+                    buckets[bucket_start] = partial
+    
+    def rebuild(self, user_id: str, metric_type: str, source_device: str,
+                samples: List[Tuple[datetime, float, float]],
+                start: datetime, end: datetime):
+        """
+        Recompute the buckets covering [start, end) from raw samples
+        Used when stored samples are revised, since min/max cannot be retracted
+        """
+        start_seconds = epoch_seconds(start)
+        end_seconds = epoch_seconds(end)
+        
+        for granularity in self.granularities:
+            width = GRANULARITIES[granularity]
+            buckets = self.rollups.setdefault(
+                (user_id, metric_type, source_device, granularity), {}
+            )
+            first = int(start_seconds // width) * width
+            for bucket_start in range(first, int(end_seconds), width):
+                buckets.pop(bucket_start, None)
+        
+        for timestamp, value, quality in samples:
+            if start_seconds <= epoch_seconds(timestamp) < end_seconds:
+                self.ingest(user_id, metric_type, source_device, timestamp, value, quality)
+    
+    def coarsest_granularity(self, start: datetime, end: datetime,
+                             resolution: Union[str, timedelta]) -> str:
+        """
+        Pick the coarsest rollup that divides the resolution and aligns with the range
+        """
+        step = resolution_seconds(resolution)
+        start_seconds = epoch_seconds(start)
+        end_seconds = epoch_seconds(end)
+        
+        for granularity in sorted(self.granularities, key=GRANULARITIES.get, reverse=True):
+            width = GRANULARITIES[granularity]
+            if (step % width == 0 and start_seconds % width == 0
+                    and end_seconds % width == 0):
+                return granularity
+        
+        return min(self.granularities, key=GRANULARITIES.get)
+    
+    def query(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+              resolution: Union[str, timedelta] = 'day',
+              source_devices: List[str] = None) -> List[Tuple[datetime, RollupBucket]]:
+        """
+        Summaries for [start, end) at the requested resolution, served from the
+        coarsest rollup that answers the query. Sources are merged when several are given.
+        A single source at its stored granularity returns the stored buckets (read-only).
+        """
+        granularity = self.coarsest_granularity(start, end, resolution)
+        step = resolution_seconds(resolution)
+        start_seconds = epoch_seconds(start)
+        end_seconds = epoch_seconds(end)
+        
+        if source_devices is None:
+            source_devices = self.sources(user_id, metric_type)
+        
+        width = GRANULARITIES[granularity]
+        first = int(-(-start_seconds // width)) * width
+        span = range(first, int(end_seconds), width)
+        
+        merged: Dict[int, RollupBucket] = {}
+        for source_device in source_devices:
+            buckets = self.rollups.get((user_id, metric_type, source_device, granularity), {})
+            
+            # Probe the range directly when it is smaller than the stored history
+            if len(span) < len(buckets):
+                in_range = ((b, buckets[b]) for b in span if b in buckets)
+            else:
+                in_range = (
+                    (b, bucket) for b, bucket in buckets.items()
+                    if start_seconds <= b < end_seconds
+                )
+            
+            if len(source_devices) == 1 and step == width:
+                # Nothing to merge: hand back the stored buckets without copying sketches
+                return [
+                    (EPOCH + timedelta(seconds=bucket_start), bucket)
+                    for bucket_start, bucket in sorted(in_range, key=lambda b: b[0])
+                ]
+            
+            for bucket_start, bucket in in_range:
+                out_start = int(start_seconds + (bucket_start - start_seconds) // step * step)
+                target = merged.get(out_start)
+                if target is None:
+                    target = merged[out_start] = RollupBucket()
+                target.merge(bucket)
+        
+        return [
+            (EPOCH + timedelta(seconds=bucket_start), merged[bucket_start])
+            for bucket_start in sorted(merged)
+        ]
+    
+    def drop_users(self, user_ids: Set[str]):
+        """Forget every rollup of the given users"""
+        self.rollups = {key: buckets for key, buckets in self.rollups.items() if key[0] not in user_ids}
+        self._sources = {key: devices for key, devices in self._sources.items() if key[0] not in user_ids}
+    
+    def sources(self, user_id: str, metric_type: str) -> List[str]:
+        """Devices that have contributed rollups for the user's metric"""
+        return sorted(self._sources.get((user_id, metric_type), ()))
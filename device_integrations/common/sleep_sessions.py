@@ -0,0 +1,172 @@
+"""
+Cross-device sleep-session stitching
+Sleep sessions are kept per user and swept in start order: overlapping sessions from
+different devices are matched, fragmented nights and naps are merged, and each wake
+date resolves to one canonical night
+"""
+
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+@dataclass
+class SleepSession:
+    """One sleep period as reported by a device"""
+    user_id: str
+    source_device: str
+    start: datetime
+    end: datetime
+    sleep_hours: float                 # time asleep, excluding awake periods
+    efficiency: Optional[float] = None  # percent
+    session_id: Optional[str] = None
+    is_main_sleep: bool = True
+    quality_score: float = 1.0
+    
+    def __post_init__(self):
+        # Night boundaries are judged on the sleeper's wall clock
+        self.start = _wall_clock(self.start)
+        self.end = _wall_clock(self.end)
+    
+    @property
+    def key(self) -> Tuple[str, str]:
+        return (self.source_device, self.session_id or self.start.isoformat())
+
+@dataclass
+class CanonicalNight:
+    """Stitched sleep for one wake date"""
+    user_id: str
+    date: date
+    start: datetime
+    end: datetime
+    sleep_hours: float
+    efficiency: Optional[float]
+    source_device: str                  # device whose measurement was used
+    nap_hours: float = 0.0
+    fragments: int = 1                  # sessions merged into the main night
+    devices: List[str] = field(default_factory=list)
+    
+    @property
+    def total_sleep_hours(self) -> float:
+        return self.sleep_hours + self.nap_hours
+
+def _wall_clock(timestamp: datetime) -> datetime:
+    return timestamp.replace(tzinfo=None) if timestamp.tzinfo else timestamp
+
+class SleepStitcher:
+    """
+    Per-user sleep-session index producing one canonical night per wake date
+    """
+    
+    def __init__(self, rank_table: Dict[Tuple[str, str], int] = None,
+                 fragment_gap: timedelta = timedelta(minutes=90),
+                 main_sleep_min_hours: float = 3.0):
+        self.rank_table = rank_table or {}
+        self.fragment_gap = fragment_gap
+        self.main_sleep_min_hours = main_sleep_min_hours
+        
+        # user_id -> session key -> session
+        self.sessions: Dict[str, Dict[Tuple[str, str], SleepSession]] = {}
+        # Derived per-user state, rebuilt lazily after new sessions arrive
+        self._nights: Dict[str, Dict[date, CanonicalNight]] = {}
+    
+    def add(self, session: SleepSession):
+        """Add or replace (on re-sync) a device's sleep session"""
+        self.sessions.setdefault(session.user_id, {})[session.key] = session
+        self._nights.pop(session.user_id, None)
+    
+    def add_many(self, sessions: List[SleepSession]):
+        for session in sessions:
+            self.add(session)
+    
+    def drop_users(self, user_ids: Set[str]):
+        for user_id in user_ids:
+            self.sessions.pop(user_id, None)
+            self._nights.pop(user_id, None)
+    
+    def _rank(self, device: str) -> int:
+        return self.rank_table.get(('sleep_duration', device), 1 << 16)
+    
+    def _cluster_summary(self, cluster: List[SleepSession]) -> Tuple[float, Optional[float], str, List[str]]:
+        """Sleep hours and efficiency from the best-ranked device in a cluster"""
+        by_device: Dict[str, List[SleepSession]] = {}
+        for session in cluster:
+            by_device.setdefault(session.source_device, []).append(session)
+        
+        device = min(by_device, key=lambda d: (
+            self._rank(d), -sum(s.quality_score for s in by_device[d]) / len(by_device[d])
+        ))
+        chosen = by_device[device]
+        hours = sum(s.sleep_hours for s in chosen)
+        
+        weighted = [(s.efficiency, s.sleep_hours) for s in chosen if s.efficiency is not None]
+        weight = sum(w for _, w in weighted)
+        efficiency = sum(e * w for e, w in weighted) / weight if weight else None
+        
+        return hours, efficiency, device, sorted(by_device)
+    
+    def _build_nights(self, user_id: str) -> Dict[date, CanonicalNight]:
+        sessions = sorted(self.sessions.get(user_id, {}).values(), key=lambda s: s.start)
+        
+        # Sweep: sessions that overlap (from any device) or sit within the fragment gap
+        # form one cluster
+        clusters: List[List[SleepSession]] = []
+        cluster_end = None
+        for session in sessions:
+            if clusters and session.start <= cluster_end + self.fragment_gap:
+                clusters[-1].append(session)
+                cluster_end = max(cluster_end, session.end)
+            else:
+                clusters.append([session])
+                cluster_end = session.end
+        
+        by_date: Dict[date, List[Tuple[List[SleepSession], float]]] = {}
+        for cluster in clusters:
+            wake_date = max(s.end for s in cluster).date()
+            span = (max(s.end for s in cluster) - cluster[0].start).total_seconds() / 3600
+            by_date.setdefault(wake_date, []).append((cluster, span))
+        
+        nights = {}
+        for wake_date, candidates in by_date.items():
+            # Longest cluster is the night; the rest of that date's sleep counts as naps
+            candidates.sort(key=lambda c: c[1], reverse=True)
+            main, _ = candidates[0]
+            hours, efficiency, device, devices = self._cluster_summary(main)
+            
+            nap_hours = 0.0
+            for nap, span in candidates[1:]:
+                nap_hours += self._cluster_summary(nap)[0]
+            
+            # A date with only short daytime sleep has no main night
+            if hours < self.main_sleep_min_hours and all(not s.is_main_sleep for s in main):
+                nap_hours += hours
+                hours = 0.0
+            
+            nights[wake_date] = CanonicalNight(
+                user_id=user_id,
+                date=wake_date,
+                start=main[0].start,
+                end=max(s.end for s in main),
+                sleep_hours=hours,
+                efficiency=efficiency,
+                source_device=device,
+                nap_hours=nap_hours,
+                fragments=len({s.key for s in main if s.source_device == device}),
+                devices=devices
+            )
+        
+        return nights
+    
+    def nights(self, user_id: str) -> Dict[date, CanonicalNight]:
+        """All canonical nights for a user, keyed by wake date"""
+        nights = self._nights.get(user_id)
+        if nights is None:
+            nights = self._nights[user_id] = self._build_nights(user_id)
+        return nights
+    
+    def night(self, user_id: str, wake_date: date) -> Optional[CanonicalNight]:
+        """Canonical night ending on the given date (dictionary lookup once built)"""
+        return self.nights(user_id).get(wake_date)
+    
+    def nights_between(self, user_id: str, start_date: date, end_date: date) -> List[CanonicalNight]:
+        nights = self.nights(user_id)
+        return [nights[d] for d in sorted(nights) if start_date <= d <= end_date]
@@ -0,0 +1,147 @@
+"""
+Fixed-size per-user sync history
+Keeps the last N sync outcomes and error messages in ring buffers plus running
+counters per interned error class, so a profile's memory stays bounded however long
+the worker runs and summaries never scan the history
+"""
+
+import sys
+from collections import deque
+from datetime import datetime
+from itertools import islice
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+from .base_device import SyncResult
+
+HISTORY_SIZE = 32
+ERROR_HISTORY_SIZE = 8
+MAX_ERROR_MESSAGE = 240
+
+# Error strings reported in SyncResult.errors, by leading text -> error class
+ERROR_PREFIXES = (
+    ('Deferred', 'deferred'),
+    ('Token refresh failed', 'token_refresh'),
+    ('No Apple Health export', 'missing_export'),
+    ('No export.xml', 'missing_export'),
+    ('Cannot connect', 'connection'),
+    ('Locked', 'locked'),
+    ('Lease lost', 'lease_lost'),
+)
+
+def classify_error(error: Union[str, BaseException]) -> str:
+    """Low-cardinality, interned class for an error message or exception"""
+    if isinstance(error, BaseException):
+        return sys.intern(type(error).__name__)
+    for prefix, error_class in ERROR_PREFIXES:
+        if error.startswith(prefix):
+            return error_class
+    return 'sync_error'
+
+# (finished at epoch seconds, device type, success, metrics synced, error class or None)
+SyncEntry = Tuple[float, str, bool, int, Optional[str]]
+
+class SyncHistory:
+    """Ring buffers of recent sync outcomes and errors with O(1) aggregates"""
+    __slots__ = ('entries', 'errors', 'error_counts', 'total_syncs', 'failed_syncs',
+                 'consecutive_failures')
+    
+    def __init__(self, size: int = HISTORY_SIZE, error_size: int = ERROR_HISTORY_SIZE):
+        self.entries: Deque[SyncEntry] = deque(maxlen=size)
+        # (device type, error class, truncated message)
+        self.errors: Deque[Tuple[str, str, str]] = deque(maxlen=error_size)
+        self.error_counts: Dict[str, int] = {}
+        self.total_syncs = 0
+        self.failed_syncs = 0
+        # device type -> failures since its last success
+        self.consecutive_failures: Dict[str, int] = {}
+    
+    def record(self, device_type: str, result: SyncResult,
+               exception: Optional[BaseException] = None):
+        """Add one device sync result; `exception` is what the sync raised, if it did"""
+        device_type = sys.intern(device_type)
+        error_class = None
+        for error in result.errors:
+            error_class = classify_error(exception if exception is not None else error)
+            self.record_error(device_type, error_class, error)
+        
+        self.entries.append((
+            result.last_sync_time.timestamp(), device_type, result.success,
+            result.metrics_synced, error_class
+        ))
+        self.total_syncs += 1
+        if result.success:
+            self.consecutive_failures[device_type] = 0
+        else:
+            self.failed_syncs += 1
+            self.consecutive_failures[device_type] = self.consecutive_failures.get(device_type, 0) + 1
+    
+    def record_error(self, device_type: str, error_class: str, message: str):
+        self.errors.append((device_type, error_class, message[:MAX_ERROR_MESSAGE]))
+        self.error_counts[error_class] = self.error_counts.get(error_class, 0) + 1
+    
+    def recent_errors(self, n: int = 5) -> List[str]:
+        """The last n error messages as 'device: message', oldest first"""
+        start = max(len(self.errors) - n, 0)
+        return [f"{device}: {message}" for device, _, message in islice(self.errors, start, None)]
+    
+    def recent(self, n: int = HISTORY_SIZE) -> List[Dict[str, Any]]:
+        start = max(len(self.entries) - n, 0)
+        return [
+            {
+                'finished_at': datetime.fromtimestamp(finished),
+                'device_type': device_type,
+                'success': success,
+                'metrics_synced': metrics,
+                'error_class': error_class
+            }
+            for finished, device_type, success, metrics, error_class in
+            islice(self.entries, start, None)
+        ]
+    
+    @property
+    def success_rate(self) -> Optional[float]:
+        if not self.total_syncs:
+            return None
+        return 1 - self.failed_syncs / self.total_syncs
+    
+    def to_state(self) -> Dict[str, Any]:
+        """JSON-serializable snapshot, restored with from_state()"""
+        return {
+            'size': self.entries.maxlen,
+            'error_size': self.errors.maxlen,
+            'entries': list(self.entries),
+            'errors': list(self.errors),
+            'error_counts': self.error_counts,
+            'total_syncs': self.total_syncs,
+            'failed_syncs': self.failed_syncs,
+            'consecutive_failures': self.consecutive_failures
+        }
+    
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> 'SyncHistory':
+        history = cls(state.get('size', HISTORY_SIZE), state.get('error_size', ERROR_HISTORY_SIZE))
+        history.entries.extend(
+            (finished, sys.intern(device), success, metrics,
+             sys.intern(error_class) if error_class else None)
+            for finished, device, success, metrics, error_class in state.get('entries', [])
+        )
+        history.errors.extend(
+            (sys.intern(device), sys.intern(error_class), message)
+            for device, error_class, message in state.get('errors', [])
+        )
+        history.error_counts = {sys.intern(k): v for k, v in state.get('error_counts', {}).items()}
+        history.total_syncs = state.get('total_syncs', 0)
+        history.failed_syncs = state.get('failed_syncs', 0)
+        history.consecutive_failures = dict(state.get('consecutive_failures', {}))
+        return history
+    
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'total_syncs': self.total_syncs,
+            'failed_syncs': self.failed_syncs,
+            'success_rate': self.success_rate,
+            'error_counts': dict(self.error_counts),
+            'consecutive_failures': {
+                device: count for device, count in self.consecutive_failures.items() if count
+            }
+        }
@@ -0,0 +1,166 @@
+"""
+Per-(user, device) sync leases in a shared SQLite file
+A worker takes a lease before syncing a device and gives it back afterwards; leases
+expire after a TTL so a crashed holder never blocks anyone for longer than that.
+Every grant bumps the key's fencing token, and a holder re-checks its token before
+committing a sync's last_sync, so one whose lease lapsed mid-sync cannot move it past
+the newer holder's.
+The token does not fence metric store writes: a superseded sync's samples are already
+stored by the time it finds out. Re-synced samples are deduplicated, so this only
+matters when the two syncs saw different vendor revisions of the same record, and
+then the later write wins.
+Every method blocks on SQLite for up to busy_timeout, so callers on an event loop run
+them in a thread (asyncio.to_thread); a lock serializes the shared connection
+"""
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+# Default lease lifetime in seconds; holders renew at a third of it while syncing
+SYNC_LEASE_TTL = 120.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sync_leases (
+    user_id TEXT NOT NULL,
+    device_type TEXT NOT NULL,
+    holder TEXT,
+    token INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (user_id, device_type)
+);
+"""
+
+@dataclass
+class Lease:
+    """A granted lease; token is the fencing token (strictly increasing per key)"""
+    user_id: str
+    device_type: str
+    holder: str
+    token: int
+    expires_at: float  # epoch seconds
+    
+    @property
+    def remaining(self) -> float:
+        return self.expires_at - time.time()
+
+def default_holder() -> str:
+    """Identity unique to this process: host, pid and a random suffix"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+class LeaseStore:
+    """
+    Grants and tracks sync leases; processes that open the same file share them
+    Expiry uses the wall clock, so processes sharing a file need reasonably close
+    clocks (they share a host with a local file)
+    """
+    
+    def __init__(self, path: str = ':memory:', ttl: float = SYNC_LEASE_TTL,
+                 holder: str = None):
+        self.path = path
+        self.ttl = ttl
+        self.holder = holder or default_holder()
+        
+        # Autocommit, with explicit BEGIN IMMEDIATE around read-modify-write; usable
+        # from worker threads, one call at a time
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA busy_timeout=2000')
+        self.db.executescript(SCHEMA)
+        
+        # Leases this process holds, by (user_id, device_type)
+        self.held: Dict[Tuple[str, str], Lease] = {}
+    
+    def acquire(self, user_id: str, device_type: str,
+                ttl: float = None) -> Tuple[Optional[Lease], str]:
+        """
+        Try to take the lease without waiting
+        Returns (lease, 'acquired'), (lease, 'takeover') when an expired lease of
+        another holder was taken over, or (None, 'contended') while it is held
+        """
+        with self._lock:
+            lease, outcome = self._acquire(user_id, device_type, ttl)
+        if lease is not None:
+            self.held[(user_id, device_type)] = lease
+        return lease, outcome
+    
+    def _acquire(self, user_id: str, device_type: str,
+                 ttl: Optional[float]) -> Tuple[Optional[Lease], str]:
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.db.execute(
+                'SELECT holder, token, expires_at FROM sync_leases '
+                'WHERE user_id = ? AND device_type = ?', (user_id, device_type)
+            ).fetchone()
+            if row is not None and row[0] is not None and row[2] > now:
+                self.db.execute('COMMIT')
+                return None, 'contended'
+            
+            outcome = 'takeover' if row is not None and row[0] is not None else 'acquired'
+            lease = Lease(
+                user_id, device_type, self.holder,
+                (row[1] if row is not None else 0) + 1, now + (ttl or self.ttl)
+            )
+            self.db.execute(
+                'INSERT OR REPLACE INTO sync_leases VALUES (?, ?, ?, ?, ?)',
+                (user_id, device_type, lease.holder, lease.token, lease.expires_at)
+            )
+            self.db.execute('COMMIT')
+        except BaseException:
+            # BEGIN itself may have failed (e.g. busy), leaving nothing to roll back
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            raise
+        return lease, outcome
+    
+    def renew(self, lease: Lease, ttl: float = None) -> bool:
+        """
+        Extend a lease; False if it lapsed and was taken over (a newer token exists)
+        Doubles as the fencing check before committing work done under the lease
+        """
+        expires_at = time.time() + (ttl or self.ttl)
+        with self._lock:
+            renewed = self.db.execute(
+                'UPDATE sync_leases SET expires_at = ? '
+                'WHERE user_id = ? AND device_type = ? AND holder = ? AND token = ?',
+                (expires_at, lease.user_id, lease.device_type, lease.holder, lease.token)
+            ).rowcount == 1
+        if renewed:
+            lease.expires_at = expires_at
+        else:
+            self.held.pop((lease.user_id, lease.device_type), None)
+        return renewed
+    
+    def release(self, lease: Lease) -> bool:
+        """Give a lease back; the row and its token stay so tokens keep increasing"""
+        self.held.pop((lease.user_id, lease.device_type), None)
+        with self._lock:
+            return self.db.execute(
+                'UPDATE sync_leases SET holder = NULL, expires_at = 0 '
+                'WHERE user_id = ? AND device_type = ? AND holder = ? AND token = ?',
+                (lease.user_id, lease.device_type, lease.holder, lease.token)
+            ).rowcount == 1
+    
+    def current(self, user_id: str, device_type: str) -> Optional[Lease]:
+        """The unexpired lease on a key, whoever holds it"""
+        with self._lock:
+            row = self.db.execute(
+                'SELECT holder, token, expires_at FROM sync_leases '
+                'WHERE user_id = ? AND device_type = ? AND holder IS NOT NULL AND expires_at > ?',
+                (user_id, device_type, time.time())
+            ).fetchone()
+        return Lease(user_id, device_type, *row) if row is not None else None
+    
+    def close(self):
+        for lease in list(self.held.values()):
+            self.release(lease)
+        with self._lock:
+            self.db.close()
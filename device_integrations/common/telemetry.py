@@ -0,0 +1,376 @@
+"""
+In-process sync telemetry exposed in the Prometheus text format
+Counters, gauges and histograms are plain Python objects updated without locks (all
+updates happen on the event loop); labelled children are cached so a hot-path update
+costs one dict lookup and an addition
+"""
+
+import asyncio
+import bisect
+import math
+import re
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+from aiohttp import web
+from loguru import logger
+
+# Seconds; vendor calls take tens of milliseconds to tens of seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+WAIT_BUCKETS = (0.001, 0.01, 0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0)
+SYNC_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, 5.0, 30.0, 300.0)
+
+# Dates in vendor paths would give every request its own label value
+_DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+def normalize_endpoint(url: str) -> str:
+    """Low-cardinality endpoint label for a request URL (path only, dates templated)"""
+    return _DATE_PATTERN.sub('{date}', urlsplit(url).path or '/')
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _CounterChild:
+    __slots__ = ('value',)
+    
+    def __init__(self):
+        self.value = 0.0
+    
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+class _GaugeChild:
+    __slots__ = ('value',)
+    
+    def __init__(self):
+        self.value = 0.0
+    
+    def set(self, value: float):
+        self.value = value
+    
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+    
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Instrument(ABC):
+    """A named metric family; `labels(...)` returns the cached child for a label set"""
+    kind = 'untyped'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+    
+    @abstractmethod
+    def _new_child(self):
+        """Fresh child holding the values for one label set"""
+        pass
+    
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+    
+    @abstractmethod
+    def samples(self) -> List[Tuple[str, Tuple[str, ...], float, str]]:
+        """(suffix, label values, value, extra label) rows for rendering"""
+        pass
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, value, extra in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_label_text(self.labelnames, values, extra)} "
+                f"{_format_value(value)}"
+            )
+        return lines
+
+class Counter(Instrument):
+    kind = 'counter'
+    
+    def _new_child(self):
+        return _CounterChild()
+    
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+    
+    def samples(self):
+        return [('_total' if not self.name.endswith('_total') else '', values, child.value, '')
+                for values, child in sorted(self._children.items())]
+
+class Gauge(Instrument):
+    kind = 'gauge'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None
+    
+    def _new_child(self):
+        return _GaugeChild()
+    
+    def set(self, value: float):
+        self.labels().set(value)
+    
+    def set_function(self, function: Callable[[], Dict[Tuple[str, ...], float]]):
+        """Compute the gauge at scrape time instead of on every change"""
+        self._function = function
+    
+    def samples(self):
+        if self._function is not None:
+            return [('', values, value, '') for values, value in sorted(self._function().items())]
+        return [('', values, child.value, '') for values, child in sorted(self._children.items())]
+
+class Histogram(Instrument):
+    kind = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+    
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value: float):
+        self.labels().observe(value)
+    
+    def samples(self):
+        rows = []
+        for values, child in sorted(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                rows.append(('_bucket', values, cumulative, f'le="{_format_value(bound)}"'))
+            rows.append(('_sum', values, child.sum, ''))
+            rows.append(('_count', values, child.count, ''))
+        return rows
+
+class MetricsRegistry:
+    """Named instruments, created once and rendered together for a scrape"""
+    
+    def __init__(self):
+        self.instruments: Dict[str, Instrument] = {}
+    
+    def _register(self, cls, name: str, *args, **kwargs):
+        instrument = self.instruments.get(name)
+        if instrument is None:
+            instrument = self.instruments[name] = cls(name, *args, **kwargs)
+        elif not isinstance(instrument, cls):
+            raise ValueError(f"Metric {name} already registered as a {instrument.kind}")
+        return instrument
+    
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+    
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+    
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+    
+    def render(self) -> str:
+        lines = []
+        for name in sorted(self.instruments):
+            lines.extend(self.instruments[name].render())
+        return '\n'.join(lines) + '\n'
+
+class SyncTelemetry:
+    """
+    The sync pipeline's instruments, shared by DeviceManager and its integrations
+    """
+    
+    def __init__(self, registry: MetricsRegistry = None):
+        self.registry = registry or MetricsRegistry()
+        registry = self.registry
+        
+        self.request_seconds = registry.histogram(
+            'vendor_request_duration_seconds', 'Vendor API request latency including body read',
+            ('vendor', 'endpoint', 'status'), LATENCY_BUCKETS
+        )
+        self.rate_limit_wait_seconds = registry.histogram(
+            'rate_limit_wait_seconds', 'Time spent sleeping for request pacing or 429 back-off',
+            ('vendor', 'reason'), WAIT_BUCKETS
+        )
+        self.token_refreshes = registry.counter(
+            'token_refreshes_total', 'OAuth token refreshes', ('vendor', 'outcome')
+        )
+        self.metrics_ingested = registry.counter(
+            'metrics_ingested_total', 'Validated metrics handed to the metric store',
+            ('vendor', 'metric_type')
+        )
+        self.store_outcomes = registry.counter(
+            'store_writes_total', 'Metric store write outcomes', ('vendor', 'outcome')
+        )
+        self.dedup_hits = registry.counter(
+            'dedup_hits_total', 'Re-synced metrics skipped as unchanged by the dedup index',
+            ('vendor',)
+        )
+        self.sync_seconds = registry.histogram(
+            'sync_duration_seconds', 'Wall time of one device sync', ('vendor',), SYNC_BUCKETS
+        )
+        self.syncs = registry.counter('syncs_total', 'Device syncs run', ('vendor', 'outcome'))
+        self.scheduler_lag_seconds = registry.histogram(
+            'scheduler_lag_seconds', 'How late scheduled syncs started', (), LAG_BUCKETS
+        )
+        self.queue_depth = registry.gauge(
+            'sync_queue_depth', 'Scheduled syncs queued with the quota planner', ('vendor',)
+        )
+        self.loop_lag_seconds = registry.histogram(
+            'event_loop_lag_seconds', 'Delay of a periodic event-loop wake-up', (), LAG_BUCKETS
+        )
+        self.sync_leases = registry.counter(
+            'sync_leases_total', 'Sync lease requests by outcome '
+            '(acquired, takeover of an expired lease, contended, lost before commit)',
+            ('vendor', 'outcome')
+        )
+        self.leases_held = registry.gauge(
+            'sync_leases_held', 'Sync leases this process currently holds', ('vendor',)
+        )
+    
+    def observe_request(self, vendor: str, url: str, status: int, seconds: float):
+        self.request_seconds.labels(vendor, normalize_endpoint(url), str(status)).observe(seconds)
+    
+    def observe_rate_limit_wait(self, vendor: str, reason: str, seconds: float):
+        self.rate_limit_wait_seconds.labels(vendor, reason).observe(seconds)
+    
+    def token_refreshed(self, vendor: str, success: bool):
+        self.token_refreshes.labels(vendor, 'success' if success else 'failure').inc()
+    
+    def observe_ingest(self, vendor: str, counts: Dict[str, int], stats):
+        """counts: metric_type -> metrics written; stats: the store's IngestStats"""
+        for metric_type, count in counts.items():
+            self.metrics_ingested.labels(vendor, metric_type).inc(count)
+        self.store_outcomes.labels(vendor, 'inserted').inc(stats.inserted)
+        self.store_outcomes.labels(vendor, 'updated').inc(stats.updated)
+        self.store_outcomes.labels(vendor, 'unchanged').inc(stats.unchanged)
+        self.dedup_hits.labels(vendor).inc(stats.unchanged)
+    
+    def observe_sync(self, vendor: str, seconds: float, success: bool):
+        self.sync_seconds.labels(vendor).observe(seconds)
+        self.syncs.labels(vendor, 'success' if success else 'failure').inc()
+    
+    def lease_outcome(self, vendor: str, outcome: str):
+        self.sync_leases.labels(vendor, outcome).inc()
+    
+    def watch_leases(self, leases):
+        """Report the leases a LeaseStore holds per vendor at scrape time"""
+        def held() -> Dict[Tuple[str, ...], float]:
+            counts: Dict[Tuple[str, ...], float] = {}
+            for _, vendor in list(leases.held):
+                counts[(vendor,)] = counts.get((vendor,), 0) + 1
+            return counts
+        self.leases_held.set_function(held)
+    
+    def watch_queue(self, planner):
+        """Report the quota planner's pending demand per vendor at scrape time"""
+        def depth() -> Dict[Tuple[str, ...], float]:
+            counts: Dict[Tuple[str, ...], float] = {}
+            for vendor, _, _ in list(planner.pending):
+                counts[(vendor,)] = counts.get((vendor,), 0) + 1
+            return counts
+        self.queue_depth.set_function(depth)
+
+class LoopLagMonitor:
+    """Periodically measures how late the event loop wakes a sleeping task"""
+    
+    def __init__(self, histogram: Histogram, interval: float = 0.5):
+        self.histogram = histogram
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        child = self.histogram.labels()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            child.observe(max(loop.time() - expected, 0.0))
+    
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+class MetricsServer:
+    """
+    Serves GET /metrics for a registry on a local port and samples event-loop lag
+    while running
+    """
+    
+    def __init__(self, telemetry: SyncTelemetry):
+        self.telemetry = telemetry
+        self.loop_monitor = LoopLagMonitor(telemetry.loop_lag_seconds)
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+        
+        self.app = web.Application()
+        self.app.add_routes([web.get('/metrics', self._metrics)])
+    
+    async def _metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.telemetry.registry.render(),
+            content_type='text/plain', charset='utf-8',
+            headers={'X-Content-Type-Options': 'nosniff'}
+        )
+    
+    async def start(self, host: str = '127.0.0.1', port: int = 9464) -> str:
+        """Start listening; port 0 picks a free port. Returns the metrics URL"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}/metrics"
+        self.loop_monitor.start()
+        logger.info(f"Metrics endpoint listening on {self.url}")
+        return self.url
+    
+    async def stop(self):
+        await self.loop_monitor.stop()
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,206 @@
+"""
+Lightweight per-sync tracing
+A SyncTrace is bound to the running task through a context variable, so any code a
+sync reaches can open spans without the trace being passed around; with no trace
+bound, span() returns a shared no-op scope
+"""
+
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+# Spans kept per trace; later spans still count toward the breakdown
+MAX_SPANS_PER_TRACE = 20_000
+
+_trace_ids = itertools.count(1)
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('sync_trace', default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar('sync_span', default=None)
+
+# Task running each bound trace, so observers outside the task (the sampling profiler)
+# can attribute work to a sync
+_task_traces: Dict[asyncio.Task, 'SyncTrace'] = {}
+
+@dataclass
+class Span:
+    """One timed operation; start/end are perf_counter seconds"""
+    name: str
+    span_id: int
+    parent_id: Optional[int]
+    start: float
+    end: float = 0.0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+class _SpanScope:
+    __slots__ = ('trace', 'name', 'attributes', 'span', 'parent', 'token')
+    
+    def __init__(self, trace: 'SyncTrace', name: str, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attributes = attributes
+    
+    def __enter__(self) -> Span:
+        self.parent = parent = _current_span.get()
+        self.span = Span(
+            self.name, next(self.trace._span_ids),
+            parent.span_id if parent is not None else None,
+            time.perf_counter(), attributes=self.attributes
+        )
+        self.token = _current_span.set(self.span)
+        self.trace.active = self.span
+        return self.span
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.span.end = time.perf_counter()
+        if exc_type is not None:
+            self.span.attributes['error'] = exc_type.__name__
+        _current_span.reset(self.token)
+        self.trace.active = self.parent
+        self.trace.add(self.span)
+
+class _NullScope:
+    __slots__ = ()
+    
+    def __enter__(self):
+        return None
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return None
+
+_NULL_SCOPE = _NullScope()
+
+def span(name: str, **attributes):
+    """
+    Time a block as a child of the current span in the current task's trace
+    Yields the Span, or None when no trace is bound
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SCOPE
+    return _SpanScope(trace, name, attributes)
+
+def current_trace() -> Optional['SyncTrace']:
+    return _current_trace.get()
+
+def task_trace(task: Optional[asyncio.Task]) -> Optional['SyncTrace']:
+    """The trace bound in a task, readable from any thread"""
+    return _task_traces.get(task) if task is not None else None
+
+class _TraceBinding:
+    __slots__ = ('trace', 'trace_token', 'root', 'task')
+    
+    def __init__(self, trace: 'SyncTrace'):
+        self.trace = trace
+    
+    def __enter__(self) -> 'SyncTrace':
+        self.trace_token = _current_trace.set(self.trace)
+        self.root = _SpanScope(
+            self.trace, 'sync', {'vendor': self.trace.vendor, 'user_id': self.trace.user_id}
+        )
+        self.root.__enter__()
+        self.task = asyncio.current_task()
+        if self.task is not None:
+            _task_traces[self.task] = self.trace
+        return self.trace
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.root.__exit__(exc_type, exc_val, exc_tb)
+        if _task_traces.get(self.task) is self.trace:
+            del _task_traces[self.task]
+        _current_trace.reset(self.trace_token)
+        self.trace.duration = self.root.span.duration
+
+class SyncTrace:
+    """
+    Spans recorded during one device sync, with per-name totals kept as spans close
+    """
+    
+    def __init__(self, vendor: str, user_id: str, max_spans: int = MAX_SPANS_PER_TRACE):
+        self.trace_id = next(_trace_ids)
+        self.vendor = vendor
+        self.user_id = user_id
+        self.max_spans = max_spans
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self.duration = 0.0
+        self.active: Optional[Span] = None  # innermost open span
+        
+        # perf_counter and wall clock at creation, to place spans on a wall-clock axis
+        self.perf_origin = time.perf_counter()
+        self.wall_origin = time.time()
+        
+        self.totals: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._span_ids = itertools.count(1)
+    
+    def bind(self) -> _TraceBinding:
+        """Make this the current task's trace, under a root 'sync' span"""
+        return _TraceBinding(self)
+    
+    def add(self, finished: Span):
+        self.totals[finished.name] = self.totals.get(finished.name, 0.0) + finished.duration
+        self.counts[finished.name] = self.counts.get(finished.name, 0) + 1
+        if len(self.spans) < self.max_spans:
+            self.spans.append(finished)
+        else:
+            self.dropped += 1
+    
+    def breakdown(self) -> Dict[str, float]:
+        """
+        Seconds per span name, plus 'total' for the whole sync
+        Nested spans are also counted in their parents (http sits inside sync.activity)
+        """
+        timings = {name: seconds for name, seconds in self.totals.items() if name != 'sync'}
+        timings['total'] = self.duration
+        return timings
+    
+    def wall_time_us(self, perf_seconds: float) -> float:
+        return (self.wall_origin + (perf_seconds - self.perf_origin)) * 1e6
+
+class ChromeTraceExporter:
+    """
+    Appends traces to a Chrome trace-event file (JSON array format), viewable in
+    Perfetto or chrome://tracing; each sync gets its own track
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    
+    def events(self, trace: SyncTrace) -> List[Dict[str, Any]]:
+        events = [{
+            'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': trace.trace_id,
+            'args': {'name': f"{trace.vendor} {trace.user_id} #{trace.trace_id}"}
+        }]
+        for finished in sorted(trace.spans, key=lambda s: s.start):
+            events.append({
+                'name': finished.name,
+                'cat': finished.name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': round(trace.wall_time_us(finished.start), 1),
+                'dur': round(finished.duration * 1e6, 1),
+                'pid': self.pid,
+                'tid': trace.trace_id,
+                'args': finished.attributes
+            })
+        return events
+    
+    def export(self, trace: SyncTrace):
+        # The array format tolerates a missing closing bracket, so traces can be appended
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, 'a') as trace_file:
+            if new_file:
+                trace_file.write('[\n')
+            for event in self.events(trace):
+                trace_file.write(json.dumps(event, default=str) + ',\n')
@@ -4,25 +4,35 @@ Handles authentication, synchronization, and data aggregation across all devices
 """
 
 import asyncio
+import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Type
 from dataclasses import dataclass
 from loguru import logger
 import json
 
-from .common.base_device import BaseDeviceIntegration, HealthMetric, DeviceConnection, SyncResult
+from .common.base_device import (
+    BaseDeviceIntegration, HealthMetric, DeviceConnection, SyncResult, IngestStats
+)
+from .common.metric_store import MetricStore
+from .common.sleep_sessions import SleepStitcher, CanonicalNight
+from .common.profile_store import ProfileStore, UserDeviceProfile
+from .common.telemetry import SyncTelemetry, MetricsServer
+from .common.tracing import SyncTrace, ChromeTraceExporter
+from .common.profiler import SyncProfiler
+from .common.sync_leases import LeaseStore, Lease
+from .metric_fusion import MetricFusionEngine, FusedSeries, build_rank_table, metric_rank
+from .query_engine import MetricQueryEngine, QueryResult
+from .cohort_analytics import CohortAnalytics, CohortFilter
+from .feature_store import FeatureStore, FeatureMatrix
+from .bulk_export import BulkExporter
+from .columnar_export import ColumnarExporter
+from .common.quota import (
+    QuotaPlanner, SharedQuotaLedger, SyncDemand, PRIORITY_CLINICIAN_VIEWED, PRIORITY_SCHEDULED
+)
 from .fitbit.fitbit_integration import FitbitIntegration
 from .oura.oura_integration import OuraIntegration
-
-@dataclass
-class UserDeviceProfile:
-    """Complete device profile for a user"""
-    user_id: str
-    connected_devices: Dict[str, DeviceConnection]
-    sync_preferences: Dict[str, Any]
-    data_quality_scores: Dict[str, float]
-    last_full_sync: Optional[datetime] = None
-    sync_errors: List[str] = None
+from .apple_health.apple_health_integration import AppleHealthIntegration
 
 @dataclass
 class AggregatedMetrics:
@@ -39,19 +49,46 @@ class DeviceManager:
     Centralized manager for all health device integrations
     """
     
-    def __init__(self):
+    def __init__(self, profile_store_path: str = None):
         # Initialize device integrations
         self.integrations: Dict[str, BaseDeviceIntegration] = {
             'fitbit': FitbitIntegration(),
             'oura': OuraIntegration(),
+            'apple': AppleHealthIntegration(),
             # Add more integrations here
-            # 'apple': AppleHealthIntegration(),
             # 'whoop': WhoopIntegration(),
             # 'garmin': GarminIntegration(),
         }
         
-        # User profiles cache
-        self.user_profiles: Dict[str, UserDeviceProfile] = {}
+        # User profiles and connections, persisted when a store path is given
+        self.user_profiles = ProfileStore(profile_store_path or ':memory:')
+        
+        # Vendor quota accounting, metric storage and telemetry shared by all integrations;
+        # with a store file the quota ledger lives there, so processes sharing it share
+        # one app-wide budget
+        self.quota_planner = QuotaPlanner(
+            SharedQuotaLedger(profile_store_path) if profile_store_path else None
+        )
+        self.metric_store = MetricStore()
+        self.telemetry = SyncTelemetry()
+        self.telemetry.watch_queue(self.quota_planner)
+        self.metrics_server: Optional[MetricsServer] = None
+        
+        # Per-(user, device) sync leases; processes sharing the store file share them
+        self.sync_leases = LeaseStore(profile_store_path or ':memory:')
+        self.telemetry.watch_leases(self.sync_leases)
+        
+        # Per-sync trace spans; written to a trace file only when export is enabled
+        self.trace_exporter: Optional[ChromeTraceExporter] = None
+        
+        # Opt-in profiling session and the timer that ends a time-boxed one
+        self.profiler: Optional[SyncProfiler] = None
+        self._profiling_timer: Optional[asyncio.TimerHandle] = None
+        for integration in self.integrations.values():
+            integration.quota_ledger = self.quota_planner.ledger
+            integration.metric_store = self.metric_store
+            integration.telemetry = self.telemetry
+            integration.on_connection_changed = self._connection_changed
         
         # Metric priority mapping (which device to prefer for each metric)
         self.metric_priorities = {
@@ -65,6 +102,23 @@ class DeviceManager:
             'body_temperature': ['oura', 'whoop']
         }
         
+        # Precomputed (metric_type, device) -> rank lookups and range fusion
+        self.metric_rank = build_rank_table(self.metric_priorities)
+        self.fusion = MetricFusionEngine(self.metric_priorities, self.metric_store)
+        self.query_engine = MetricQueryEngine(self.metric_store)
+        
+        # Cohort attributes (age, conditions, risk_level) used to filter cohort analytics
+        self.user_attributes: Dict[str, Dict[str, Any]] = {}
+        self.cohort_analytics = CohortAnalytics(self.metric_store, self.metric_rank)
+        
+        # Cross-device sleep sessions stitched into one night per wake date
+        self.sleep_stitcher = SleepStitcher(self.metric_rank)
+        for integration in self.integrations.values():
+            integration.sleep_stitcher = self.sleep_stitcher
+        
+        # Daily feature rows for risk models, refreshed as new data lands
+        self.feature_store = FeatureStore(self.metric_store, self.metric_rank, self.sleep_stitcher)
+        
         # Sync scheduling
         self.sync_intervals = {
             'real_time': timedelta(minutes=15),
@@ -92,11 +146,11 @@ class DeviceManager:
                     user_id=user_id,
                     connected_devices={},
                     sync_preferences={},
-                    data_quality_scores={},
-                    sync_errors=[]
+                    data_quality_scores={}
                 )
             
             self.user_profiles[user_id].connected_devices[device_type] = connection
+            self.user_profiles.mark_dirty(user_id, immediate=True)
             
             logger.info(f"Device {device_type} authenticated for user {user_id}")
             return connection
@@ -104,9 +158,11 @@ class DeviceManager:
     async def sync_user_data(self, user_id: str, 
                             start_date: datetime = None,
                             end_date: datetime = None,
-                            device_types: List[str] = None) -> Dict[str, SyncResult]:
+                            device_types: List[str] = None,
+                            priority: int = None) -> Dict[str, SyncResult]:
         """
         Sync data for all connected devices for a user
+        Devices whose vendor quota cannot cover the sync are deferred, not called
         """
         if user_id not in self.user_profiles:
             raise ValueError(f"No device profile found for user {user_id}")
@@ -123,26 +179,69 @@ class DeviceManager:
         if not device_types:
             device_types = list(profile.connected_devices.keys())
         
+        if priority is None:
+            priority = profile.sync_preferences.get('priority', PRIORITY_SCHEDULED)
+        
         sync_results = {}
         
         # Sync each device concurrently
         sync_tasks = []
-        for device_type in device_types:
-            if device_type in profile.connected_devices:
-                connection = profile.connected_devices[device_type]
-                integration = self.integrations[device_type]
-                
-                task = self._sync_device_data(
-                    integration, connection, start_date, end_date, device_type
-                )
-                sync_tasks.append(task)
+        task_devices = []
+        # Leases taken here whose sync has not started, released if the loop fails
+        pending_leases = []
+        try:
+            for device_type in device_types:
+                if device_type in profile.connected_devices:
+                    connection = profile.connected_devices[device_type]
+                    integration = self.integrations[device_type]
+                    
+                    # Skip devices whose sync is already running here or in another worker
+                    lease = await self._acquire_sync_lease(user_id, device_type)
+                    if lease is None:
+                        sync_results[device_type] = await self._locked_result(user_id, device_type)
+                        profile.sync_history.record(device_type, sync_results[device_type])
+                        continue
+                    pending_leases.append(lease)
+                    
+                    # Defer instead of spending quota that higher-priority syncs need
+                    decision = self.quota_planner.admit(
+                        device_type, connection.user_id,
+                        self.quota_planner.estimate_calls(device_type, start_date, end_date),
+                        priority, integration.app_id
+                    )
+                    if not decision.admitted:
+                        pending_leases.pop()
+                        await self._release_lease(lease)
+                        sync_results[device_type] = SyncResult(
+                            success=False,
+                            metrics_synced=0,
+                            errors=[f"Deferred: {decision.reason}"],
+                            last_sync_time=datetime.now(),
+                            next_sync_time=decision.retry_at
+                        )
+                        profile.sync_history.record(device_type, sync_results[device_type])
+                        continue
+                    
+                    self.quota_planner.dequeue(device_type, connection.user_id, integration.app_id)
+                    task = self._sync_device_data(
+                        integration, connection, start_date, end_date, device_type, lease
+                    )
+                    sync_tasks.append(task)
+                    task_devices.append(device_type)
+        except BaseException:
+            # The syncs never started, so their own finally won't release the leases
+            for task in sync_tasks:
+                task.close()
+            for lease in pending_leases:
+                await self._release_lease(lease)
+            raise
         
         # Wait for all syncs to complete
         results = await asyncio.gather(*sync_tasks, return_exceptions=True)
         
         # Process results
         for i, result in enumerate(results):
-            device_type = device_types[i]
+            device_type = task_devices[i]
             if isinstance(result, Exception):
                 logger.error(f"Sync failed for {device_type}: {result}")
                 sync_results[device_type] = SyncResult(
@@ -151,13 +250,15 @@ class DeviceManager:
                     errors=[str(result)],
                     last_sync_time=datetime.now()
                 )
-                profile.sync_errors.append(f"{device_type}: {result}")
+                profile.sync_history.record(device_type, sync_results[device_type], result)
             else:
                 sync_results[device_type] = result
                 profile.data_quality_scores[device_type] = result.data_quality_score
+                profile.sync_history.record(device_type, result)
         
         # Update profile
         profile.last_full_sync = datetime.now()
+        self.user_profiles.mark_dirty(user_id)
         
         logger.info(f"Sync completed for user {user_id}: {len(sync_results)} devices")
         return sync_results
@@ -165,10 +266,90 @@ class DeviceManager:
     async def _sync_device_data(self, integration: BaseDeviceIntegration,
                                connection: DeviceConnection,
                                start_date: datetime, end_date: datetime,
-                               device_type: str) -> SyncResult:
-        """Sync data from a specific device"""
-        async with integration:
-            return await integration.sync_metrics(connection, start_date, end_date)
+                               device_type: str, lease: Lease) -> SyncResult:
+        """
+        Sync data from a specific device under its sync lease, released when done
+        The sync runs under a trace whose phase timings are attached to the result
+        """
+        started = time.perf_counter()
+        success = False
+        trace = SyncTrace(device_type, connection.user_id)
+        try:
+            with trace.bind():
+                async with integration:
+                    result = await self._sync_under_lease(
+                        integration, connection, lease, start_date, end_date
+                    )
+            success = result.success
+            result.timings = trace.breakdown()
+            result.trace = trace
+            return result
+        finally:
+            await self._release_lease(lease)
+            self.telemetry.observe_sync(device_type, time.perf_counter() - started, success)
+            if self.trace_exporter is not None:
+                self.trace_exporter.export(trace)
+            if self.profiler is not None and self.profiler.sync_finished():
+                self.stop_profiling()
+    
+    async def _acquire_sync_lease(self, user_id: str, device_type: str) -> Optional[Lease]:
+        # Lease calls can wait on SQLite's busy_timeout, so they run off the event loop
+        lease, outcome = await asyncio.to_thread(self.sync_leases.acquire, user_id, device_type)
+        self.telemetry.lease_outcome(device_type, outcome)
+        if outcome == 'takeover':
+            logger.warning(f"Took over an expired {device_type} sync lease for user {user_id}")
+        return lease
+    
+    async def _release_lease(self, lease: Lease):
+        await asyncio.to_thread(self.sync_leases.release, lease)
+    
+    async def _locked_result(self, user_id: str, device_type: str) -> SyncResult:
+        current = await asyncio.to_thread(self.sync_leases.current, user_id, device_type)
+        holder = current.holder if current else 'another sync'
+        return SyncResult(
+            success=False,
+            metrics_synced=0,
+            errors=[f"Locked: {device_type} sync already running in {holder}"],
+            last_sync_time=datetime.now()
+        )
+    
+    async def _keep_lease(self, lease: Lease):
+        """Renew a lease while its sync runs so long syncs don't lapse"""
+        while True:
+            await asyncio.sleep(self.sync_leases.ttl / 3)
+            if not await asyncio.to_thread(self.sync_leases.renew, lease):
+                logger.warning(
+                    f"Lost {lease.device_type} sync lease for user {lease.user_id} mid-sync"
+                )
+                return
+    
+    async def _sync_under_lease(self, integration: BaseDeviceIntegration,
+                                connection: DeviceConnection, lease: Lease,
+                                start_date: datetime, end_date: datetime) -> SyncResult:
+        """
+        Run a vendor sync while renewing its lease, then check the fencing token
+        before the sync's last_sync is kept
+        The check only fences last_sync: metrics the sync wrote are already in the
+        store when it fails
+        """
+        previous_sync = connection.last_sync
+        keepalive = asyncio.create_task(self._keep_lease(lease))
+        try:
+            result = await integration.sync_metrics(connection, start_date, end_date)
+        finally:
+            keepalive.cancel()
+        
+        if not await asyncio.to_thread(self.sync_leases.renew, lease):
+            # The lease lapsed and a newer holder may have synced since. Its metrics
+            # stay stored (deduplicated, but a stale vendor revision can replace the
+            # newer sync's); last_sync must not move past the newer sync's
+            self.telemetry.lease_outcome(integration.device_type, 'lost')
+            connection.last_sync = previous_sync
+            result.success = False
+            result.errors.append(
+                f"Lease lost: sync token {lease.token} was superseded before commit"
+            )
+        return result
     
     async def get_aggregated_metrics(self, user_id: str, 
                                    date: datetime = None) -> AggregatedMetrics:
@@ -182,6 +363,7 @@ class DeviceManager:
             raise ValueError(f"No device profile found for user {user_id}")
         
         profile = self.user_profiles[user_id]
+        priority = profile.sync_preferences.get('priority', PRIORITY_SCHEDULED)
         
         # Collect metrics from all devices for the specified date
         all_metrics = {}
@@ -196,38 +378,72 @@ class DeviceManager:
                     start_datetime = datetime.combine(date, datetime.min.time())
                     end_datetime = datetime.combine(date, datetime.max.time())
                     
-                    result = await integration.sync_metrics(
-                        connection, start_datetime, end_datetime
-                    )
+                    # Another worker already syncing this device covers the day
+                    lease = await self._acquire_sync_lease(user_id, device_type)
+                    if lease is not None:
+                        try:
+                            # Quota promised to higher-priority syncs isn't spent on a
+                            # read; a deferred read serves stored (or simulated) data
+                            decision = self.quota_planner.admit(
+                                device_type, connection.user_id,
+                                self.quota_planner.estimate_calls(device_type, start_datetime, end_datetime),
+                                priority, integration.app_id
+                            )
+                            if decision.admitted:
+                                self.quota_planner.dequeue(device_type, connection.user_id, integration.app_id)
+                                await self._sync_under_lease(
+                                    integration, connection, lease, start_datetime, end_datetime
+                                )
+                            else:
+                                logger.info(
+                                    f"Serving stored {device_type} data for user {user_id}: "
+                                    f"{decision.reason}"
+                                )
+                        finally:
+                            await self._release_lease(lease)
                     
-                    # Process metrics (this would typically come from database)
-                    # For now, we'll simulate having the metrics
-                    device_metrics = self._simulate_device_metrics(device_type, date)
+                    # Daily summaries come from the store's day rollups;
+                    # simulate when nothing has been stored for the day yet
+                    device_metrics = (
+                        self.metric_store.daily_metrics(connection.user_id, device_type, date)
+                        or self._simulate_device_metrics(device_type, date)
+                    )
                     
                     for metric in device_metrics:
                         metric_type = metric.metric_type
                         
-                        # Use device priority to determine which metric to keep
-                        if metric_type in self.metric_priorities:
-                            priority_devices = self.metric_priorities[metric_type]
+                        # Keep the best-ranked device; unranked devices and metrics
+                        # without priorities keep the first available value
+                        if (metric_type not in all_metrics or
+                            metric_rank(self.metric_rank, metric_type, device_type) <
+                            metric_rank(self.metric_rank, metric_type, data_sources[metric_type])):
                             
-                            if (metric_type not in all_metrics or 
-                                device_type in priority_devices and
-                                (data_sources.get(metric_type) not in priority_devices or
-                                 priority_devices.index(device_type) < 
-                                 priority_devices.index(data_sources.get(metric_type)))):
-                                
-                                all_metrics[metric_type] = metric
-                                data_sources[metric_type] = device_type
-                        else:
-                            # No priority defined, use first available
-                            if metric_type not in all_metrics:
-                                all_metrics[metric_type] = metric
-                                data_sources[metric_type] = device_type
+                            all_metrics[metric_type] = metric
+                            data_sources[metric_type] = device_type
             
             except Exception as e:
                 logger.error(f"Error getting metrics from {device_type}: {e}")
         
+        # Syncs above may have refreshed tokens or advanced last_sync
+        self.user_profiles.mark_dirty(user_id)
+        
+        # Sleep comes from the stitched night rather than per-device session starts
+        night = self.sleep_stitcher.night(
+            user_id, date.date() if isinstance(date, datetime) else date
+        )
+        if night and night.sleep_hours:
+            night_start = datetime.combine(night.date, datetime.min.time())
+            all_metrics['sleep_duration'] = HealthMetric(
+                'sleep_duration', night.sleep_hours, 'hours', night_start, night.source_device,
+                metadata={'nap_hours': night.nap_hours, 'devices': night.devices}
+            )
+            data_sources['sleep_duration'] = night.source_device
+            if night.efficiency is not None:
+                all_metrics['sleep_efficiency'] = HealthMetric(
+                    'sleep_efficiency', night.efficiency, 'percent', night_start, night.source_device
+                )
+                data_sources['sleep_efficiency'] = night.source_device
+        
         # Calculate overall quality and completeness scores
         quality_scores = [m.quality_score for m in all_metrics.values()]
         overall_quality = sum(quality_scores) / len(quality_scores) if quality_scores else 0
@@ -248,6 +464,122 @@ class DeviceManager:
             completeness_score=completeness
         )
     
+    def get_fused_metrics(self, user_id: str, metric_types: List[str] = None,
+                          start_date: datetime = None, end_date: datetime = None,
+                          resolution: str = 'day',
+                          strategy: str = 'select') -> Dict[str, FusedSeries]:
+        """
+        Fuse stored metrics from all devices over a date range in one vectorized pass
+        """
+        if user_id not in self.user_profiles:
+            raise ValueError(f"No device profile found for user {user_id}")
+        
+        if not end_date:
+            end_date = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+        if not start_date:
+            start_date = end_date - timedelta(days=7)
+        if not metric_types:
+            metric_types = list(self.metric_priorities.keys())
+        
+        return self.fusion.fuse_many(
+            user_id, metric_types, start_date, end_date, resolution, strategy
+        )
+    
+    def query_metrics(self, metric_types: List[str], start_date: datetime, end_date: datetime,
+                      user_ids: List[str] = None, resolution: str = 'day',
+                      agg: str = 'mean', fill: str = None,
+                      source_device: str = None) -> QueryResult:
+        """
+        Range query across users and metric types, returned as NumPy columns
+        Served from rollups when they can answer it, raw samples otherwise
+        """
+        if user_ids is None:
+            user_ids = list(self.user_profiles.keys())
+        
+        result = self.query_engine.query(
+            user_ids, metric_types, start_date, end_date, resolution, agg, fill, source_device
+        )
+        logger.debug(
+            f"Query {metric_types} x {len(user_ids)} users ({agg}, {resolution}): "
+            f"{len(result)} rows in {result.stats.total_ms:.2f}ms"
+        )
+        return result
+    
+    def get_features(self, user_ids: List[str], start_date: datetime,
+                     end_date: datetime) -> FeatureMatrix:
+        """Fixed-schema daily feature rows for batch risk scoring, one per user and day"""
+        return self.feature_store.get_features(user_ids, start_date.date(), end_date.date())
+    
+    def export_observations(self, output_dir: str, start_date: datetime, end_date: datetime,
+                            user_ids: List[str] = None, format: str = 'fhir',
+                            **options) -> Dict[str, Any]:
+        """
+        Bulk-export stored metrics as gzip NDJSON (FHIR Observations by default)
+        Re-running with the same range resumes an interrupted export
+        """
+        if user_ids is None:
+            user_ids = sorted({key[0] for key in self.metric_store.series})
+        
+        exporter = BulkExporter(self.metric_store, output_dir, format, **options)
+        return exporter.export(user_ids, start_date, end_date)
+    
+    def export_columnar(self, root: str, start_date: datetime, end_date: datetime,
+                        user_ids: List[str] = None, format: str = 'parquet',
+                        **options) -> Dict[str, Any]:
+        """Export stored metrics as a shard/month partitioned Parquet or Arrow dataset"""
+        if user_ids is None:
+            user_ids = sorted({key[0] for key in self.metric_store.series})
+        
+        return ColumnarExporter(self.metric_store, root, format, **options).export(
+            user_ids, start_date, end_date
+        )
+    
+    def import_columnar(self, root: str, format: str = 'parquet', user_ids: List[str] = None,
+                        metric_types: List[str] = None, start_date: datetime = None,
+                        end_date: datetime = None, **options) -> IngestStats:
+        """Seed the metric store from a columnar export without calling vendor APIs"""
+        exporter = ColumnarExporter(self.metric_store, root, format, **options)
+        return exporter.import_into(self.metric_store, user_ids, metric_types, start_date, end_date)
+    
+    async def import_apple_health(self, user_id: str, export_path: str,
+                                  start_date: datetime = None,
+                                  end_date: datetime = None) -> SyncResult:
+        """
+        Register and import a user's Apple Health export (export.xml or export.zip)
+        Without a date range the whole export is imported
+        """
+        await self.authenticate_device(
+            user_id, 'apple', {'user_id': user_id, 'export_path': export_path}
+        )
+        profile = self.user_profiles[user_id]
+        connection = profile.connected_devices['apple']
+        
+        lease = await self._acquire_sync_lease(user_id, 'apple')
+        if lease is None:
+            result = await self._locked_result(user_id, 'apple')
+            profile.sync_history.record('apple', result)
+            return result
+        
+        result = await self._sync_device_data(
+            self.integrations['apple'], connection, start_date, end_date, 'apple', lease
+        )
+        profile.data_quality_scores['apple'] = result.data_quality_score
+        profile.sync_history.record('apple', result)
+        self.user_profiles.mark_dirty(user_id)
+        return result
+    
+    def get_sleep_nights(self, user_id: str, start_date: datetime = None,
+                         end_date: datetime = None) -> List[CanonicalNight]:
+        """Canonical stitched nights for a user, one per wake date"""
+        if not end_date:
+            end_date = datetime.now()
+        if not start_date:
+            start_date = end_date - timedelta(days=7)
+        
+        return self.sleep_stitcher.nights_between(
+            user_id, start_date.date(), end_date.date()
+        )
+    
     def _simulate_device_metrics(self, device_type: str, date: datetime) -> List[HealthMetric]:
         """
         Simulate device metrics for demonstration
@@ -295,6 +627,7 @@ class DeviceManager:
                 logger.error(f"Error getting real-time data from {device_type}: {e}")
                 real_time_data[device_type] = []
         
+        self.user_profiles.mark_dirty(user_id)
         return real_time_data
     
     async def schedule_sync(self, user_id: str, sync_type: str = 'daily'):
@@ -307,18 +640,213 @@ class DeviceManager:
         interval = self.sync_intervals[sync_type]
         
         while True:
+            next_run = datetime.now() + interval
+            
             try:
-                await self.sync_user_data(user_id)
+                results = await self.sync_user_data(user_id)
                 logger.info(f"Scheduled {sync_type} sync completed for user {user_id}")
+                
+                # Retry deferred devices as soon as their quota window reopens
+                retry_times = [r.next_sync_time for r in results.values() if r.next_sync_time]
+                if retry_times:
+                    next_run = min(min(retry_times), next_run)
             except Exception as e:
                 logger.error(f"Scheduled sync failed for user {user_id}: {e}")
             
-            await asyncio.sleep(interval.total_seconds())
+            self._enqueue_sync_demand(user_id, next_run)
+            await asyncio.sleep(max((next_run - datetime.now()).total_seconds(), 0))
+            self.telemetry.scheduler_lag_seconds.observe(
+                max((datetime.now() - next_run).total_seconds(), 0.0)
+            )
+    
+    def _enqueue_sync_demand(self, user_id: str, due_at: datetime):
+        """Tell the quota planner about the calls the next scheduled sync will make"""
+        profile = self.user_profiles.get(user_id)
+        if not profile:
+            return
+        
+        profile.next_sync_due = due_at
+        self.user_profiles.mark_dirty(user_id)
+        
+        priority = profile.sync_preferences.get('priority', PRIORITY_SCHEDULED)
+        for device_type, connection in profile.connected_devices.items():
+            integration = self.integrations[device_type]
+            self.quota_planner.enqueue(SyncDemand(
+                vendor=device_type,
+                user_id=connection.user_id,
+                # Scheduled syncs use the default 7-day window
+                estimated_calls=self.quota_planner.estimate_calls(
+                    device_type, due_at - timedelta(days=7), due_at
+                ),
+                priority=priority,
+                due_at=due_at,
+                app_id=integration.app_id
+            ))
+    
+    def mark_clinician_viewed(self, user_id: str, viewed: bool = True):
+        """Prioritize syncs for patients a clinician is currently looking at"""
+        if user_id in self.user_profiles:
+            self.user_profiles[user_id].sync_preferences['priority'] = (
+                PRIORITY_CLINICIAN_VIEWED if viewed else PRIORITY_SCHEDULED
+            )
+            self.user_profiles.mark_dirty(user_id)
+    
+    def set_user_attributes(self, user_id: str, age: Optional[float] = None,
+                            conditions: List[str] = None, risk_level: Optional[str] = None):
+        """Record the clinical attributes cohort filters select on"""
+        self.user_attributes[user_id] = {
+            'age': age,
+            'conditions': list(conditions or []),
+            'risk_level': risk_level
+        }
+    
+    def get_cohort_analytics(self, age_group: str = 'all', condition: str = 'all',
+                             risk_level: str = 'all', metric_types: List[str] = None,
+                             start_date: datetime = None,
+                             end_date: datetime = None) -> Dict[str, Any]:
+        """
+        Per-metric distributions, trends and quality summaries for a filtered cohort
+        Filters mirror the cohort analytics endpoint's query parameters
+        """
+        if not end_date:
+            end_date = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+        if not start_date:
+            start_date = end_date - timedelta(days=30)
+        if not metric_types:
+            metric_types = list(self.metric_priorities.keys())
+        
+        cohort_filter = CohortFilter(age_group, condition, risk_level)
+        user_ids = [
+            user_id for user_id in sorted(set(self.user_profiles) | set(self.user_attributes))
+            if cohort_filter.matches(self.user_attributes.get(user_id, {}))
+        ]
+        
+        analytics = self.cohort_analytics.compute(user_ids, metric_types, start_date, end_date)
+        analytics['alerts'] = self.get_baseline_alerts(user_ids, since=end_date - timedelta(days=7))
+        analytics['filters'] = {
+            'ageGroup': age_group,
+            'condition': condition,
+            'riskLevel': risk_level
+        }
+        return analytics
+    
+    def get_baseline_alerts(self, user_ids: List[str] = None,
+                            since: datetime = None) -> List[Dict[str, Any]]:
+        """
+        Cohort alerts from anomalies flagged against each user's own baseline at ingest
+        """
+        if user_ids is None:
+            user_ids = list(self.user_profiles.keys())
+        if since is None:
+            since = datetime.now() - timedelta(days=7)
+        
+        baselines = self.metric_store.baselines
+        alerts = []
+        for metric_type, (direction, threshold) in baselines.rules.items():
+            flagged = baselines.flagged_users(user_ids, metric_type, direction, since)
+            if not flagged:
+                continue
+            
+            alerts.append({
+                'type': 'baseline_deviation',
+                'metric_type': metric_type,
+                'direction': direction,
+                'message': (
+                    f"{len(flagged)} patients with {metric_type} more than {threshold:g} SD "
+                    f"{ {'low': 'below', 'high': 'above'}.get(direction, 'away from') } their baseline"
+                ),
+                'priority': 'high' if len(flagged) >= 5 else 'medium',
+                'patientCount': len(flagged),
+                'user_ids': flagged,
+                'created': datetime.now().isoformat()
+            })
+        
+        return alerts
+    
+    def enable_trace_export(self, path: str):
+        """Append every subsequent sync's spans to a Chrome trace-event file at path"""
+        self.trace_exporter = ChromeTraceExporter(path)
+    
+    def disable_trace_export(self):
+        self.trace_exporter = None
+    
+    def start_profiling(self, output_dir: str, duration: float = None, syncs: int = None,
+                        mode: str = 'sample', interval: float = 0.01) -> SyncProfiler:
+        """
+        Profile sync work on the running event loop until `duration` seconds pass or
+        `syncs` more device syncs finish (whichever comes first), or stop_profiling()
+        Must be called from the event loop's thread
+        """
+        if self.profiler is not None:
+            raise RuntimeError("A profiling session is already running")
+        
+        self.profiler = SyncProfiler(output_dir, mode, interval, max_syncs=syncs)
+        self.profiler.start()
+        if duration is not None:
+            self._profiling_timer = asyncio.get_running_loop().call_later(
+                duration, self.stop_profiling
+            )
+        return self.profiler
+    
+    def stop_profiling(self) -> Optional[Dict[str, Any]]:
+        """End the current profiling session; returns its summary and output files"""
+        profiler, self.profiler = self.profiler, None
+        if self._profiling_timer is not None:
+            self._profiling_timer.cancel()
+            self._profiling_timer = None
+        if profiler is None:
+            return None
+        return profiler.stop()
+    
+    async def start_metrics_server(self, host: str = '127.0.0.1', port: int = 9464) -> str:
+        """Expose sync telemetry at http://host:port/metrics in the Prometheus text format"""
+        if self.metrics_server is None:
+            self.metrics_server = MetricsServer(self.telemetry)
+            await self.metrics_server.start(host, port)
+        return self.metrics_server.url
+    
+    async def stop_metrics_server(self):
+        if self.metrics_server is not None:
+            await self.metrics_server.stop()
+            self.metrics_server = None
     
     def get_user_profile(self, user_id: str) -> Optional[UserDeviceProfile]:
         """Get user device profile"""
         return self.user_profiles.get(user_id)
     
+    def users_due_for_sync(self, now: datetime = None, limit: int = None) -> List[str]:
+        """Users whose scheduled sync is due, most overdue first (indexed lookup)"""
+        return self.user_profiles.due_for_sync(now, limit)
+    
+    def connections_expiring(self, within: timedelta = timedelta(hours=1),
+                             device_type: str = None) -> List[DeviceConnection]:
+        """Active connections whose access token expires within the window"""
+        return [
+            self.user_profiles[user_id].connected_devices[device]
+            for user_id, device in self.user_profiles.expiring_tokens(
+                datetime.now() + within, device_type
+            )
+        ]
+    
+    def flush_profiles(self) -> int:
+        """Write pending profile changes now rather than with the next batch"""
+        return self.user_profiles.flush()
+    
+    def _connection_changed(self, connection: DeviceConnection):
+        """Persist refreshed tokens right away rather than with the next batch"""
+        if connection.user_id in self.user_profiles:
+            self.user_profiles.mark_dirty(connection.user_id, immediate=True)
+    
+    async def close(self):
+        """
+        Write pending profile changes and release the shared store files; call before
+        the process exits, or profile changes since the last flush are lost
+        """
+        await self.stop_metrics_server()
+        await self.user_profiles.aclose()
+        await asyncio.to_thread(self.sync_leases.close)
+        self.quota_planner.ledger.close()
+    
     def get_connected_devices(self, user_id: str) -> List[str]:
         """Get list of connected device types for a user"""
         if user_id in self.user_profiles:
@@ -331,6 +859,7 @@ class DeviceManager:
             profile = self.user_profiles[user_id]
             if device_type in profile.connected_devices:
                 del profile.connected_devices[device_type]
+                self.user_profiles.mark_dirty(user_id, immediate=True)
                 logger.info(f"Device {device_type} disconnected for user {user_id}")
     
     def get_data_quality_summary(self, user_id: str) -> Dict[str, Any]:
@@ -344,7 +873,8 @@ class DeviceManager:
             'connected_devices': len(profile.connected_devices),
             'data_quality_scores': profile.data_quality_scores,
             'last_sync': profile.last_full_sync,
-            'recent_errors': profile.sync_errors[-5:] if profile.sync_errors else [],
+            'recent_errors': profile.sync_history.recent_errors(5),
+            'sync_history': profile.sync_history.summary(),
             'overall_quality': (
                 sum(profile.data_quality_scores.values()) / 
                 len(profile.data_quality_scores)
@@ -354,33 +884,33 @@ class DeviceManager:
 
 # Example usage and testing
 async def test_device_manager():
-    """Test device manager functionality"""
+    """Test device manager functionality against the local mock vendor server"""
+    from .mock_vendor_server import MockVendorServer
+    
     manager = DeviceManager()
+    server = MockVendorServer()
+    await server.start()
+    for device_type in ('fitbit', 'oura'):
+        server.attach(manager.integrations[device_type])
     
     # Test user
     user_id = "test_user_123"
     
-    # Mock authentication (in production, this would use real credentials)
+    # The mock exchanges any authorization code for tokens of the user it names
     try:
-        # Authenticate Fitbit
-        fitbit_creds = {
-            'client_id': 'test_client_id',
-            'client_secret': 'test_client_secret',
-            'redirect_uri': 'http://localhost:8000/callback',
-            'authorization_code': 'mock_code',
-            'user_id': user_id
-        }
-        
-        # This would fail without real credentials, but shows the flow
-        # await manager.authenticate_device(user_id, 'fitbit', fitbit_creds)
-        
-        # Simulate connected devices
-        manager.user_profiles[user_id] = UserDeviceProfile(
-            user_id=user_id,
-            connected_devices={},
-            sync_preferences={},
-            data_quality_scores={'fitbit': 0.85, 'oura': 0.92}
-        )
+        for device_type in ('fitbit', 'oura'):
+            await manager.authenticate_device(user_id, device_type, {
+                'client_id': 'test_client_id',
+                'client_secret': 'test_client_secret',
+                'redirect_uri': 'http://localhost:8000/callback',
+                'authorization_code': user_id,
+                'user_id': user_id
+            })
+        
+        # Test sync
+        results = await manager.sync_user_data(user_id)
+        for device_type, result in results.items():
+            print(f"{device_type}: {result.metrics_synced} metrics, quality: {result.data_quality_score:.2f}")
         
         # Test aggregated metrics
         aggregated = await manager.get_aggregated_metrics(user_id)
@@ -391,9 +921,12 @@ async def test_device_manager():
         # Test data quality summary
         quality_summary = manager.get_data_quality_summary(user_id)
         print(f"Quality summary: {quality_summary}")
-        
+    
     except Exception as e:
         print(f"Test failed: {e}")
+    finally:
+        await manager.close()
+        await server.stop()
 
 if __name__ == "__main__":
     asyncio.run(test_device_manager())
@@ -0,0 +1,229 @@
+"""
+Feature store of per-user daily feature vectors for risk models
+Materializes one fixed-schema row per (user, day) from daily rollups and stitched
+sleep, recomputing only the rows whose 28-day window saw new data
+"""
+
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from loguru import logger
+import numpy as np
+
+from .common.rollups import EPOCH
+from .common.sleep_sessions import SleepStitcher
+from .metric_fusion import RankTable, metric_rank
+
+FEATURE_METRICS = [
+    'hrv_rmssd', 'resting_heart_rate', 'heart_rate', 'sleep_duration', 'sleep_efficiency',
+    'steps', 'active_minutes', 'readiness_score', 'body_temperature'
+]
+
+SHORT_WINDOW = 7
+LONG_WINDOW = 28
+
+# Per-metric statistics, in column order
+METRIC_FEATURES = ['mean_7d', 'mean_28d', 'trend_28d', 'std_28d', 'coverage_28d']
+SLEEP_FEATURES = ['sleep_onset_std_7d', 'sleep_midpoint_std_7d']
+
+FEATURE_NAMES = [
+    f"{metric_type}_{feature}" for metric_type in FEATURE_METRICS for feature in METRIC_FEATURES
+] + SLEEP_FEATURES
+
+def day_number(day: date) -> int:
+    return (day - EPOCH.date()).days
+
+@dataclass
+class FeatureMatrix:
+    """Contiguous feature block for batch scoring: row i is (user_ids[i], dates[i])"""
+    user_ids: np.ndarray        # object
+    dates: np.ndarray           # datetime64[D]
+    feature_names: List[str]
+    values: np.ndarray          # float32, shape (rows, features), C-contiguous; NaN = missing
+    
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.values.shape
+
+def _windows(values: np.ndarray, width: int) -> np.ndarray:
+    return np.lib.stride_tricks.sliding_window_view(values, width)
+
+def _window_stats(windows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """NaN-aware count, mean and population std along the last axis"""
+    present = ~np.isnan(windows)
+    counts = present.sum(axis=-1)
+    filled = np.where(present, windows, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = filled.sum(axis=-1) / counts
+        variance = (filled * filled).sum(axis=-1) / counts - means * means
+    return counts, means, np.sqrt(np.maximum(variance, 0.0))
+
+def _window_slopes(windows: np.ndarray) -> np.ndarray:
+    """NaN-aware least-squares slope per window (units per day)"""
+    present = ~np.isnan(windows)
+    x = np.broadcast_to(np.arange(windows.shape[-1], dtype=np.float64), windows.shape)
+    counts = present.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.where(present, x, 0.0).sum(axis=-1) / counts
+        y_mean = np.where(present, windows, 0.0).sum(axis=-1) / counts
+        dx = np.where(present, x - x_mean[..., None], 0.0)
+        dy = np.where(present, windows - y_mean[..., None], 0.0)
+        slopes = (dx * dy).sum(axis=-1) / (dx * dx).sum(axis=-1)
+    return np.where(counts >= 3, slopes, np.nan)
+
+class FeatureStore:
+    """
+    Incrementally maintained daily feature rows per user
+    """
+    
+    def __init__(self, store, rank_table: RankTable = None,
+                 sleep_stitcher: Optional[SleepStitcher] = None,
+                 metric_types: List[str] = None):
+        self.store = store
+        self.rank_table = rank_table or {}
+        self.sleep_stitcher = sleep_stitcher
+        self.metric_types = metric_types or FEATURE_METRICS
+        self.feature_names = [
+            f"{metric_type}_{feature}"
+            for metric_type in self.metric_types for feature in METRIC_FEATURES
+        ] + SLEEP_FEATURES
+        
+        # user_id -> day number -> feature row
+        self.rows: Dict[str, Dict[int, np.ndarray]] = {}
+        # user_id -> day numbers that received data since the last materialization
+        self._dirty: Dict[str, Set[int]] = {}
+        
+        store.listeners.append(self.on_write)
+    
+    def on_write(self, user_id: str, days: Set[int]):
+        """Metric store callback: a write touched these day numbers"""
+        self._dirty.setdefault(user_id, set()).update(days)
+    
+    def drop_users(self, user_ids: Set[str]):
+        for user_id in user_ids:
+            self.rows.pop(user_id, None)
+            self._dirty.pop(user_id, None)
+    
+    def _stale_days(self, user_id: str) -> Set[int]:
+        # A day's data feeds the rows of that day and the following window
+        stale = set()
+        for day in self._dirty.pop(user_id, ()):
+            stale.update(range(day, day + LONG_WINDOW))
+        return stale
+    
+    def _daily_values(self, user_id: str, metric_type: str,
+                      first_day: int, last_day: int) -> np.ndarray:
+        values = np.full(last_day - first_day + 1, np.nan)
+        sources = self.store.sources(user_id, metric_type)
+        if not sources:
+            return values
+        
+        source_device = min(sources, key=lambda d: metric_rank(self.rank_table, metric_type, d))
+        start = EPOCH + timedelta(days=first_day)
+        end = EPOCH + timedelta(days=last_day + 1)
+        for day_start, bucket in self.store.rollup(user_id, metric_type, start, end, 'day', source_device):
+            values[(day_start - start).days] = bucket.value(metric_type)
+        return values
+    
+    def _sleep_timing(self, user_id: str, first_day: int,
+                      last_day: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Onset and midpoint in hours after the previous noon, per wake date"""
+        onset = np.full(last_day - first_day + 1, np.nan)
+        midpoint = np.full(last_day - first_day + 1, np.nan)
+        if self.sleep_stitcher is None:
+            return onset, midpoint
+        
+        first_date = EPOCH.date() + timedelta(days=first_day)
+        last_date = EPOCH.date() + timedelta(days=last_day)
+        for night in self.sleep_stitcher.nights_between(user_id, first_date, last_date):
+            if not night.sleep_hours:
+                continue
+            noon = datetime.combine(night.date - timedelta(days=1), datetime.min.time()) + timedelta(hours=12)
+            i = day_number(night.date) - first_day
+            onset[i] = (night.start - noon).total_seconds() / 3600
+            midpoint[i] = onset[i] + (night.end - night.start).total_seconds() / 7200
+        return onset, midpoint
+    
+    def _compute_rows(self, user_id: str, first_day: int, last_day: int) -> np.ndarray:
+        """Feature rows for day numbers first_day..last_day, shape (days, features)"""
+        history_start = first_day - LONG_WINDOW + 1
+        n_days = last_day - first_day + 1
+        rows = np.empty((n_days, len(self.feature_names)), dtype=np.float32)
+        
+        column = 0
+        for metric_type in self.metric_types:
+            daily = self._daily_values(user_id, metric_type, history_start, last_day)
+            long_windows = _windows(daily, LONG_WINDOW)
+            counts, means, stds = _window_stats(long_windows)
+            _, short_means, _ = _window_stats(long_windows[:, -SHORT_WINDOW:])
+            
+            rows[:, column] = short_means
+            rows[:, column + 1] = means
+            rows[:, column + 2] = _window_slopes(long_windows)
+            rows[:, column + 3] = stds
+            rows[:, column + 4] = counts / LONG_WINDOW
+            column += len(METRIC_FEATURES)
+        
+        onset, midpoint = self._sleep_timing(user_id, history_start, last_day)
+        for values in (onset, midpoint):
+            counts, _, stds = _window_stats(_windows(values, LONG_WINDOW)[:, -SHORT_WINDOW:])
+            rows[:, column] = np.where(counts >= 2, stds, np.nan)
+            column += 1
+        
+        return rows
+    
+    def materialize(self, user_id: str, first_day: int = None, last_day: int = None) -> int:
+        """
+        Recompute stale rows for a user, plus any missing rows in [first_day, last_day]
+        Returns the number of rows written
+        """
+        user_rows = self.rows.setdefault(user_id, {})
+        
+        # Built rows whose window saw new data; unbuilt ones are computed when requested
+        days = {d for d in self._stale_days(user_id) if d in user_rows}
+        if first_day is not None and last_day is not None:
+            days.update(d for d in range(first_day, last_day + 1) if d not in user_rows)
+        if not days:
+            return 0
+        
+        # Compute contiguous runs in one vectorized pass each
+        ordered = sorted(days)
+        runs, run_start = [], ordered[0]
+        for previous, day in zip(ordered, ordered[1:]):
+            if day != previous + 1:
+                runs.append((run_start, previous))
+                run_start = day
+        runs.append((run_start, ordered[-1]))
+        
+        for run_first, run_last in runs:
+            computed = self._compute_rows(user_id, run_first, run_last)
+            for offset, row in enumerate(computed):
+                user_rows[run_first + offset] = row
+        
+        logger.debug(f"Materialized {len(days)} feature rows for user {user_id}")
+        return len(days)
+    
+    def get_features(self, user_ids: List[str], start_date: date,
+                     end_date: date) -> FeatureMatrix:
+        """
+        Feature rows for every user and day in [start_date, end_date] as one matrix,
+        ordered user-major; rows are brought up to date first
+        """
+        first_day, last_day = day_number(start_date), day_number(end_date)
+        n_days = max(last_day - first_day + 1, 0)
+        values = np.empty((len(user_ids) * n_days, len(self.feature_names)), dtype=np.float32)
+        
+        for u, user_id in enumerate(user_ids):
+            if n_days:
+                self.materialize(user_id, first_day, last_day)
+            user_rows = self.rows.get(user_id, {})
+            for offset in range(n_days):
+                values[u * n_days + offset] = user_rows[first_day + offset]
+        
+        dates = np.datetime64(start_date, 'D') + np.arange(n_days)
+        return FeatureMatrix(
+            user_ids=np.repeat(np.array(user_ids, dtype=object), n_days),
+            dates=np.tile(dates, len(user_ids)),
+            feature_names=list(self.feature_names),
+            values=values
+        )
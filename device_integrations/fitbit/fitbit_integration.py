@@ -14,6 +14,8 @@ from loguru import logger
 from ..common.base_device import (
     BaseDeviceIntegration, HealthMetric, DeviceConnection, SyncResult
 )
+from ..common.sleep_sessions import SleepSession
+from ..common.tracing import span
 
 class FitbitIntegration(BaseDeviceIntegration):
     """
@@ -46,7 +48,8 @@ class FitbitIntegration(BaseDeviceIntegration):
         ]
         
         # Rate limiting (Fitbit allows 150 requests per hour per user)
-        self.rate_limit_delay = 24  # seconds (150 requests / 3600 seconds)
+        self.request_interval = 24  # seconds (150 requests / 3600 seconds)
+        self.rate_limit_delay = self.request_interval
     
     async def authenticate(self, credentials: Dict[str, str]) -> DeviceConnection:
         """
@@ -166,45 +169,55 @@ class FitbitIntegration(BaseDeviceIntegration):
         try:
             # Activity data (steps, distance, calories)
             if any(m in metric_types for m in ['steps', 'distance_km', 'calories_burned']):
-                activity_metrics = await self._sync_activity_data(
-                    connection, start_date, end_date
-                )
+                with span('sync.activity'):
+                    activity_metrics = await self._sync_activity_data(
+                        connection, start_date, end_date
+                    )
                 all_metrics.extend(activity_metrics)
             
             # Heart rate data
             if 'heart_rate' in metric_types:
-                hr_metrics = await self._sync_heart_rate_data(
-                    connection, start_date, end_date
-                )
+                with span('sync.heart_rate'):
+                    hr_metrics = await self._sync_heart_rate_data(
+                        connection, start_date, end_date
+                    )
                 all_metrics.extend(hr_metrics)
             
             # Sleep data
             if any(m in metric_types for m in ['sleep_duration', 'sleep_efficiency']):
-                sleep_metrics = await self._sync_sleep_data(
-                    connection, start_date, end_date
-                )
+                with span('sync.sleep'):
+                    sleep_metrics = await self._sync_sleep_data(
+                        connection, start_date, end_date
+                    )
                 all_metrics.extend(sleep_metrics)
             
             # Weight and body composition
             if any(m in metric_types for m in ['weight_kg', 'body_fat_percent']):
-                weight_metrics = await self._sync_weight_data(
-                    connection, start_date, end_date
-                )
+                with span('sync.weight'):
+                    weight_metrics = await self._sync_weight_data(
+                        connection, start_date, end_date
+                    )
                 all_metrics.extend(weight_metrics)
-            
+        
         except Exception as e:
             logger.error(f"Error during Fitbit sync: {e}")
             errors.append(str(e))
         
         # Clean and validate metrics
-        all_metrics = self.detect_outliers(all_metrics)
-        validated_metrics = [
-            m for m in all_metrics 
-            if self.validate_metric_value(m.metric_type, m.value)
-        ]
+        with span('outliers', metrics=len(all_metrics)):
+            all_metrics = self.detect_outliers(all_metrics)
+        with span('validation'):
+            validated_metrics = [
+                m for m in all_metrics 
+                if self.validate_metric_value(m.metric_type, m.value)
+            ]
+        ingest_stats = await self.ingest_metrics(connection, validated_metrics)
         
         # Calculate data quality score
-        quality_score = self.calculate_quality_score(validated_metrics)
+        with span('quality'):
+            quality_score = self.calculate_quality_score(
+                validated_metrics, user_id=connection.user_id
+            )
         
         # Update connection last sync time
         connection.last_sync = datetime.now()
@@ -214,10 +227,15 @@ class FitbitIntegration(BaseDeviceIntegration):
             metrics_synced=len(validated_metrics),
             errors=errors,
             last_sync_time=connection.last_sync,
-            data_quality_score=quality_score
+            data_quality_score=quality_score,
+            ingest_stats=ingest_stats
         )
         
-        logger.info(f"Fitbit sync completed: {len(validated_metrics)} metrics, quality: {quality_score:.2f}")
+        logger.info(
+            f"Fitbit sync completed: {len(validated_metrics)} metrics "
+            f"({ingest_stats.inserted} new, {ingest_stats.updated} revised, "
+            f"{ingest_stats.unchanged} unchanged), quality: {quality_score:.2f}"
+        )
         return result
     
     async def _sync_activity_data(self, connection: DeviceConnection,
@@ -240,7 +258,7 @@ class FitbitIntegration(BaseDeviceIntegration):
                     connection, 'GET', url
                 ) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = await self.read_json(response)
                         summary = data.get('summary', {})
                         
                         # Extract metrics
@@ -272,8 +290,8 @@ class FitbitIntegration(BaseDeviceIntegration):
                                 source_device='fitbit'
                             ))
                     
-                    await asyncio.sleep(self.rate_limit_delay)
-                    
+                    await self.pace()
+            
             except Exception as e:
                 logger.error(f"Error syncing Fitbit activity for {date_str}: {e}")
             
@@ -300,7 +318,7 @@ class FitbitIntegration(BaseDeviceIntegration):
                     connection, 'GET', url
                 ) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = await self.read_json(response)
                         
                         # Resting heart rate
                         if 'activities-heart' in data and data['activities-heart']:
@@ -330,8 +348,8 @@ class FitbitIntegration(BaseDeviceIntegration):
                                     source_device='fitbit'
                                 ))
                     
-                    await asyncio.sleep(self.rate_limit_delay)
-                    
+                    await self.pace()
+            
             except Exception as e:
                 logger.error(f"Error syncing Fitbit heart rate for {date_str}: {e}")
             
@@ -358,10 +376,13 @@ class FitbitIntegration(BaseDeviceIntegration):
                     connection, 'GET', url
                 ) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = await self.read_json(response)
                         
                         if 'sleep' in data:
                             for sleep_session in data['sleep']:
+                                # Naps are kept as intervals so stitching can merge them
+                                self._record_fitbit_sleep_session(connection, sleep_session)
+                                
                                 if sleep_session.get('isMainSleep', True):
                                     # Sleep duration
                                     duration_ms = sleep_session.get('duration', 0)
@@ -371,12 +392,15 @@ class FitbitIntegration(BaseDeviceIntegration):
                                         sleep_session.get('startTime', '')
                                     )
                                     
+                                    # Main sleep is keyed on date + family so a revised
+                                    # startTime replaces the earlier record
                                     metrics.append(HealthMetric(
                                         metric_type='sleep_duration',
                                         value=duration_hours,
                                         unit='hours',
                                         timestamp=start_time,
-                                        source_device='fitbit'
+                                        source_device='fitbit',
+                                        metadata={'natural_id': f"sleep:{date_str}"}
                                     ))
                                     
                                     # Sleep efficiency
@@ -387,11 +411,12 @@ class FitbitIntegration(BaseDeviceIntegration):
                                             value=float(efficiency),
                                             unit='percent',
                                             timestamp=start_time,
-                                            source_device='fitbit'
+                                            source_device='fitbit',
+                                            metadata={'natural_id': f"sleep:{date_str}"}
                                         ))
                     
-                    await asyncio.sleep(self.rate_limit_delay)
-                    
+                    await self.pace()
+            
             except Exception as e:
                 logger.error(f"Error syncing Fitbit sleep for {date_str}: {e}")
             
@@ -399,6 +424,34 @@ class FitbitIntegration(BaseDeviceIntegration):
         
         return metrics
     
+    def _record_fitbit_sleep_session(self, connection: DeviceConnection,
+                                     sleep_session: Dict[str, Any]):
+        """Record a Fitbit sleep log as an interval for cross-device stitching"""
+        start_time = sleep_session.get('startTime')
+        end_time = sleep_session.get('endTime')
+        if not start_time or not end_time:
+            return
+        
+        minutes_asleep = sleep_session.get('minutesAsleep')
+        if minutes_asleep is not None:
+            sleep_hours = minutes_asleep / 60
+        else:
+            sleep_hours = sleep_session.get('duration', 0) / (1000 * 60 * 60)
+        
+        efficiency = sleep_session.get('efficiency')
+        log_id = sleep_session.get('logId')
+        
+        self.record_sleep_session(SleepSession(
+            user_id=connection.user_id,
+            source_device='fitbit',
+            start=self.normalize_timestamp(start_time),
+            end=self.normalize_timestamp(end_time),
+            sleep_hours=sleep_hours,
+            efficiency=float(efficiency) if efficiency else None,
+            session_id=str(log_id) if log_id is not None else None,
+            is_main_sleep=sleep_session.get('isMainSleep', True)
+        ))
+    
     async def _sync_weight_data(self, connection: DeviceConnection,
                                start_date: datetime, end_date: datetime) -> List[HealthMetric]:
         """Sync weight and body composition data"""
@@ -415,7 +468,7 @@ class FitbitIntegration(BaseDeviceIntegration):
                 connection, 'GET', url
             ) as response:
                 if response.status == 200:
-                    data = await response.json()
+                    data = await self.read_json(response)
                     
                     if 'weight' in data:
                         for weight_entry in data['weight']:
@@ -478,35 +531,38 @@ class FitbitIntegration(BaseDeviceIntegration):
 
 # Example usage and testing
 async def test_fitbit_integration():
-    """Test Fitbit integration functionality"""
+    """Test Fitbit integration functionality against the local mock vendor server"""
+    from ..mock_vendor_server import MockVendorServer
+    
     fitbit = FitbitIntegration()
-
-    # Mock credentials for testing
+    
+    # The mock exchanges any authorization code for tokens of the user it names
     test_credentials = {
         'client_id': 'your_fitbit_client_id',
         'client_secret': 'your_fitbit_client_secret',
         'redirect_uri': 'http://localhost:8000/callback',
-        'authorization_code': 'mock_auth_code',
+        'authorization_code': 'test_user_123',
         'user_id': 'test_user_123'
     }
-
-    async with fitbit:
+    
+    async with MockVendorServer() as server, fitbit:
+        server.attach(fitbit)
         try:
             # Test authentication
             connection = await fitbit.authenticate(test_credentials)
             print(f"Authentication successful: {connection.user_id}")
-
+            
             # Test available metrics
             metrics = await fitbit.get_available_metrics(connection)
             print(f"Available metrics: {metrics}")
-
+            
             # Test data sync
             end_date = datetime.now()
             start_date = end_date - timedelta(days=7)
-
+            
             result = await fitbit.sync_metrics(connection, start_date, end_date)
             print(f"Sync result: {result.metrics_synced} metrics, quality: {result.data_quality_score}")
-
+        
         except Exception as e:
             print(f"Test failed: {e}")
 
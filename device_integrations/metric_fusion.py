@@ -0,0 +1,140 @@
+"""
+Multi-device metric fusion
+Merges time-sorted streams from every device per metric type and picks or blends
+a value per time bucket using a precomputed (metric_type, device) rank table
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple, Union
+import numpy as np
+
+from .common.rollups import ADDITIVE_METRICS, epoch_seconds, resolution_seconds
+
+# (metric_type, device_type) -> rank, 0 is most preferred
+RankTable = Dict[Tuple[str, str], int]
+
+# Devices missing from a metric's priority list rank after every listed device
+UNRANKED = 1 << 16
+
+def build_rank_table(metric_priorities: Dict[str, List[str]]) -> RankTable:
+    """Flatten DeviceManager.metric_priorities into O(1) rank lookups"""
+    return {
+        (metric_type, device_type): rank
+        for metric_type, devices in metric_priorities.items()
+        for rank, device_type in enumerate(devices)
+    }
+
+def metric_rank(rank_table: RankTable, metric_type: str, device_type: str) -> int:
+    return rank_table.get((metric_type, device_type), UNRANKED)
+
+@dataclass
+class FusedSeries:
+    """One fused value per time bucket for a user's metric"""
+    metric_type: str
+    bucket_starts: np.ndarray   # datetime64[s]
+    values: np.ndarray          # float64, NaN where no device reported
+    quality: np.ndarray         # float64
+    sources: np.ndarray         # device of the chosen value ('' when blended or empty)
+    
+    def __len__(self) -> int:
+        return len(self.values)
+
+class MetricFusionEngine:
+    """
+    Vectorized source selection over a whole date range
+    """
+    
+    def __init__(self, metric_priorities: Dict[str, List[str]], store):
+        self.rank_table = build_rank_table(metric_priorities)
+        self.store = store
+    
+    def _device_buckets(self, user_id: str, metric_type: str, device_type: str,
+                        start: datetime, end: datetime, step: int,
+                        n_buckets: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Per-bucket value and mean quality for one device (NaN where empty)"""
+        timestamps, values, quality = self.store.read_arrays(
+            user_id, metric_type, start, end, device_type
+        )
+        bucket = ((timestamps - int(epoch_seconds(start) * 1000)) // (step * 1000)).astype(np.int64)
+        counts = np.bincount(bucket, minlength=n_buckets)[:n_buckets]
+        sums = np.bincount(bucket, weights=values, minlength=n_buckets)[:n_buckets]
+        quality_sums = np.bincount(bucket, weights=quality, minlength=n_buckets)[:n_buckets]
+        
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bucket_values = sums if metric_type in ADDITIVE_METRICS else sums / counts
+            bucket_quality = quality_sums / counts
+        bucket_values = np.where(counts > 0, bucket_values, np.nan)
+        return bucket_values, np.where(counts > 0, bucket_quality, 0.0)
+    
+    def fuse(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+             resolution: Union[str, timedelta] = 'day',
+             strategy: str = 'select') -> FusedSeries:
+        """
+        Fuse all devices for [start, end) into one series at the given resolution
+        
+        strategy='select' keeps the best-ranked device per bucket (quality breaks ties);
+        strategy='blend' averages devices weighted by quality / (1 + rank)
+        """
+        if strategy not in ('select', 'blend'):
+            raise ValueError(f"Unknown fusion strategy: {strategy}")
+        
+        step = resolution_seconds(resolution)
+        n_buckets = max(int(np.ceil((epoch_seconds(end) - epoch_seconds(start)) / step)), 0)
+        first_bucket = np.datetime64(int(epoch_seconds(start)), 's')
+        bucket_starts = first_bucket + np.arange(n_buckets) * np.timedelta64(step, 's')
+        
+        devices = self.store.sources(user_id, metric_type)
+        if not devices or not n_buckets:
+            return FusedSeries(
+                metric_type, bucket_starts, np.full(n_buckets, np.nan),
+                np.zeros(n_buckets), np.full(n_buckets, '', dtype=object)
+            )
+        
+        per_device = [
+            self._device_buckets(user_id, metric_type, device, start, end, step, n_buckets)
+            for device in devices
+        ]
+        values = np.vstack([v for v, _ in per_device])    # (devices, buckets)
+        quality = np.vstack([q for _, q in per_device])
+        present = ~np.isnan(values)
+        ranks = np.array([metric_rank(self.rank_table, metric_type, d) for d in devices],
+                         dtype=np.float64)[:, None]
+        any_present = present.any(axis=0)
+        
+        if strategy == 'select':
+            # Rank dominates; quality (0-1) only separates devices of equal rank
+            score = np.where(present, ranks - 0.5 * quality, np.inf)
+            best = np.argmin(score, axis=0)
+            columns = np.arange(n_buckets)
+            fused_values = np.where(any_present, values[best, columns], np.nan)
+            fused_quality = np.where(any_present, quality[best, columns], 0.0)
+            sources = np.where(any_present, np.array(devices, dtype=object)[best], '')
+        else:
+            # Small floor keeps zero-quality samples usable when nothing better exists
+            capped_ranks = np.minimum(ranks, len(devices))
+            weights = np.where(present, (quality + 1e-6) / (1 + capped_ranks), 0.0)
+            weight_sums = weights.sum(axis=0)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                fused_values = np.where(
+                    any_present,
+                    (np.where(present, values, 0.0) * weights).sum(axis=0) / weight_sums,
+                    np.nan
+                )
+                fused_quality = np.where(
+                    any_present,
+                    np.where(present, quality, 0.0).sum(axis=0) / present.sum(axis=0),
+                    0.0
+                )
+            sources = np.full(n_buckets, '', dtype=object)
+        
+        return FusedSeries(metric_type, bucket_starts, fused_values, fused_quality, sources)
+    
+    def fuse_many(self, user_id: str, metric_types: List[str], start: datetime, end: datetime,
+                  resolution: Union[str, timedelta] = 'day',
+                  strategy: str = 'select') -> Dict[str, FusedSeries]:
+        """Fuse several metric types over the same range"""
+        return {
+            metric_type: self.fuse(user_id, metric_type, start, end, resolution, strategy)
+            for metric_type in metric_types
+        }
@@ -0,0 +1,625 @@
+"""
+Local stand-in for the Fitbit and Oura web APIs
+Serves the endpoints the integrations call with deterministic synthetic data for any
+user, plus configurable latency, rate limiting, 429/5xx injection, token expiry and
+pagination, so syncs can be exercised and load-tested without network access
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import zlib
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from aiohttp import web
+from loguru import logger
+import numpy as np
+
+MOCK_VENDORS = ('fitbit', 'oura')
+
+def attach_integration(url: str, integration):
+    """Point an integration at a mock server at url (usable without the server object)"""
+    vendor = integration.device_type
+    if vendor not in MOCK_VENDORS:
+        raise ValueError(f"No mock for device type: {vendor}")
+    
+    integration.base_url = f"{url}/{vendor}"
+    integration.token_url = f"{url}/{vendor}/oauth2/token" if vendor == 'fitbit' \
+        else f"{url}/{vendor}/oauth/token"
+    integration.request_interval = 0.0
+    integration.rate_limit_delay = 0.0
+
+def attach_manager(url: str, manager):
+    """
+    Attach every mocked integration of a DeviceManager; picklable as
+    functools.partial(attach_manager, url) for sharded worker setup
+    """
+    for vendor in MOCK_VENDORS:
+        attach_integration(url, manager.integrations[vendor])
+
+@dataclass
+class LatencyModel:
+    """Per-request latency distribution in milliseconds"""
+    kind: str = 'lognormal'     # 'fixed' | 'uniform' | 'lognormal' | 'exponential'
+    median_ms: float = 0.0
+    spread: float = 0.5         # lognormal sigma, or uniform half-width as a fraction
+    max_ms: float = 10_000.0
+    
+    def sample(self, rng: random.Random) -> float:
+        if self.median_ms <= 0:
+            return 0.0
+        if self.kind == 'fixed':
+            delay = self.median_ms
+        elif self.kind == 'uniform':
+            delay = rng.uniform(self.median_ms * (1 - self.spread), self.median_ms * (1 + self.spread))
+        elif self.kind == 'exponential':
+            delay = rng.expovariate(math.log(2) / self.median_ms)
+        elif self.kind == 'lognormal':
+            delay = rng.lognormvariate(math.log(self.median_ms), self.spread)
+        else:
+            raise ValueError(f"Unknown latency distribution: {self.kind}")
+        return min(max(delay, 0.0), self.max_ms)
+
+@dataclass
+class MockVendorConfig:
+    """Behaviour of the mock vendors; the defaults answer instantly and never fail"""
+    seed: int = 0
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    
+    # Failure injection: probability per data request
+    error_rate: float = 0.0         # 500/502/503
+    throttle_rate: float = 0.0      # 429 regardless of remaining quota
+    retry_after: int = 1            # seconds, sent with every 429
+    
+    # Per-user request quota, reported in rate-limit headers; None disables it
+    rate_limit: Optional[int] = None
+    rate_limit_window: float = 3600.0
+    
+    # Access tokens stop working this many seconds after issue
+    token_ttl: float = 3600.0
+    
+    # Items per page for Oura collections; 0 returns everything in one page
+    page_size: int = 0
+    
+    # Fitbit intraday heart rate resolution in seconds; 0 disables intraday
+    intraday_interval: int = 60
+
+@dataclass
+class UserTraits:
+    """Stable per-user physiology the daily data varies around"""
+    resting_hr: float
+    steps: float
+    sleep_hours: float
+    bedtime_hour: float
+    weight_kg: float
+    body_fat: float
+    temperature_deviation: float
+
+@dataclass
+class VendorStats:
+    """Request counts by endpoint and status"""
+    requests: int = 0
+    by_status: Dict[int, int] = field(default_factory=dict)
+    by_endpoint: Dict[str, int] = field(default_factory=dict)
+    tokens_issued: int = 0
+    tokens_refreshed: int = 0
+    
+    def record(self, endpoint: str, status: int):
+        self.requests += 1
+        self.by_status[status] = self.by_status.get(status, 0) + 1
+        self.by_endpoint[endpoint] = self.by_endpoint.get(endpoint, 0) + 1
+
+def _stable_hash(text: str) -> int:
+    return zlib.crc32(text.encode())
+
+class SyntheticData:
+    """
+    Deterministic per-(user, day) data: the same seed, user and date always produce
+    the same payload, independent of request order
+    """
+    
+    def __init__(self, seed: int = 0):
+        self.seed = seed
+        self._traits: Dict[str, UserTraits] = {}
+    
+    def rng(self, *parts: Any) -> np.random.Generator:
+        return np.random.default_rng([self.seed] + [_stable_hash(str(p)) for p in parts])
+    
+    def traits(self, user_id: str) -> UserTraits:
+        traits = self._traits.get(user_id)
+        if traits is None:
+            rng = self.rng('traits', user_id)
+            traits = self._traits[user_id] = UserTraits(
+                resting_hr=float(rng.uniform(50, 75)),
+                steps=float(rng.uniform(4000, 13000)),
+                sleep_hours=float(rng.uniform(6.0, 8.5)),
+                bedtime_hour=float(rng.uniform(21.5, 24.5)),
+                weight_kg=float(rng.uniform(55, 105)),
+                body_fat=float(rng.uniform(12, 35)),
+                temperature_deviation=float(rng.normal(0, 0.1)),
+            )
+        return traits
+    
+    def activity(self, user_id: str, day: date) -> Dict[str, float]:
+        traits = self.traits(user_id)
+        rng = self.rng('activity', user_id, day.toordinal())
+        # Weekends are less active
+        steps = max(traits.steps * (0.8 if day.weekday() >= 5 else 1.0) * rng.lognormal(0, 0.3), 0)
+        return {
+            'steps': int(steps),
+            'distance_km': round(steps * 0.00075, 2),
+            'calories': int(1600 + steps * 0.045 + rng.normal(0, 80)),
+            'active_calories': int(steps * 0.045 + max(rng.normal(0, 40), 0)),
+            'active_minutes': int(steps / 120),
+            'score': int(np.clip(rng.normal(75, 10), 0, 100)),
+        }
+    
+    def heart_rate(self, user_id: str, day: date) -> float:
+        traits = self.traits(user_id)
+        return float(round(traits.resting_hr + self.rng('rhr', user_id, day.toordinal()).normal(0, 2)))
+    
+    def intraday_heart_rate(self, user_id: str, day: date, interval: int) -> np.ndarray:
+        """Heart rate every `interval` seconds: circadian curve plus activity bursts"""
+        traits = self.traits(user_id)
+        rng = self.rng('intraday', user_id, day.toordinal(), interval)
+        hours = np.arange(0, 86400, interval) / 3600
+        circadian = 12 * np.clip(np.sin((hours - 6) / 24 * 2 * np.pi) + 0.3, 0, None)
+        bursts = (rng.random(len(hours)) < 0.02) * rng.uniform(20, 60, len(hours))
+        noise = rng.normal(0, 3, len(hours))
+        return np.clip(np.round(traits.resting_hr + 5 + circadian + bursts + noise), 35, 200)
+    
+    def sleep(self, user_id: str, wake_day: date) -> Dict[str, Any]:
+        """The main sleep ending on wake_day"""
+        traits = self.traits(user_id)
+        rng = self.rng('sleep', user_id, wake_day.toordinal())
+        bedtime = datetime.combine(wake_day - timedelta(days=1), datetime.min.time()) + timedelta(
+            hours=traits.bedtime_hour + rng.normal(0, 0.5)
+        )
+        asleep_hours = float(np.clip(traits.sleep_hours + rng.normal(0, 0.6), 3, 11))
+        efficiency = int(np.clip(rng.normal(88, 4), 60, 99))
+        in_bed = timedelta(hours=asleep_hours * 100 / efficiency)
+        rem, deep = rng.uniform(0.18, 0.25), rng.uniform(0.12, 0.2)
+        return {
+            'id': f"{user_id}-{wake_day.isoformat()}",
+            'start': bedtime.replace(second=0, microsecond=0),
+            'end': (bedtime + in_bed).replace(second=0, microsecond=0),
+            'asleep_seconds': int(asleep_hours * 3600),
+            'efficiency': efficiency,
+            'rem_seconds': int(asleep_hours * 3600 * rem),
+            'deep_seconds': int(asleep_hours * 3600 * deep),
+            'light_seconds': int(asleep_hours * 3600 * (1 - rem - deep)),
+            'lowest_hr': int(traits.resting_hr - rng.uniform(2, 6)),
+            'average_hr': int(traits.resting_hr + rng.uniform(0, 5)),
+        }
+    
+    def readiness(self, user_id: str, day: date) -> Dict[str, float]:
+        traits = self.traits(user_id)
+        rng = self.rng('readiness', user_id, day.toordinal())
+        return {
+            'score': int(np.clip(rng.normal(78, 8), 0, 100)),
+            'temperature_deviation': round(float(traits.temperature_deviation + rng.normal(0, 0.15)), 2),
+        }
+    
+    def weight(self, user_id: str, day: date) -> Optional[Dict[str, float]]:
+        """Weigh-ins happen on roughly a third of days"""
+        traits = self.traits(user_id)
+        rng = self.rng('weight', user_id, day.toordinal())
+        if rng.random() > 0.35:
+            return None
+        return {
+            'weight': round(traits.weight_kg + rng.normal(0, 0.4), 1),
+            'fat': round(traits.body_fat + rng.normal(0, 0.5), 1),
+        }
+
+def _days(start: date, end: date) -> List[date]:
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+def _parse_day(text: str) -> date:
+    return datetime.strptime(text, '%Y-%m-%d').date()
+
+class MockVendorServer:
+    """
+    aiohttp application serving /fitbit/... and /oura/... like the real vendors
+        
+        async with MockVendorServer(MockVendorConfig(page_size=50)) as server:
+            server.attach(fitbit)
+            connection = server.connect(fitbit, 'user-1')
+            await fitbit.sync_metrics(connection, start, end)
+    """
+    
+    def __init__(self, config: MockVendorConfig = None):
+        self.config = config or MockVendorConfig()
+        self.data = SyntheticData(self.config.seed)
+        self.stats: Dict[str, VendorStats] = {vendor: VendorStats() for vendor in MOCK_VENDORS}
+        
+        # access token -> (vendor, user_id, expires at monotonic seconds)
+        self.tokens: Dict[str, Tuple[str, str, float]] = {}
+        # refresh token -> (vendor, user_id)
+        self.refresh_tokens: Dict[str, Tuple[str, str]] = {}
+        # (vendor, user_id) -> (window start monotonic seconds, requests in window)
+        self.quota_windows: Dict[Tuple[str, str], Tuple[float, int]] = {}
+        
+        self._rng = random.Random(self.config.seed)
+        self._token_counter = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+        
+        self.app = web.Application(middlewares=[self._vendor_middleware])
+        self.app.add_routes([
+            web.post('/fitbit/oauth2/token', self._token),
+            web.get('/fitbit/1/user/-/activities/date/{day}.json', self._fitbit_activity),
+            web.get('/fitbit/1/user/-/activities/heart/date/{day}/1d.json', self._fitbit_heart),
+            web.get('/fitbit/1.2/user/-/sleep/date/{day}.json', self._fitbit_sleep),
+            web.get('/fitbit/1/user/-/body/log/weight/date/{start}/{end}.json', self._fitbit_weight),
+            web.post('/oura/oauth/token', self._token),
+            web.get('/oura/v2/usercollection/sleep', self._oura_sleep),
+            web.get('/oura/v2/usercollection/daily_activity', self._oura_activity),
+            web.get('/oura/v2/usercollection/daily_readiness', self._oura_readiness),
+            web.get('/oura/v2/usercollection/heartrate', self._oura_heartrate),
+        ])
+    
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Start listening; port 0 picks a free port. Returns the base URL"""
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}"
+        logger.info(f"Mock vendor server listening on {self.url}")
+        return self.url
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+    
+    def attach(self, integration):
+        """Point an integration at this server and drop its real-API request pacing"""
+        attach_integration(self.url, integration)
+    
+    def issue_token(self, vendor: str, user_id: str) -> Dict[str, Any]:
+        """Token response body as the vendor's token endpoint returns it"""
+        self._token_counter += 1
+        access_token = f"{vendor}-{user_id}-access-{self._token_counter}"
+        refresh_token = f"{vendor}-{user_id}-refresh-{self._token_counter}"
+        self.tokens[access_token] = (vendor, user_id, time.monotonic() + self.config.token_ttl)
+        self.refresh_tokens[refresh_token] = (vendor, user_id)
+        self.stats[vendor].tokens_issued += 1
+        return {
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_in': int(self.config.token_ttl),
+            'token_type': 'Bearer',
+            'scope': 'activity heartrate sleep weight' if vendor == 'fitbit' else 'personal daily',
+            'user_id': user_id,
+        }
+    
+    def connect(self, integration, user_id: str):
+        """A DeviceConnection for the user, skipping the authorization-code exchange"""
+        from .common.base_device import DeviceConnection
+        
+        token = self.issue_token(integration.device_type, user_id)
+        return DeviceConnection(
+            user_id=user_id,
+            device_type=integration.device_type,
+            access_token=token['access_token'],
+            refresh_token=token['refresh_token'],
+            token_expires_at=datetime.now() + timedelta(seconds=token['expires_in']),
+            permissions=token['scope'].split(),
+            status='active'
+        )
+    
+    def expire_tokens(self, vendor: str = None):
+        """Make current access tokens fail with 401, as if their TTL had passed"""
+        for token, (token_vendor, user_id, _) in list(self.tokens.items()):
+            if vendor is None or token_vendor == vendor:
+                self.tokens[token] = (token_vendor, user_id, 0.0)
+    
+    @web.middleware
+    async def _vendor_middleware(self, request: web.Request, handler):
+        """Latency, auth, quota and failure injection shared by every endpoint"""
+        vendor = request.path.split('/', 2)[1]
+        endpoint = request.match_info.route.resource.canonical if request.match_info.route.resource else request.path
+        
+        delay = self.config.latency.sample(self._rng)
+        if delay:
+            await asyncio.sleep(delay / 1000)
+        
+        if request.method == 'POST':
+            response = await handler(request)
+            self.stats[vendor].record(endpoint, response.status)
+            return response
+        
+        response = self._check_request(request, vendor)
+        if response is None:
+            response = await handler(request)
+        
+        self._add_rate_limit_headers(response, vendor, request.get('user_id'))
+        self.stats[vendor].record(endpoint, response.status)
+        return response
+    
+    def _check_request(self, request: web.Request, vendor: str) -> Optional[web.Response]:
+        """An error response if the request is rejected, else None"""
+        authorization = request.headers.get('Authorization', '')
+        token = self.tokens.get(authorization[len('Bearer '):]) if authorization.startswith('Bearer ') else None
+        if token is None or token[0] != vendor:
+            return self._error(401, 'invalid_token', 'Access token invalid')
+        if token[2] <= time.monotonic():
+            return self._error(401, 'expired_token', 'Access token expired')
+        user_id = request['user_id'] = token[1]
+        
+        if self.config.rate_limit is not None:
+            now = time.monotonic()
+            window_start, used = self.quota_windows.get((vendor, user_id), (now, 0))
+            if now - window_start >= self.config.rate_limit_window:
+                window_start, used = now, 0
+            if used >= self.config.rate_limit:
+                return self._throttled(window_start + self.config.rate_limit_window - now)
+            self.quota_windows[(vendor, user_id)] = (window_start, used + 1)
+        
+        roll = self._rng.random()
+        if roll < self.config.throttle_rate:
+            return self._throttled(self.config.retry_after)
+        if roll < self.config.throttle_rate + self.config.error_rate:
+            status = self._rng.choice((500, 502, 503))
+            return self._error(status, 'server_error', 'Injected failure')
+        return None
+    
+    def _error(self, status: int, error_type: str, message: str) -> web.Response:
+        return web.json_response(
+            {'errors': [{'errorType': error_type, 'message': message}], 'success': False},
+            status=status
+        )
+    
+    def _throttled(self, retry_after: float) -> web.Response:
+        response = self._error(429, 'rate_limit_exceeded', 'Too many requests')
+        response.headers['Retry-After'] = str(max(int(math.ceil(retry_after)), 1))
+        return response
+    
+    def _add_rate_limit_headers(self, response: web.Response, vendor: str, user_id: Optional[str]):
+        if self.config.rate_limit is None or user_id is None:
+            return
+        
+        window_start, used = self.quota_windows.get((vendor, user_id), (time.monotonic(), 0))
+        reset = max(int(window_start + self.config.rate_limit_window - time.monotonic()), 0)
+        remaining = max(self.config.rate_limit - used, 0)
+        if vendor == 'fitbit':
+            response.headers['Fitbit-Rate-Limit-Limit'] = str(self.config.rate_limit)
+            response.headers['Fitbit-Rate-Limit-Remaining'] = str(remaining)
+            response.headers['Fitbit-Rate-Limit-Reset'] = str(reset)
+        else:
+            response.headers['X-RateLimit-Limit'] = str(self.config.rate_limit)
+            response.headers['X-RateLimit-Remaining'] = str(remaining)
+            response.headers['X-RateLimit-Reset'] = str(reset)
+    
+    async def _token(self, request: web.Request) -> web.Response:
+        """authorization_code grants use the code as the user id; refresh_token rotates"""
+        vendor = request.path.split('/', 2)[1]
+        form = await request.post()
+        grant_type = form.get('grant_type')
+        
+        if grant_type == 'authorization_code' and form.get('code'):
+            return web.json_response(self.issue_token(vendor, form['code']))
+        
+        if grant_type == 'refresh_token':
+            owner = self.refresh_tokens.pop(form.get('refresh_token', ''), None)
+            if owner is None or owner[0] != vendor:
+                return self._error(400, 'invalid_grant', 'Refresh token invalid')
+            self.stats[vendor].tokens_refreshed += 1
+            return web.json_response(self.issue_token(vendor, owner[1]))
+        
+        return self._error(400, 'invalid_request', 'Unsupported grant')
+    
+    # Fitbit
+    
+    async def _fitbit_activity(self, request: web.Request) -> web.Response:
+        day = _parse_day(request.match_info['day'])
+        activity = self.data.activity(request['user_id'], day)
+        return web.json_response({
+            'activities': [],
+            'summary': {
+                'steps': activity['steps'],
+                'distances': [{'activity': 'total', 'distance': activity['distance_km']}],
+                'caloriesOut': activity['calories'],
+                'activityCalories': activity['active_calories'],
+                'fairlyActiveMinutes': activity['active_minutes'] // 2,
+                'veryActiveMinutes': activity['active_minutes'] - activity['active_minutes'] // 2,
+            }
+        })
+    
+    async def _fitbit_heart(self, request: web.Request) -> web.Response:
+        user_id = request['user_id']
+        day = _parse_day(request.match_info['day'])
+        body: Dict[str, Any] = {
+            'activities-heart': [{
+                'dateTime': day.isoformat(),
+                'value': {'restingHeartRate': int(self.data.heart_rate(user_id, day)), 'heartRateZones': []}
+            }]
+        }
+        
+        interval = self.config.intraday_interval
+        if interval:
+            values = self.data.intraday_heart_rate(user_id, day, interval)
+            body['activities-heart-intraday'] = {
+                'dataset': [
+                    {'time': f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}", 'value': int(v)}
+                    for s, v in zip(range(0, 86400, interval), values.tolist())
+                ],
+                'datasetInterval': max(interval // 60, 1),
+                'datasetType': 'minute' if interval >= 60 else 'second',
+            }
+        return web.json_response(body)
+    
+    async def _fitbit_sleep(self, request: web.Request) -> web.Response:
+        day = _parse_day(request.match_info['day'])
+        sleep = self.data.sleep(request['user_id'], day)
+        return web.json_response({
+            'sleep': [{
+                'logId': _stable_hash(sleep['id']),
+                'dateOfSleep': day.isoformat(),
+                'startTime': sleep['start'].strftime('%Y-%m-%dT%H:%M:%S.000'),
+                'endTime': sleep['end'].strftime('%Y-%m-%dT%H:%M:%S.000'),
+                'duration': int((sleep['end'] - sleep['start']).total_seconds() * 1000),
+                'minutesAsleep': sleep['asleep_seconds'] // 60,
+                'efficiency': sleep['efficiency'],
+                'isMainSleep': True,
+                'type': 'stages',
+            }],
+            'summary': {'totalMinutesAsleep': sleep['asleep_seconds'] // 60, 'totalSleepRecords': 1}
+        })
+    
+    async def _fitbit_weight(self, request: web.Request) -> web.Response:
+        user_id = request['user_id']
+        entries = []
+        for day in _days(_parse_day(request.match_info['start']), _parse_day(request.match_info['end'])):
+            weight = self.data.weight(user_id, day)
+            if weight:
+                entries.append({
+                    'logId': _stable_hash(f"{user_id}-{day}"), 'date': day.isoformat(),
+                    'time': '07:30:00', 'bmi': None, **weight
+                })
+        return web.json_response({'weight': entries})
+    
+    # Oura
+    
+    def _oura_page(self, request: web.Request, items: List[Dict[str, Any]]) -> web.Response:
+        """One page of a collection; next_token is the offset of the following page"""
+        page_size = self.config.page_size
+        if not page_size:
+            return web.json_response({'data': items, 'next_token': None})
+        
+        try:
+            offset = int(request.query.get('next_token') or 0)
+        except ValueError:
+            return self._error(400, 'invalid_request', 'Invalid next_token')
+        end = offset + page_size
+        return web.json_response({
+            'data': items[offset:end],
+            'next_token': str(end) if end < len(items) else None
+        })
+    
+    def _oura_days(self, request: web.Request) -> List[date]:
+        return _days(_parse_day(request.query['start_date']), _parse_day(request.query['end_date']))
+    
+    async def _oura_sleep(self, request: web.Request) -> web.Response:
+        user_id = request['user_id']
+        items = []
+        for day in self._oura_days(request):
+            sleep = self.data.sleep(user_id, day)
+            items.append({
+                'id': sleep['id'],
+                'day': day.isoformat(),
+                'type': 'long_sleep',
+                'bedtime_start': sleep['start'].isoformat(),
+                'bedtime_end': sleep['end'].isoformat(),
+                'total_sleep_duration': sleep['asleep_seconds'],
+                'time_in_bed': int((sleep['end'] - sleep['start']).total_seconds()),
+                'efficiency': sleep['efficiency'],
+                'rem_sleep_duration': sleep['rem_seconds'],
+                'deep_sleep_duration': sleep['deep_seconds'],
+                'light_sleep_duration': sleep['light_seconds'],
+                'lowest_heart_rate': sleep['lowest_hr'],
+                'average_heart_rate': sleep['average_hr'],
+            })
+        return self._oura_page(request, items)
+    
+    async def _oura_activity(self, request: web.Request) -> web.Response:
+        user_id = request['user_id']
+        items = []
+        for day in self._oura_days(request):
+            activity = self.data.activity(user_id, day)
+            items.append({
+                'id': f"{user_id}-activity-{day.isoformat()}",
+                'day': day.isoformat(),
+                'steps': activity['steps'],
+                'active_calories': activity['active_calories'],
+                'total_calories': activity['calories'],
+                'score': activity['score'],
+            })
+        return self._oura_page(request, items)
+    
+    async def _oura_readiness(self, request: web.Request) -> web.Response:
+        user_id = request['user_id']
+        items = []
+        for day in self._oura_days(request):
+            readiness = self.data.readiness(user_id, day)
+            items.append({
+                'id': f"{user_id}-readiness-{day.isoformat()}",
+                'day': day.isoformat(),
+                **readiness
+            })
+        return self._oura_page(request, items)
+    
+    async def _oura_heartrate(self, request: web.Request) -> web.Response:
+        """Overnight heart rate in 5-minute windows, the shape the integration reads"""
+        user_id = request['user_id']
+        items = []
+        for day in self._oura_days(request):
+            sleep = self.data.sleep(user_id, day)
+            rng = self.data.rng('oura-hr', user_id, day.toordinal())
+            window = sleep['start']
+            while window < sleep['end']:
+                bpm = np.round(sleep['average_hr'] + rng.normal(0, 2.5, 10)).astype(int)
+                items.append({'timestamp': window.isoformat(), 'bpm': bpm.tolist(), 'source': 'sleep'})
+                window += timedelta(minutes=5)
+        return self._oura_page(request, items)
+
+async def _serve(config: MockVendorConfig, host: str, port: int):
+    server = MockVendorServer(config)
+    await server.start(host, port)
+    try:
+        while True:
+            await asyncio.sleep(60)
+            logger.info(json.dumps({
+                vendor: {'requests': stats.requests, 'by_status': stats.by_status}
+                for vendor, stats in server.stats.items()
+            }))
+    finally:
+        await server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the mock Fitbit/Oura API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', default='lognormal', choices=('fixed', 'uniform', 'lognormal', 'exponential'))
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="median latency")
+    parser.add_argument('--latency-spread', type=float, default=0.5)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--rate-limit', type=int, default=None, help="requests per user per window")
+    parser.add_argument('--rate-limit-window', type=float, default=3600.0)
+    parser.add_argument('--token-ttl', type=float, default=3600.0)
+    parser.add_argument('--page-size', type=int, default=0)
+    parser.add_argument('--intraday-interval', type=int, default=60)
+    args = parser.parse_args()
+    
+    config = MockVendorConfig(
+        seed=args.seed,
+        latency=LatencyModel(args.latency, args.latency_ms, args.latency_spread),
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+        token_ttl=args.token_ttl,
+        page_size=args.page_size,
+        intraday_interval=args.intraday_interval,
+    )
+    asyncio.run(_serve(config, args.host, args.port))
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,8 @@ from loguru import logger
 from ..common.base_device import (
     BaseDeviceIntegration, HealthMetric, DeviceConnection, SyncResult
 )
+from ..common.sleep_sessions import SleepSession
+from ..common.tracing import span
 
 class OuraIntegration(BaseDeviceIntegration):
     """
@@ -52,7 +54,8 @@ class OuraIntegration(BaseDeviceIntegration):
         }
         
         # Rate limiting (Oura allows 5000 requests per day)
-        self.rate_limit_delay = 17.28  # seconds (5000 requests / 86400 seconds)
+        self.request_interval = 17.28  # seconds (5000 requests / 86400 seconds)
+        self.rate_limit_delay = self.request_interval
     
     async def authenticate(self, credentials: Dict[str, str]) -> DeviceConnection:
         """
@@ -150,38 +153,49 @@ class OuraIntegration(BaseDeviceIntegration):
         
         try:
             # Sleep data (most comprehensive from Oura)
-            sleep_metrics = await self._sync_sleep_data(connection, start_date, end_date)
+            with span('sync.sleep'):
+                sleep_metrics = await self._sync_sleep_data(connection, start_date, end_date)
             all_metrics.extend(sleep_metrics)
             
             # Activity data
-            activity_metrics = await self._sync_activity_data(connection, start_date, end_date)
+            with span('sync.activity'):
+                activity_metrics = await self._sync_activity_data(connection, start_date, end_date)
             all_metrics.extend(activity_metrics)
             
             # Readiness data
-            readiness_metrics = await self._sync_readiness_data(connection, start_date, end_date)
+            with span('sync.readiness'):
+                readiness_metrics = await self._sync_readiness_data(connection, start_date, end_date)
             all_metrics.extend(readiness_metrics)
             
             # Heart rate variability data
-            hrv_metrics = await self._sync_hrv_data(connection, start_date, end_date)
+            with span('sync.hrv'):
+                hrv_metrics = await self._sync_hrv_data(connection, start_date, end_date)
             all_metrics.extend(hrv_metrics)
-            
+        
         except Exception as e:
             logger.error(f"Error during Oura sync: {e}")
             errors.append(str(e))
         
         # Apply Oura-specific quality scoring
-        for metric in all_metrics:
-            metric.quality_score = self._calculate_oura_quality_score(metric)
+        with span('quality'):
+            for metric in all_metrics:
+                metric.quality_score = self._calculate_oura_quality_score(metric)
         
         # Clean and validate metrics
-        all_metrics = self.detect_outliers(all_metrics)
-        validated_metrics = [
-            m for m in all_metrics 
-            if self.validate_metric_value(m.metric_type, m.value)
-        ]
+        with span('outliers', metrics=len(all_metrics)):
+            all_metrics = self.detect_outliers(all_metrics)
+        with span('validation'):
+            validated_metrics = [
+                m for m in all_metrics 
+                if self.validate_metric_value(m.metric_type, m.value)
+            ]
+        ingest_stats = await self.ingest_metrics(connection, validated_metrics)
         
         # Calculate overall data quality
-        quality_score = self.calculate_quality_score(validated_metrics)
+        with span('quality'):
+            quality_score = self.calculate_quality_score(
+                validated_metrics, user_id=connection.user_id
+            )
         
         connection.last_sync = datetime.now()
         
@@ -190,12 +204,37 @@ class OuraIntegration(BaseDeviceIntegration):
             metrics_synced=len(validated_metrics),
             errors=errors,
             last_sync_time=connection.last_sync,
-            data_quality_score=quality_score
+            data_quality_score=quality_score,
+            ingest_stats=ingest_stats
         )
         
-        logger.info(f"Oura sync completed: {len(validated_metrics)} metrics, quality: {quality_score:.2f}")
+        logger.info(
+            f"Oura sync completed: {len(validated_metrics)} metrics "
+            f"({ingest_stats.inserted} new, {ingest_stats.updated} revised, "
+            f"{ingest_stats.unchanged} unchanged), quality: {quality_score:.2f}"
+        )
         return result
     
+    async def _get_collection(self, connection: DeviceConnection, url: str,
+                              params: Dict[str, str]) -> List[Dict[str, Any]]:
+        """All documents of a v2 collection, following next_token across pages"""
+        documents = []
+        page_params = dict(params)
+        
+        while True:
+            async with await self.make_authenticated_request(
+                connection, 'GET', url, params=page_params
+            ) as response:
+                data = await self.read_json(response) if response.status == 200 else {}
+            
+            documents.extend(data.get('data', []))
+            await self.pace()
+            
+            next_token = data.get('next_token')
+            if not next_token:
+                return documents
+            page_params['next_token'] = next_token
+    
     async def _sync_sleep_data(self, connection: DeviceConnection,
                               start_date: datetime, end_date: datetime) -> List[HealthMetric]:
         """Sync detailed sleep data from Oura"""
@@ -211,103 +250,121 @@ class OuraIntegration(BaseDeviceIntegration):
         }
         
         try:
-            async with await self.make_authenticated_request(
-                connection, 'GET', url, params=params
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    for sleep_session in data.get('data', []):
-                        bedtime_start = self.normalize_timestamp(sleep_session.get('bedtime_start'))
-                        
-                        # Sleep duration (total sleep time)
-                        total_sleep_duration = sleep_session.get('total_sleep_duration')
-                        if total_sleep_duration:
-                            metrics.append(HealthMetric(
-                                metric_type='sleep_duration',
-                                value=total_sleep_duration / 3600,  # Convert seconds to hours
-                                unit='hours',
-                                timestamp=bedtime_start,
-                                source_device='oura',
-                                metadata={'sleep_id': sleep_session.get('id')}
-                            ))
-                        
-                        # Sleep efficiency
-                        efficiency = sleep_session.get('efficiency')
-                        if efficiency:
-                            metrics.append(HealthMetric(
-                                metric_type='sleep_efficiency',
-                                value=float(efficiency),
-                                unit='percent',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
-                        
-                        # Sleep stages
-                        rem_duration = sleep_session.get('rem_sleep_duration')
-                        if rem_duration:
-                            metrics.append(HealthMetric(
-                                metric_type='rem_sleep_duration',
-                                value=rem_duration / 3600,
-                                unit='hours',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
-                        
-                        deep_duration = sleep_session.get('deep_sleep_duration')
-                        if deep_duration:
-                            metrics.append(HealthMetric(
-                                metric_type='deep_sleep_duration',
-                                value=deep_duration / 3600,
-                                unit='hours',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
-                        
-                        light_duration = sleep_session.get('light_sleep_duration')
-                        if light_duration:
-                            metrics.append(HealthMetric(
-                                metric_type='light_sleep_duration',
-                                value=light_duration / 3600,
-                                unit='hours',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
-                        
-                        # Heart rate during sleep
-                        hr_lowest = sleep_session.get('lowest_heart_rate')
-                        if hr_lowest:
-                            metrics.append(HealthMetric(
-                                metric_type='resting_heart_rate',
-                                value=float(hr_lowest),
-                                unit='bpm',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
-                        
-                        hr_average = sleep_session.get('average_heart_rate')
-                        if hr_average:
-                            metrics.append(HealthMetric(
-                                metric_type='heart_rate_avg_sleep',
-                                value=float(hr_average),
-                                unit='bpm',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
-                        
-                        # Sleep score
-                        sleep_score = sleep_session.get('score')
-                        if sleep_score:
-                            metrics.append(HealthMetric(
-                                metric_type='sleep_score',
-                                value=float(sleep_score),
-                                unit='score',
-                                timestamp=bedtime_start,
-                                source_device='oura'
-                            ))
+            for sleep_session in await self._get_collection(connection, url, params):
+                bedtime_start = self.normalize_timestamp(sleep_session.get('bedtime_start'))
+                session_start = len(metrics)
+                
+                # Sleep duration (total sleep time)
+                total_sleep_duration = sleep_session.get('total_sleep_duration')
+                if total_sleep_duration:
+                    metrics.append(HealthMetric(
+                        metric_type='sleep_duration',
+                        value=total_sleep_duration / 3600,  # Convert seconds to hours
+                        unit='hours',
+                        timestamp=bedtime_start,
+                        source_device='oura',
+                        metadata={'sleep_id': sleep_session.get('id')}
+                    ))
+                
+                # Sleep efficiency
+                efficiency = sleep_session.get('efficiency')
+                if efficiency:
+                    metrics.append(HealthMetric(
+                        metric_type='sleep_efficiency',
+                        value=float(efficiency),
+                        unit='percent',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
+                
+                # Sleep stages
+                rem_duration = sleep_session.get('rem_sleep_duration')
+                if rem_duration:
+                    metrics.append(HealthMetric(
+                        metric_type='rem_sleep_duration',
+                        value=rem_duration / 3600,
+                        unit='hours',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
+                
+                deep_duration = sleep_session.get('deep_sleep_duration')
+                if deep_duration:
+                    metrics.append(HealthMetric(
+                        metric_type='deep_sleep_duration',
+                        value=deep_duration / 3600,
+                        unit='hours',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
+                
+                light_duration = sleep_session.get('light_sleep_duration')
+                if light_duration:
+                    metrics.append(HealthMetric(
+                        metric_type='light_sleep_duration',
+                        value=light_duration / 3600,
+                        unit='hours',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
+                
+                # Heart rate during sleep
+                hr_lowest = sleep_session.get('lowest_heart_rate')
+                if hr_lowest:
+                    metrics.append(HealthMetric(
+                        metric_type='resting_heart_rate',
+                        value=float(hr_lowest),
+                        unit='bpm',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
                 
-                await asyncio.sleep(self.rate_limit_delay)
+                hr_average = sleep_session.get('average_heart_rate')
+                if hr_average:
+                    metrics.append(HealthMetric(
+                        metric_type='heart_rate_avg_sleep',
+                        value=float(hr_average),
+                        unit='bpm',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
                 
+                # Sleep score
+                sleep_score = sleep_session.get('score')
+                if sleep_score:
+                    metrics.append(HealthMetric(
+                        metric_type='sleep_score',
+                        value=float(sleep_score),
+                        unit='score',
+                        timestamp=bedtime_start,
+                        source_device='oura'
+                    ))
+                
+                # Key every session metric on sleep_id so re-syncs and
+                # revised bedtimes replace rather than duplicate them
+                sleep_id = sleep_session.get('id')
+                if sleep_id:
+                    for metric in metrics[session_start:]:
+                        metric.metadata = {
+                            **(metric.metadata or {}),
+                            'sleep_id': sleep_id,
+                            'natural_id': f"sleep:{sleep_id}"
+                        }
+                
+                # Keep the full interval for cross-device stitching
+                bedtime_end = sleep_session.get('bedtime_end')
+                if bedtime_end and total_sleep_duration:
+                    self.record_sleep_session(SleepSession(
+                        user_id=connection.user_id,
+                        source_device='oura',
+                        start=bedtime_start,
+                        end=self.normalize_timestamp(bedtime_end),
+                        sleep_hours=total_sleep_duration / 3600,
+                        efficiency=float(efficiency) if efficiency else None,
+                        session_id=sleep_id,
+                        is_main_sleep=sleep_session.get('type', 'long_sleep') == 'long_sleep'
+                    ))
+        
         except Exception as e:
             logger.error(f"Error syncing Oura sleep data: {e}")
         
@@ -328,50 +385,42 @@ class OuraIntegration(BaseDeviceIntegration):
         }
         
         try:
-            async with await self.make_authenticated_request(
-                connection, 'GET', url, params=params
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    for activity_day in data.get('data', []):
-                        day_date = self.normalize_timestamp(activity_day.get('day'))
-                        
-                        # Steps
-                        steps = activity_day.get('steps')
-                        if steps:
-                            metrics.append(HealthMetric(
-                                metric_type='steps',
-                                value=float(steps),
-                                unit='count',
-                                timestamp=day_date,
-                                source_device='oura'
-                            ))
-                        
-                        # Calories
-                        calories = activity_day.get('active_calories')
-                        if calories:
-                            metrics.append(HealthMetric(
-                                metric_type='calories_burned',
-                                value=float(calories),
-                                unit='kcal',
-                                timestamp=day_date,
-                                source_device='oura'
-                            ))
-                        
-                        # Activity score
-                        activity_score = activity_day.get('score')
-                        if activity_score:
-                            metrics.append(HealthMetric(
-                                metric_type='activity_score',
-                                value=float(activity_score),
-                                unit='score',
-                                timestamp=day_date,
-                                source_device='oura'
-                            ))
+            for activity_day in await self._get_collection(connection, url, params):
+                day_date = self.normalize_timestamp(activity_day.get('day'))
+                
+                # Steps
+                steps = activity_day.get('steps')
+                if steps:
+                    metrics.append(HealthMetric(
+                        metric_type='steps',
+                        value=float(steps),
+                        unit='count',
+                        timestamp=day_date,
+                        source_device='oura'
+                    ))
                 
-                await asyncio.sleep(self.rate_limit_delay)
+                # Calories
+                calories = activity_day.get('active_calories')
+                if calories:
+                    metrics.append(HealthMetric(
+                        metric_type='calories_burned',
+                        value=float(calories),
+                        unit='kcal',
+                        timestamp=day_date,
+                        source_device='oura'
+                    ))
                 
+                # Activity score
+                activity_score = activity_day.get('score')
+                if activity_score:
+                    metrics.append(HealthMetric(
+                        metric_type='activity_score',
+                        value=float(activity_score),
+                        unit='score',
+                        timestamp=day_date,
+                        source_device='oura'
+                    ))
+        
         except Exception as e:
             logger.error(f"Error syncing Oura activity data: {e}")
         
@@ -392,39 +441,31 @@ class OuraIntegration(BaseDeviceIntegration):
         }
         
         try:
-            async with await self.make_authenticated_request(
-                connection, 'GET', url, params=params
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    for readiness_day in data.get('data', []):
-                        day_date = self.normalize_timestamp(readiness_day.get('day'))
-                        
-                        # Readiness score
-                        readiness_score = readiness_day.get('score')
-                        if readiness_score:
-                            metrics.append(HealthMetric(
-                                metric_type='readiness_score',
-                                value=float(readiness_score),
-                                unit='score',
-                                timestamp=day_date,
-                                source_device='oura'
-                            ))
-                        
-                        # Body temperature deviation
-                        temp_deviation = readiness_day.get('temperature_deviation')
-                        if temp_deviation is not None:
-                            metrics.append(HealthMetric(
-                                metric_type='body_temperature_deviation',
-                                value=float(temp_deviation),
-                                unit='celsius',
-                                timestamp=day_date,
-                                source_device='oura'
-                            ))
+            for readiness_day in await self._get_collection(connection, url, params):
+                day_date = self.normalize_timestamp(readiness_day.get('day'))
                 
-                await asyncio.sleep(self.rate_limit_delay)
+                # Readiness score
+                readiness_score = readiness_day.get('score')
+                if readiness_score:
+                    metrics.append(HealthMetric(
+                        metric_type='readiness_score',
+                        value=float(readiness_score),
+                        unit='score',
+                        timestamp=day_date,
+                        source_device='oura'
+                    ))
                 
+                # Body temperature deviation
+                temp_deviation = readiness_day.get('temperature_deviation')
+                if temp_deviation is not None:
+                    metrics.append(HealthMetric(
+                        metric_type='body_temperature_deviation',
+                        value=float(temp_deviation),
+                        unit='celsius',
+                        timestamp=day_date,
+                        source_device='oura'
+                    ))
+        
         except Exception as e:
             logger.error(f"Error syncing Oura readiness data: {e}")
         
@@ -445,33 +486,25 @@ class OuraIntegration(BaseDeviceIntegration):
         }
         
         try:
-            async with await self.make_authenticated_request(
-                connection, 'GET', url, params=params
-            ) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    
-                    for hr_session in data.get('data', []):
-                        timestamp = self.normalize_timestamp(hr_session.get('timestamp'))
-                        
-                        # HRV (RMSSD)
-                        if 'bpm' in hr_session and len(hr_session['bpm']) > 1:
-                            # Calculate RMSSD from heart rate data
-                            hr_values = hr_session['bpm']
-                            rr_intervals = [60000 / hr for hr in hr_values if hr > 0]
-                            
-                            if len(rr_intervals) > 1:
-                                rmssd = self._calculate_rmssd(rr_intervals)
-                                metrics.append(HealthMetric(
-                                    metric_type='hrv_rmssd',
-                                    value=rmssd,
-                                    unit='ms',
-                                    timestamp=timestamp,
-                                    source_device='oura'
-                                ))
-                
-                await asyncio.sleep(self.rate_limit_delay)
+            for hr_session in await self._get_collection(connection, url, params):
+                timestamp = self.normalize_timestamp(hr_session.get('timestamp'))
                 
+                # HRV (RMSSD)
+                if 'bpm' in hr_session and len(hr_session['bpm']) > 1:
+                    # Calculate RMSSD from heart rate data
+                    hr_values = hr_session['bpm']
+                    rr_intervals = [60000 / hr for hr in hr_values if hr > 0]
+                    
+                    if len(rr_intervals) > 1:
+                        rmssd = self._calculate_rmssd(rr_intervals)
+                        metrics.append(HealthMetric(
+                            metric_type='hrv_rmssd',
+                            value=rmssd,
+                            unit='ms',
+                            timestamp=timestamp,
+                            source_device='oura'
+                        ))
+        
         except Exception as e:
             logger.error(f"Error syncing Oura HRV data: {e}")
         
@@ -0,0 +1,246 @@
+"""
+Time-series range queries over stored device metrics
+Answers "metric X for users U from A to B at resolution R" from pre-aggregated
+rollups when possible and from raw arrays otherwise, returning columnar output
+"""
+
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Union
+import numpy as np
+
+from .common.rollups import GRANULARITIES, SKETCH_GRANULARITIES, epoch_seconds, resolution_seconds
+
+# Aggregations a rollup bucket can answer directly
+ROLLUP_AGGREGATIONS = {'mean', 'sum', 'min', 'max', 'count'}
+RAW_AGGREGATIONS = ROLLUP_AGGREGATIONS | {'median', 'std', 'first', 'last'}
+FILL_POLICIES = {None, 'none', 'drop', 'zero', 'ffill', 'interpolate'}
+
+@dataclass
+class QueryStats:
+    """Timing and volume breakdown for one query"""
+    plan_ms: float = 0.0
+    read_ms: float = 0.0
+    aggregate_ms: float = 0.0
+    fill_ms: float = 0.0
+    total_ms: float = 0.0
+    series: int = 0
+    rollup_buckets_read: int = 0
+    raw_samples_read: int = 0
+    paths: Dict[str, str] = field(default_factory=dict)  # metric_type -> 'rollup' | 'raw'
+
+@dataclass
+class QueryResult:
+    """Columnar query output: one row per (user, metric, bucket)"""
+    columns: Dict[str, np.ndarray]
+    stats: QueryStats
+    
+    def __len__(self) -> int:
+        return len(self.columns['value'])
+    
+    def to_arrow(self):
+        """Columns as a pyarrow Table (requires pyarrow)"""
+        try:
+            import pyarrow as pa
+        except ImportError as e:
+            raise ImportError("pyarrow is required for Arrow output") from e
+        
+        return pa.table({
+            'user_id': pa.array(self.columns['user_id'].astype(str)),
+            'metric_type': pa.array(self.columns['metric_type'].astype(str)),
+            'timestamp': pa.array(self.columns['timestamp']),
+            'value': pa.array(self.columns['value']),
+        })
+
+def _is_percentile(agg: str) -> bool:
+    # pNN with 0 <= NN <= 100; np.percentile rejects anything else and sketches clamp it
+    return (agg.startswith('p') and agg[1:].replace('.', '', 1).isdigit()
+            and float(agg[1:]) <= 100)
+
+class MetricQueryEngine:
+    """
+    Plans and executes range queries against a metric store
+    """
+    
+    def __init__(self, store):
+        self.store = store
+    
+    def _use_rollups(self, start: datetime, end: datetime, step: int, agg: str) -> bool:
+        rollups = getattr(self.store, 'rollups', None)
+        if rollups is None:
+            return False
+        if agg not in ROLLUP_AGGREGATIONS and not _is_percentile(agg):
+            return False
+        
+        # Any rollup granularity that tiles both the range and the resolution will do;
+        # percentiles need one that keeps sketches
+        if _is_percentile(agg):
+            finest = min(GRANULARITIES[g] for g in SKETCH_GRANULARITIES)
+        else:
+            finest = min(GRANULARITIES.values())
+        return (step % finest == 0 and epoch_seconds(start) % finest == 0
+                and epoch_seconds(end) % finest == 0)
+    
+    def _rollup_series(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+                       resolution, agg: str, source_device: Optional[str],
+                       bucket_index, stats: QueryStats) -> np.ndarray:
+        n_buckets = len(bucket_index)
+        values = np.full(n_buckets, np.nan)
+        
+        read_start = time.perf_counter()
+        buckets = self.store.rollup(user_id, metric_type, start, end, resolution, source_device)
+        stats.read_ms += (time.perf_counter() - read_start) * 1000
+        stats.rollup_buckets_read += len(buckets)
+        
+        aggregate_start = time.perf_counter()
+        step = resolution_seconds(resolution)
+        base = epoch_seconds(start)
+        for bucket_start, bucket in buckets:
+            i = int((epoch_seconds(bucket_start) - base) // step)
+            if _is_percentile(agg):
+                values[i] = bucket.percentile(float(agg[1:]) / 100)
+            elif agg == 'count':
+                values[i] = bucket.count
+            else:
+                values[i] = getattr(bucket, agg)
+        stats.aggregate_ms += (time.perf_counter() - aggregate_start) * 1000
+        return values
+    
+    def _raw_series(self, user_id: str, metric_type: str, start: datetime, end: datetime,
+                    step: int, agg: str, source_device: Optional[str],
+                    n_buckets: int, stats: QueryStats) -> np.ndarray:
+        read_start = time.perf_counter()
+        timestamps, samples, _ = self.store.read_arrays(
+            user_id, metric_type, start, end, source_device
+        )
+        stats.read_ms += (time.perf_counter() - read_start) * 1000
+        stats.raw_samples_read += len(samples)
+        
+        aggregate_start = time.perf_counter()
+        values = np.full(n_buckets, np.nan)
+        if len(samples):
+            samples = np.asarray(samples, dtype=np.float64)
+            bucket = ((timestamps - int(epoch_seconds(start) * 1000)) // (step * 1000)).astype(np.int64)
+            
+            # Timestamps are sorted, so each bucket is one contiguous segment
+            segment_starts = np.flatnonzero(np.r_[True, np.diff(bucket) != 0])
+            segment_ends = np.r_[segment_starts[1:], len(samples)]
+            occupied = bucket[segment_starts]
+            counts = segment_ends - segment_starts
+            
+            if agg in ('sum', 'mean', 'std'):
+                sums = np.add.reduceat(samples, segment_starts)
+                if agg == 'sum':
+                    values[occupied] = sums
+                else:
+                    means = sums / counts
+                    if agg == 'mean':
+                        values[occupied] = means
+                    else:
+                        squares = np.add.reduceat(samples * samples, segment_starts)
+                        values[occupied] = np.sqrt(np.maximum(squares / counts - means ** 2, 0))
+            elif agg == 'min':
+                values[occupied] = np.minimum.reduceat(samples, segment_starts)
+            elif agg == 'max':
+                values[occupied] = np.maximum.reduceat(samples, segment_starts)
+            elif agg == 'count':
+                values[occupied] = counts
+            elif agg == 'first':
+                values[occupied] = samples[segment_starts]
+            elif agg == 'last':
+                values[occupied] = samples[segment_ends - 1]
+            else:
+                q = 50.0 if agg == 'median' else float(agg[1:])
+                values[occupied] = [
+                    np.percentile(samples[lo:hi], q)
+                    for lo, hi in zip(segment_starts, segment_ends)
+                ]
+        stats.aggregate_ms += (time.perf_counter() - aggregate_start) * 1000
+        return values
+    
+    def _fill(self, values: np.ndarray, fill: Optional[str]) -> np.ndarray:
+        missing = np.isnan(values)
+        if fill in (None, 'none', 'drop') or not missing.any():
+            return values
+        if fill == 'zero':
+            return np.where(missing, 0.0, values)
+        
+        present = np.flatnonzero(~missing)
+        if not len(present):
+            return values
+        if fill == 'ffill':
+            last_seen = np.maximum.accumulate(np.where(missing, 0, np.arange(len(values))))
+            filled = values[last_seen]
+            filled[:present[0]] = np.nan  # nothing to carry before the first value
+            return filled
+        
+        # Linear interpolation between observed buckets; edges stay empty
+        filled = values.copy()
+        inner = missing & (np.arange(len(values)) > present[0]) & (np.arange(len(values)) < present[-1])
+        filled[inner] = np.interp(np.flatnonzero(inner), present, values[present])
+        return filled
+    
+    def query(self, user_ids: List[str], metric_types: List[str],
+              start: datetime, end: datetime,
+              resolution: Union[str, timedelta] = 'day',
+              agg: str = 'mean', fill: Optional[str] = None,
+              source_device: str = None) -> QueryResult:
+        """
+        Aggregate each (user, metric_type) over [start, end) at the given resolution
+        
+        agg: mean, sum, min, max, count, median, std, first, last or pNN with NN in 0-100 (e.g. p95)
+        fill: None/'none' (NaN for empty buckets), 'drop', 'zero', 'ffill' or 'interpolate'
+        """
+        query_start = time.perf_counter()
+        if agg not in RAW_AGGREGATIONS and not _is_percentile(agg):
+            raise ValueError(f"Unsupported aggregation: {agg}")
+        if fill not in FILL_POLICIES:
+            raise ValueError(f"Unsupported fill policy: {fill}")
+        
+        stats = QueryStats()
+        step = resolution_seconds(resolution)
+        n_buckets = max(int(np.ceil((epoch_seconds(end) - epoch_seconds(start)) / step)), 0)
+        bucket_times = (np.datetime64(int(epoch_seconds(start)), 's')
+                        + np.arange(n_buckets) * np.timedelta64(step, 's'))
+        use_rollups = self._use_rollups(start, end, step, agg)
+        stats.plan_ms = (time.perf_counter() - query_start) * 1000
+        
+        users, metrics, timestamps, values = [], [], [], []
+        for metric_type in metric_types:
+            stats.paths[metric_type] = 'rollup' if use_rollups else 'raw'
+            
+            for user_id in user_ids:
+                if use_rollups:
+                    series = self._rollup_series(
+                        user_id, metric_type, start, end, resolution, agg,
+                        source_device, bucket_times, stats
+                    )
+                else:
+                    series = self._raw_series(
+                        user_id, metric_type, start, end, step, agg,
+                        source_device, n_buckets, stats
+                    )
+                
+                fill_start = time.perf_counter()
+                series = self._fill(series, fill)
+                keep = ~np.isnan(series) if fill == 'drop' else slice(None)
+                stats.fill_ms += (time.perf_counter() - fill_start) * 1000
+                
+                kept_times = bucket_times[keep]
+                users.append(np.full(len(kept_times), user_id, dtype=object))
+                metrics.append(np.full(len(kept_times), metric_type, dtype=object))
+                timestamps.append(kept_times)
+                values.append(series[keep])
+                stats.series += 1
+        
+        columns = {
+            'user_id': np.concatenate(users) if users else np.empty(0, dtype=object),
+            'metric_type': np.concatenate(metrics) if metrics else np.empty(0, dtype=object),
+            'timestamp': (np.concatenate(timestamps) if timestamps
+                          else np.empty(0, dtype='datetime64[s]')),
+            'value': np.concatenate(values) if values else np.empty(0, dtype=np.float64),
+        }
+        
+        stats.total_ms = (time.perf_counter() - query_start) * 1000
+        return QueryResult(columns, stats)
@@ -0,0 +1,593 @@
+"""
+Sharded multi-process deployment of the DeviceManager
+Each worker process runs its own DeviceManager on its own event loop and owns the
+users a consistent-hash ring assigns to it, so parsing and post-processing spread
+across cores; a thin coordinator routes per-user calls to the owning worker over a
+pipe. Profiles, connections, sync leases and the vendor quota ledger live in one
+shared SQLite file, so moving a user between workers only hands over its in-memory
+metric history, and adding or removing a worker moves about 1/N of the users
+"""
+
+import asyncio
+import bisect
+import dataclasses
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from loguru import logger
+
+from .common.base_device import DeviceConnection, HealthMetric, IngestStats, SyncResult
+from .common.profile_store import ProfileStore
+from .device_manager import AggregatedMetrics, DeviceManager
+
+# Points per worker on the hash ring; more points even out the range sizes
+VIRTUAL_NODES = 160
+
+# Users handed over per release/adopt message while rebalancing
+HANDOFF_BATCH = 256
+
+# DeviceManager methods whose first argument is the user_id they act on
+ROUTED_METHODS = frozenset({
+    'authenticate_device', 'sync_user_data', 'get_aggregated_metrics', 'get_real_time_data',
+    'import_apple_health', 'get_fused_metrics', 'get_sleep_nights', 'mark_clinician_viewed',
+    'set_user_attributes', 'get_user_profile', 'get_connected_devices', 'disconnect_device',
+    'get_data_quality_summary'
+})
+
+def _ring_hash(key: str) -> int:
+    """64-bit ring position (independent of Python's hash seed)"""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class ConsistentHashRing:
+    """
+    Maps user_ids to worker ids through virtual nodes on a 64-bit ring
+    Adding or removing a worker only reassigns the users on the arcs its points cover
+    """
+    
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = VIRTUAL_NODES):
+        self.vnodes = vnodes
+        self.nodes: Set[str] = set(nodes)
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._rebuild()
+    
+    def _rebuild(self):
+        points = sorted(
+            (_ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(self.vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+    
+    def add(self, node: str):
+        if node not in self.nodes:
+            self.nodes.add(node)
+            self._rebuild()
+    
+    def remove(self, node: str):
+        if node in self.nodes:
+            self.nodes.discard(node)
+            self._rebuild()
+    
+    def node_for(self, key: str) -> str:
+        """Owner of the first point clockwise from the key's hash"""
+        if not self._points:
+            raise LookupError("Hash ring has no nodes")
+        index = bisect.bisect(self._points, _ring_hash(key))
+        return self._owners[index % len(self._owners)]
+    
+    def copy(self) -> 'ConsistentHashRing':
+        ring = ConsistentHashRing(vnodes=self.vnodes)
+        ring.nodes = set(self.nodes)
+        ring._points = list(self._points)
+        ring._owners = list(self._owners)
+        return ring
+
+def _portable(value: Any) -> Any:
+    """Drop per-sync traces from results sent back; they stay exportable in the worker"""
+    if isinstance(value, SyncResult):
+        return dataclasses.replace(value, trace=None)
+    if isinstance(value, dict):
+        return {key: _portable(item) for key, item in value.items()}
+    return value
+
+def _portable_error(error: Exception) -> Exception:
+    """The exception itself if it survives pickling, else a RuntimeError naming it"""
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+class _Channel:
+    """
+    Pickled messages over a pipe: the event loop reads when the pipe is readable and a
+    sender thread writes, so neither process stalls its loop on a full pipe
+    Messages are sent in the order send() is called
+    """
+    
+    def __init__(self, conn, on_message: Callable[[Any], None], on_closed: Callable[[], None]):
+        self.conn = conn
+        self.on_message = on_message
+        self.on_closed = on_closed
+        self.closed = False
+        self.loop = asyncio.get_running_loop()
+        self._sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shard-send')
+        self.loop.add_reader(conn.fileno(), self._readable)
+    
+    def _readable(self):
+        try:
+            payload = self.conn.recv_bytes()
+        except (EOFError, OSError):
+            self.close()
+            self.on_closed()
+            return
+        self.on_message(pickle.loads(payload))
+    
+    def send(self, message: Any) -> asyncio.Future:
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        return self.loop.run_in_executor(self._sender, self.conn.send_bytes, payload)
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.conn.fileno())
+        # Queued behind any sends still in flight
+        self._sender.submit(self.conn.close)
+        self._sender.shutdown(wait=False)
+
+class ShardWorker:
+    """
+    Serves routed calls against one DeviceManager inside a worker process
+    Each call runs as its own task, so a worker overlaps its users' syncs as the
+    single-process manager does
+    """
+    
+    def __init__(self, worker_id: str, conn, manager_options: Dict[str, Any],
+                 setup: Optional[Callable[[DeviceManager], None]] = None):
+        self.worker_id = worker_id
+        self.conn = conn
+        self.manager_options = manager_options
+        self.setup = setup
+        self.manager: Optional[DeviceManager] = None
+        self.channel: Optional[_Channel] = None
+        self._closed = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+        # user_id -> calls in flight, awaited before the user is handed over
+        self._user_tasks: Dict[str, Set[asyncio.Task]] = {}
+    
+    async def serve(self):
+        self.manager = DeviceManager(**self.manager_options)
+        if self.setup is not None:
+            self.setup(self.manager)
+        self.channel = _Channel(self.conn, self._on_message, self._closed.set)
+        
+        await self._closed.wait()
+        for task in list(self._tasks):
+            task.cancel()
+        await self.manager.close()
+    
+    def _on_message(self, message: Tuple[int, str, tuple, dict]):
+        call_id, method, args, kwargs = message
+        task = asyncio.create_task(self._handle(call_id, method, args, kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        
+        if method in ROUTED_METHODS:
+            user_tasks = self._user_tasks.setdefault(args[0], set())
+            user_tasks.add(task)
+            task.add_done_callback(lambda done, user_id=args[0]: self._call_done(user_id, done))
+    
+    def _call_done(self, user_id: str, task: asyncio.Task):
+        user_tasks = self._user_tasks.get(user_id)
+        if user_tasks is not None:
+            user_tasks.discard(task)
+            if not user_tasks:
+                del self._user_tasks[user_id]
+    
+    async def _handle(self, call_id: int, method: str, args: tuple, kwargs: dict):
+        try:
+            if method in ROUTED_METHODS:
+                handler = getattr(self.manager, method)
+            else:
+                handler = getattr(self, f"_op_{method}", None)
+                if handler is None:
+                    raise ValueError(f"Unknown shard worker call: {method}")
+            value = handler(*args, **kwargs)
+            if asyncio.iscoroutine(value):
+                value = await value
+            reply = (call_id, True, _portable(value))
+        except Exception as e:
+            reply = (call_id, False, _portable_error(e))
+        
+        try:
+            await self.channel.send(reply)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            await self.channel.send((call_id, False, RuntimeError(
+                f"Result of {method} could not be sent from {self.worker_id}: {e}"
+            )))
+    
+    # Coordinator operations
+    
+    def _op_stats(self) -> Dict[str, Any]:
+        return {
+            'worker_id': self.worker_id,
+            'pid': os.getpid(),
+            'cached_profiles': len(self.manager.user_profiles._cache),
+            'series': len(self.manager.metric_store.series),
+            'calls_in_flight': len(self._tasks) - 1
+        }
+    
+    def _op_flush_profiles(self) -> int:
+        return self.manager.flush_profiles()
+    
+    def _op_user_ids(self) -> Set[str]:
+        """Users this worker holds state for, whether or not they have a profile"""
+        return (set(self.manager.user_attributes)
+                | {key[0] for key in self.manager.metric_store.series}
+                | set(self.manager.sleep_stitcher.sessions))
+    
+    async def _op_release_users(self, user_ids: List[str]) -> List[Tuple[str, Any, list, list, list, dict]]:
+        """
+        Copy out users moving to another worker once their calls in flight finish:
+        pending profile writes are flushed and each user's stored series (as arrays),
+        cohort attributes, sleep sessions, recent anomalies and dedup entries are returned
+        Nothing is removed here; the coordinator purges the users once every handover
+        of the rebalance has succeeded
+        """
+        pending = [task for user_id in user_ids for task in self._user_tasks.get(user_id, ())]
+        if pending:
+            await asyncio.wait(pending)
+        
+        store = self.manager.metric_store
+        handoff = []
+        for user_id in user_ids:
+            self.manager.user_profiles.reload(user_id)
+            series = []
+            for _, metric_type, device in store.series_keys(user_id):
+                timestamps, values, quality = store.read_arrays(
+                    user_id, metric_type, datetime.min, datetime.max, device
+                )
+                series.append((
+                    metric_type, device, timestamps, values, quality,
+                    store.unit(user_id, metric_type, device)
+                ))
+            handoff.append((
+                user_id, self.manager.user_attributes.get(user_id), series,
+                list(self.manager.sleep_stitcher.sessions.get(user_id, {}).values()),
+                list(store.baselines.anomalies.get(user_id, ())),
+                store.dedup.user_entries(user_id)
+            ))
+        return handoff
+    
+    def _op_adopt_users(self, handoff: List[Tuple[str, Any, list, list, list, dict]]) -> IngestStats:
+        """
+        Take over users released by another worker; rollups, baselines and feature
+        rows rebuild from the bulk writes and sleep nights re-stitch from the sessions
+        Bulk writes carry no vendor IDs, so the dedup entries are restored alongside
+        them or the next sync would re-insert every vendor-ID record
+        """
+        stats = IngestStats()
+        for user_id, attributes, series, sessions, anomalies, dedup_entries in handoff:
+            # Drop any copy cached from an earlier stint so the shared store is read
+            self.manager.user_profiles.reload(user_id)
+            if attributes is not None:
+                self.manager.user_attributes[user_id] = attributes
+            for metric_type, device, timestamps, values, quality, unit in series:
+                stats.merge(self.manager.metric_store.write_arrays(
+                    user_id, metric_type, device, timestamps, values, quality, unit
+                ))
+            self.manager.sleep_stitcher.add_many(sessions)
+            self.manager.metric_store.baselines.restore_anomalies(user_id, anomalies)
+            self.manager.metric_store.dedup.restore(user_id, dedup_entries)
+        return stats
+    
+    def _op_purge_users(self, user_ids: List[str]) -> int:
+        """
+        Forget users this worker no longer owns: after they moved away, or the
+        partial copies left by a handover that failed
+        """
+        users = set(user_ids)
+        self.manager.metric_store.drop_users(users)
+        self.manager.sleep_stitcher.drop_users(users)
+        self.manager.feature_store.drop_users(users)
+        for user_id in users:
+            self.manager.user_attributes.pop(user_id, None)
+            self.manager.user_profiles.reload(user_id)
+        return len(users)
+    
+    def _op_shutdown(self) -> int:
+        return self.manager.flush_profiles()
+
+def _run_worker(worker_id: str, conn, manager_options: Dict[str, Any],
+                setup: Optional[Callable[[DeviceManager], None]]):
+    """Worker process entry point"""
+    try:
+        asyncio.run(ShardWorker(worker_id, conn, manager_options, setup).serve())
+    except KeyboardInterrupt:
+        pass
+
+class _WorkerHandle:
+    """Coordinator-side state of one worker process"""
+    
+    def __init__(self, worker_id: str, process):
+        self.worker_id = worker_id
+        self.process = process
+        self.channel: Optional[_Channel] = None
+        self.pending: Dict[int, asyncio.Future] = {}
+
+class ShardedDeviceManager:
+    """
+    Coordinator for N DeviceManager worker processes sharded by user_id
+    Per-user calls go to the worker the hash ring assigns; a user being moved by
+    add_worker()/remove_worker() has its calls held until the handover completes
+    """
+    
+    def __init__(self, workers: int = None, profile_store_path: str = None,
+                 vnodes: int = VIRTUAL_NODES,
+                 worker_setup: Optional[Callable[[DeviceManager], None]] = None,
+                 start_method: str = 'spawn', **manager_options):
+        """
+        worker_setup is called with each worker's DeviceManager after it is built
+        (e.g. to point integrations at a mock server) and must be picklable;
+        manager_options are passed to every worker's DeviceManager
+        """
+        self.initial_workers = workers or os.cpu_count() or 1
+        self.profile_store_path = profile_store_path
+        self.worker_setup = worker_setup
+        self.manager_options = manager_options
+        
+        self.ring = ConsistentHashRing(vnodes=vnodes)
+        self.workers: Dict[str, _WorkerHandle] = {}
+        self.profiles: Optional[ProfileStore] = None  # read-only view for rebalancing
+        
+        self._context = multiprocessing.get_context(start_method)
+        self._worker_ids = itertools.count()
+        self._call_ids = itertools.count(1)
+        self._temp_dir: Optional[str] = None
+        self._stopping = False
+        
+        # Users whose handover is in progress, and the event set when it ends
+        self._moving: Set[str] = set()
+        self._moved = asyncio.Event()
+        self._moved.set()
+        self._rebalance_lock = asyncio.Lock()
+    
+    async def start(self):
+        """Start the worker processes and wait until each has built its manager"""
+        if self.profile_store_path is None:
+            # Handovers need a store every worker can read
+            self._temp_dir = tempfile.mkdtemp(prefix='device-shards-')
+            self.profile_store_path = os.path.join(self._temp_dir, 'profiles.db')
+        self.profiles = ProfileStore(self.profile_store_path)
+        
+        handles = [self._spawn() for _ in range(self.initial_workers)]
+        await asyncio.gather(*(self._call(handle, 'stats') for handle in handles))
+        for handle in handles:
+            self.ring.add(handle.worker_id)
+        logger.info(f"Started {len(handles)} shard workers")
+    
+    async def stop(self):
+        self._stopping = True
+        await asyncio.gather(*(self._shutdown(handle) for handle in self.workers.values()))
+        self.workers.clear()
+        if self.profiles is not None:
+            self.profiles.close()
+            self.profiles = None
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+    
+    async def __aenter__(self):
+        await self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+    
+    # Worker processes
+    
+    def _spawn(self) -> _WorkerHandle:
+        worker_id = f"worker-{next(self._worker_ids)}"
+        options = dict(self.manager_options, profile_store_path=self.profile_store_path)
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_run_worker, args=(worker_id, child_conn, options, self.worker_setup),
+            name=f"device-shard-{worker_id}", daemon=True
+        )
+        process.start()
+        child_conn.close()
+        
+        handle = _WorkerHandle(worker_id, process)
+        handle.channel = _Channel(
+            parent_conn,
+            lambda message: self._on_reply(handle, message),
+            lambda: self._on_worker_exit(handle)
+        )
+        self.workers[worker_id] = handle
+        return handle
+    
+    def _on_reply(self, handle: _WorkerHandle, message: Tuple[int, bool, Any]):
+        call_id, ok, value = message
+        future = handle.pending.pop(call_id, None)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+    
+    def _on_worker_exit(self, handle: _WorkerHandle):
+        if not self._stopping:
+            logger.error(f"Shard {handle.worker_id} exited with {len(handle.pending)} calls pending")
+        for future in handle.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Shard {handle.worker_id} exited"))
+        handle.pending.clear()
+    
+    async def _call(self, handle: _WorkerHandle, method: str, *args, **kwargs) -> Any:
+        if handle.channel.closed:
+            raise ConnectionError(f"Shard {handle.worker_id} is not running")
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        handle.pending[call_id] = future
+        # The message is queued before the first await, so calls reach a worker in
+        # the order they were made
+        await handle.channel.send((call_id, method, args, kwargs))
+        return await future
+    
+    async def _shutdown(self, handle: _WorkerHandle):
+        try:
+            await self._call(handle, 'shutdown')
+        except ConnectionError:
+            pass
+        handle.channel.close()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, handle.process.join, 10)
+        if handle.process.is_alive():
+            logger.warning(f"Shard {handle.worker_id} did not exit; terminating")
+            handle.process.terminate()
+    
+    # Routing
+    
+    def worker_for(self, user_id: str) -> str:
+        return self.ring.node_for(user_id)
+    
+    async def call(self, user_id: str, method: str, *args, **kwargs) -> Any:
+        """Run a per-user DeviceManager method on the worker that owns the user"""
+        if method not in ROUTED_METHODS:
+            raise ValueError(f"Not a per-user DeviceManager method: {method}")
+        while user_id in self._moving:
+            await self._moved.wait()
+        # No await between the ownership lookup and queueing the call, so a handover
+        # that starts later is queued behind it
+        handle = self.workers[self.ring.node_for(user_id)]
+        return await self._call(handle, method, user_id, *args, **kwargs)
+    
+    async def authenticate_device(self, user_id: str, device_type: str,
+                                  credentials: Dict[str, str]) -> DeviceConnection:
+        return await self.call(user_id, 'authenticate_device', device_type, credentials)
+    
+    async def sync_user_data(self, user_id: str, start_date: datetime = None,
+                             end_date: datetime = None, device_types: List[str] = None,
+                             priority: int = None) -> Dict[str, SyncResult]:
+        """Sync a user's devices on their worker; results carry timings but not traces"""
+        return await self.call(
+            user_id, 'sync_user_data', start_date, end_date, device_types, priority
+        )
+    
+    async def get_aggregated_metrics(self, user_id: str,
+                                     date: datetime = None) -> AggregatedMetrics:
+        return await self.call(user_id, 'get_aggregated_metrics', date)
+    
+    async def get_real_time_data(self, user_id: str) -> Dict[str, List[HealthMetric]]:
+        return await self.call(user_id, 'get_real_time_data')
+    
+    async def stats(self) -> List[Dict[str, Any]]:
+        """Per-worker process id, cached profiles, stored series and calls in flight"""
+        return list(await asyncio.gather(
+            *(self._call(handle, 'stats') for handle in self.workers.values())
+        ))
+    
+    # Membership changes
+    
+    async def add_worker(self) -> str:
+        """Start another worker and move the users its ring points now own to it"""
+        async with self._rebalance_lock:
+            handle = self._spawn()
+            try:
+                await self._call(handle, 'stats')
+                ring = self.ring.copy()
+                ring.add(handle.worker_id)
+                await self._rebalance(ring)
+            except BaseException:
+                # The ring never included it, so no user is routed there
+                await self._shutdown(self.workers.pop(handle.worker_id))
+                raise
+            return handle.worker_id
+    
+    async def remove_worker(self, worker_id: str):
+        """Move a worker's users to the rest of the ring, then stop it"""
+        async with self._rebalance_lock:
+            if worker_id not in self.workers:
+                raise KeyError(worker_id)
+            if len(self.workers) == 1:
+                raise ValueError("Cannot remove the last shard worker")
+            ring = self.ring.copy()
+            ring.remove(worker_id)
+            await self._rebalance(ring)
+            await self._shutdown(self.workers.pop(worker_id))
+    
+    async def _rebalance(self, ring: ConsistentHashRing) -> int:
+        """
+        Hand over every user whose owner differs under `ring`, then switch to it
+        Users are copied first and purged from their old workers only once every
+        handover succeeded; on failure the ring is unchanged, the old workers still
+        hold everything and the partial copies are purged from the new ones
+        """
+        # Profiles written since the last batch must be in the store to be found
+        await asyncio.gather(*(
+            self._call(handle, 'flush_profiles') for handle in self.workers.values()
+        ))
+        # Users with attributes or data but no profile have to move as well
+        held = await asyncio.gather(*(
+            self._call(handle, 'user_ids') for handle in self.workers.values()
+        ))
+        user_ids = sorted(set(self.profiles).union(*held))
+        
+        moves: Dict[Tuple[str, str], List[str]] = {}
+        for user_id in user_ids:
+            old, new = self.ring.node_for(user_id), ring.node_for(user_id)
+            if old != new:
+                moves.setdefault((old, new), []).append(user_id)
+        moving = [user_id for users in moves.values() for user_id in users]
+        
+        # new worker -> users it may hold a copy of
+        copied: Dict[str, List[str]] = {}
+        
+        async def hand_over(old: str, new: str, users: List[str]):
+            for i in range(0, len(users), HANDOFF_BATCH):
+                batch = users[i:i + HANDOFF_BATCH]
+                handoff = await self._call(self.workers[old], 'release_users', batch)
+                copied.setdefault(new, []).extend(batch)
+                await self._call(self.workers[new], 'adopt_users', handoff)
+        
+        self._moving.update(moving)
+        self._moved.clear()
+        try:
+            # Every handover runs to completion before failures are acted on
+            results = await asyncio.gather(
+                *(hand_over(old, new, users) for (old, new), users in moves.items()),
+                return_exceptions=True
+            )
+            failure = next((r for r in results if isinstance(r, BaseException)), None)
+            if failure is not None:
+                await asyncio.gather(*(
+                    self._call(self.workers[new], 'purge_users', users)
+                    for new, users in copied.items() if new in self.workers
+                ), return_exceptions=True)
+                raise failure
+            
+            self.ring = ring
+            purged = await asyncio.gather(*(
+                self._call(self.workers[old], 'purge_users', users)
+                for (old, _), users in moves.items() if old in ring.nodes
+            ), return_exceptions=True)
+            for error in purged:
+                if isinstance(error, BaseException):
+                    logger.warning(f"Could not purge moved users from their old shard: {error}")
+        finally:
+            self._moving.difference_update(moving)
+            self._moved.set()
+        
+        logger.info(
+            f"Rebalanced {len(moving)} of {len(user_ids)} users across {len(ring.nodes)} shard workers"
+        )
+        return len(moving)